@@ -0,0 +1,124 @@
+"""
+Compare a cold `gpttrace` run with a request served by a warm daemon.
+
+Both paths run the same request against the scripted model server and the
+fake bpftrace of `bench_pipeline.py`. For each run the time until the
+model server sees the first request and the total time of the command are
+recorded; the cold path pays for the imports, the indexes and the model
+client every time, the daemon path only for the client.
+
+Usage (with gpttrace installed, e.g. `pip install -e .`):
+
+    python benchmarks/bench_daemon.py [--runs 5] [--output FILE]
+"""
+import argparse
+import json
+import os
+import shlex
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import ThreadingHTTPServer
+from pathlib import Path
+from typing import Dict, List, Optional
+
+sys.path.insert(0, str(Path(__file__).parent))
+from bench_pipeline import FAKE_BPFTRACE, ScriptedChatServer  # noqa: E402
+
+REQUEST = "which files are opened"
+
+
+class TimedChatServer(ScriptedChatServer):
+    """
+    The scripted model server, also noting when the first request of a run arrives.
+    """
+    first_request: Optional[float] = None
+
+    def do_POST(self) -> None:
+        with self.lock:
+            if type(self).first_request is None:
+                type(self).first_request = time.perf_counter()
+        super().do_POST()
+
+
+def timed_run(command: List[str], env: Dict[str, str]) -> Dict[str, float]:
+    """
+    Runs one request, confirming the program on stdin.
+
+    :param command: The gpttrace command line.
+    :param env: The environment of the command.
+    :return: The seconds until the first model request and until the command exited.
+    """
+    TimedChatServer.first_request = None
+    TimedChatServer.calls = 0
+    start = time.perf_counter()
+    subprocess.run(command, input="y\n", env=env, text=True, check=True,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    total = time.perf_counter() - start
+    first = TimedChatServer.first_request
+    return {"first_llm_s": first - start if first is not None else None, "total_s": total}
+
+
+def wait_for_socket(path: Path, timeout: float = 60) -> None:
+    deadline = time.monotonic() + timeout
+    while not path.exists():
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"the daemon did not listen on {path}")
+        time.sleep(0.05)
+
+
+def summarize(runs: List[Dict[str, float]]) -> Dict[str, float]:
+    """
+    :return: The median of each measurement over the runs.
+    """
+    return {key: statistics.median(run[key] for run in runs if run[key] is not None)
+            for key in runs[0]}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5, help="Requests per path")
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), TimedChatServer)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    with tempfile.TemporaryDirectory() as run_dir:
+        socket = Path(run_dir) / "daemon.sock"
+        env = dict(os.environ, **{
+            "OPENAI_API_BASE": f"http://127.0.0.1:{server.server_address[1]}",
+            "OPENAI_API_KEY": "benchmark",
+            "BPFTRACE_COMMAND": " ".join(shlex.quote(part) for part in [sys.executable, str(FAKE_BPFTRACE)]),
+            "EXAMPLE_RETRIEVER": "bm25",
+            "FAKE_BPFTRACE_BYTES": str(64 << 10),
+            "GPTTRACE_SOCKET": str(socket),
+        })
+        gpttrace = [sys.executable, "-m", "gpttrace"]
+        print("cold runs...", file=sys.stderr)
+        cold = [timed_run(gpttrace + ["--no-daemon", "--no-cache", REQUEST], env) for _ in range(args.runs)]
+
+        print("starting the daemon...", file=sys.stderr)
+        daemon = subprocess.Popen(gpttrace + ["--daemon"], env=env,
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            wait_for_socket(socket)
+            print("daemon runs...", file=sys.stderr)
+            warm = [timed_run(gpttrace + ["--no-cache", REQUEST], env) for _ in range(args.runs)]
+        finally:
+            daemon.terminate()
+            daemon.wait()
+    server.shutdown()
+
+    results = {"runs": args.runs, "cold": summarize(cold), "daemon": summarize(warm)}
+    results["speedup_first_llm"] = results["cold"]["first_llm_s"] / results["daemon"]["first_llm_s"]
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,24 @@
+"""
+Measure how fast `-f json` bpftrace output is parsed into trace tables.
+
+Usage (with gpttrace installed, e.g. `pip install -e .`):
+
+    python benchmarks/bench_json_ingest.py [TRACE.jsonl ...]
+"""
+import json
+import sys
+from pathlib import Path
+
+from gpttrace.trace_data import benchmark_parse
+
+TRACES_PATH = Path(__file__).parent / "traces"
+
+
+def main() -> None:
+    paths = sys.argv[1:] or sorted(str(path) for path in TRACES_PATH.glob("*.jsonl"))
+    results = {Path(path).name: benchmark_parse(path) for path in paths}
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,239 @@
+"""
+Measure the whole `execute()` pipeline against a local model server and a fake bpftrace.
+
+Nothing leaves the machine: chat completions come from a scripted server
+on localhost and bpftrace is replaced by `fake_bpftrace.py`, which prints
+a configurable volume of output at a configurable rate. For each scenario
+the wall time of every stage (retrieval, prompt, llm, exec, explain) is
+recorded, along with the stdout throughput of `run_command_with_timeout`
+and the peak RSS.
+
+Usage (with gpttrace installed, e.g. `pip install -e .`):
+
+    python benchmarks/bench_pipeline.py [--output FILE] [--baseline FILE] [--tolerance 0.2]
+
+With `--baseline`, the wall times and throughputs are compared to an
+earlier `--output` and the exit status is 1 if any regressed by more than
+the tolerance.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import resource
+import shlex
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Any, Dict, List
+
+FAKE_BPFTRACE = Path(__file__).parent / "fake_bpftrace.py"
+PROGRAM = 'tracepoint:syscalls:sys_enter_openat { printf("%d %s %s\\n", pid, comm, str(args->filename)); }'
+EXPLANATION = ("Most files were opened by `cat` under /etc/fake, at a steady rate across "
+               "a few dozen processes. Nothing looks abnormal.")
+# name: (programs the model returns in turn, stdout bytes, MB/s or 0 for unlimited, model delay in s)
+SCENARIOS = {
+    "small": ([PROGRAM], 1 << 20, 0, 0.0),
+    "large": ([PROGRAM], 64 << 20, 0, 0.0),
+    "rated": ([PROGRAM], 8 << 20, 16, 0.0),
+    "retry": (["tracepoint:syscalls:sys_enter_openat { FAIL }", PROGRAM], 1 << 20, 0, 0.0),
+    "slow_model": ([PROGRAM], 1 << 20, 0, 0.05),
+}
+# Bytes read by the raw throughput runs of `run_command_with_timeout`.
+THROUGHPUT_BYTES = 256 << 20
+
+
+class ScriptedChatServer(BaseHTTPRequestHandler):
+    """
+    A chat completion API that answers function calls from a script.
+
+    Requests that offer functions get the next program of `programs`;
+    other requests are explain requests and get `EXPLANATION`.
+    """
+    programs: List[str] = [PROGRAM]
+    delay = 0.0
+    calls = 0
+    lock = threading.Lock()
+
+    def do_POST(self) -> None:
+        payload = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        time.sleep(self.delay)
+        if payload.get("stream"):
+            self._stream()
+            return
+        if payload.get("functions"):
+            with self.lock:
+                program = self.programs[min(type(self).calls, len(self.programs) - 1)]
+                type(self).calls += 1
+            arguments = json.dumps({"program": program})
+            message = {"role": "assistant", "content": None,
+                       "function_call": {"name": "bpftrace", "arguments": arguments}}
+        else:
+            message = {"role": "assistant", "content": EXPLANATION}
+        choices = [{"index": i, "message": message} for i in range(payload.get("n", 1))]
+        body = json.dumps({"choices": choices,
+                           "usage": {"prompt_tokens": 500, "completion_tokens": 60, "total_tokens": 560}})
+        self._send(body.encode("utf-8"), "application/json")
+
+    def _stream(self) -> None:
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.end_headers()
+        for word in EXPLANATION.split(" "):
+            chunk = {"choices": [{"index": 0, "delta": {"content": word + " "}}]}
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+        self.wfile.write(b"data: [DONE]\n\n")
+
+    def _send(self, body: bytes, content_type: str) -> None:
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args: Any) -> None:
+        pass
+
+
+def peak_rss_mb() -> Dict[str, float]:
+    """
+    :return: The peak RSS so far of this process and of its largest child, in MB.
+    """
+    # ru_maxrss is in KiB on Linux.
+    return {"self": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            "children": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024}
+
+
+def run_scenario(name: str) -> Dict[str, Any]:
+    """
+    Runs one request through `execute()` end to end.
+
+    :param name: A key of `SCENARIOS`.
+    :return: The wall and per-stage times, attempts and exec throughput of the request.
+    """
+    from gpttrace.bpftrace import RunPolicy
+    from gpttrace.execute import execute
+    from gpttrace.watchdog import ResourceBudget
+
+    programs, size, rate, delay = SCENARIOS[name]
+    ScriptedChatServer.programs = programs
+    ScriptedChatServer.delay = delay
+    ScriptedChatServer.calls = 0
+    os.environ["FAKE_BPFTRACE_BYTES"] = str(size)
+    os.environ["FAKE_BPFTRACE_RATE"] = str(rate)
+    # The watchdog still samples the command, but without limits it never stops it.
+    policy = RunPolicy(lambda command, timeout: True, echo=False, budget=ResourceBudget())
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        outcome = execute(f"benchmark {name}: which files are opened", use_cache=False, policy=policy)
+    wall = time.perf_counter() - start
+    stages = outcome["stage_times"]
+    return {
+        "ok": outcome["explanation"] is not None,
+        "attempts": len(outcome["attempts"]),
+        "wall_s": wall,
+        "stages_s": stages,
+        "stdout_mb": size / 1e6,
+        "exec_mb_per_s": size / 1e6 / stages["exec"] if stages["exec"] else None,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def run_throughput(line_size: int) -> Dict[str, float]:
+    """
+    Measures how fast `run_command_with_timeout` drains a command's stdout.
+
+    :param line_size: Bytes per output line.
+    :return: The seconds taken and the throughput in MB/s.
+    """
+    from gpttrace.bpftrace import RunPolicy, bpftrace_command, run_command_with_timeout
+    from gpttrace.watchdog import ResourceBudget
+
+    os.environ["FAKE_BPFTRACE_BYTES"] = str(THROUGHPUT_BYTES)
+    os.environ["FAKE_BPFTRACE_RATE"] = "0"
+    os.environ["FAKE_BPFTRACE_LINE"] = str(line_size)
+    lines = [0]
+    # The watchdog still samples the command, but without limits it never stops it.
+    policy = RunPolicy(lambda command, timeout: True, echo=False, budget=ResourceBudget())
+    start = time.perf_counter()
+    run_command_with_timeout(bpftrace_command() + ["-e", PROGRAM], 300,
+                             lambda stream, line: lines.__setitem__(0, lines[0] + 1), policy)
+    seconds = time.perf_counter() - start
+    del os.environ["FAKE_BPFTRACE_LINE"]
+    return {"seconds": seconds, "mb_per_s": THROUGHPUT_BYTES / 1e6 / seconds, "lines": lines[0]}
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> List[str]:
+    """
+    :param results: The results of this run.
+    :param baseline: The results of an earlier run.
+    :param tolerance: The allowed relative slowdown, e.g. 0.2 for 20%.
+    :return: A line per metric that regressed by more than the tolerance.
+    """
+    regressions = []
+    for name, scenario in results["scenarios"].items():
+        old = baseline.get("scenarios", {}).get(name)
+        if old is not None and scenario["wall_s"] > old["wall_s"] * (1 + tolerance):
+            regressions.append(f"{name}: wall {old['wall_s']:.3f}s -> {scenario['wall_s']:.3f}s")
+    for name, run in results["throughput"].items():
+        old = baseline.get("throughput", {}).get(name)
+        if old is not None and run["mb_per_s"] < old["mb_per_s"] / (1 + tolerance):
+            regressions.append(f"throughput {name}: {old['mb_per_s']:.1f} -> {run['mb_per_s']:.1f} MB/s")
+    return regressions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    parser.add_argument("--baseline", help="Compare against the results of an earlier run")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed relative slowdown")
+    parser.add_argument("scenarios", nargs="*", help=f"Scenarios to run, from {', '.join(SCENARIOS)}")
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), ScriptedChatServer)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    # Must be set before gpttrace creates its model client.
+    os.environ.update({
+        "OPENAI_API_BASE": f"http://127.0.0.1:{server.server_address[1]}",
+        "OPENAI_API_KEY": "benchmark",
+        "BPFTRACE_COMMAND": " ".join(shlex.quote(part) for part in [sys.executable, str(FAKE_BPFTRACE)]),
+        "EXAMPLE_RETRIEVER": "bm25",
+        "STREAM_EXPLAIN": "1",
+    })
+    import gpttrace
+
+    results = {
+        "version": gpttrace.__version__,
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "scenarios": {},
+        "throughput": {},
+    }
+    for name in args.scenarios or SCENARIOS:
+        print(f"scenario {name}...", file=sys.stderr)
+        results["scenarios"][name] = run_scenario(name)
+    for line_size in (80, 1024):
+        print(f"throughput {line_size} B lines...", file=sys.stderr)
+        results["throughput"][f"{line_size}B_lines"] = run_throughput(line_size)
+    results["peak_rss_mb"] = peak_rss_mb()
+    server.shutdown()
+
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(results, file, indent=2)
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as file:
+            regressions = compare(results, json.load(file), args.tolerance)
+        for regression in regressions:
+            print("REGRESSION " + regression, file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,33 @@
+"""
+Measure the ranking latency and top-k recall of the bcc tool router.
+
+Usage (with gpttrace installed, e.g. `pip install -e .`):
+
+    python benchmarks/bench_tool_router.py [K ...]
+"""
+import json
+import sys
+import tempfile
+from pathlib import Path
+
+from gpttrace.config import BCC_FUNC_CALL_PATH
+from gpttrace.schema_registry import SchemaRegistry
+from gpttrace.tool_router import ToolRouter, benchmark_router
+
+QUERIES_PATH = Path(__file__).parent / "router_queries.json"
+
+
+def main() -> None:
+    with open(QUERIES_PATH, "r", encoding="utf-8") as file:
+        queries = json.load(file)
+    with tempfile.TemporaryDirectory() as data_dir:
+        registry = SchemaRegistry(BCC_FUNC_CALL_PATH, Path(data_dir) / "generated.json",
+                                  lambda name: "")
+        router = ToolRouter(registry, Path(data_dir) / "tool_router.npz")
+        results = {f"k={k}": benchmark_router(router, queries, k)
+                   for k in [int(k) for k in sys.argv[1:]] or [1, 3, 5]}
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+"""
+A stand-in for `bpftrace` that prints a configurable volume of output.
+
+Point gpttrace at it with `BPFTRACE_COMMAND="python3 benchmarks/fake_bpftrace.py"`.
+It is configured through the environment:
+
+- `FAKE_BPFTRACE_BYTES`: bytes written to stdout (default 1 MiB)
+- `FAKE_BPFTRACE_LINE`: bytes per line, newline included (default 80)
+- `FAKE_BPFTRACE_RATE`: MB/s to write at, 0 for as fast as possible (default 0)
+
+Programs containing `FAIL` exit with a bpftrace style error instead,
+`-d` (dry run) succeeds without output and `-l` lists a few probes.
+"""
+import os
+import sys
+import time
+
+CHUNK_SIZE = 1 << 16
+PROBES = ["tracepoint:syscalls:sys_enter_openat", "tracepoint:syscalls:sys_exit_openat",
+          "kprobe:vfs_read", "kprobe:vfs_write"]
+
+
+def make_chunk(line_size: int) -> bytes:
+    """
+    :param line_size: Bytes per line, newline included.
+    :return: About `CHUNK_SIZE` bytes of whole lines that look like `printf` output.
+    """
+    lines = []
+    for i in range(max(1, CHUNK_SIZE // line_size)):
+        line = f"{4000 + i % 97:<8} {'cat':<16} /etc/fake/{i:06d}"
+        lines.append(line[:line_size - 1].ljust(line_size - 1) + "\n")
+    return "".join(lines).encode("ascii")
+
+
+def main() -> int:
+    args = sys.argv[1:]
+    if "-l" in args:
+        print("\n".join(PROBES))
+        return 0
+    program = args[args.index("-e") + 1] if "-e" in args[:-1] else ""
+    if "FAIL" in program:
+        sys.stderr.write("stdin:1:1-5: ERROR: fake failure\n")
+        return 1
+    if "-d" in args:
+        return 0
+    total = int(os.getenv("FAKE_BPFTRACE_BYTES", str(1 << 20)))
+    rate = float(os.getenv("FAKE_BPFTRACE_RATE", "0")) * 1e6
+    chunk = make_chunk(int(os.getenv("FAKE_BPFTRACE_LINE", "80")))
+    out = sys.stdout.buffer
+    start = time.monotonic()
+    written = 0
+    while written < total:
+        piece = chunk[:total - written]
+        out.write(piece)
+        out.flush()
+        written += len(piece)
+        if rate > 0:
+            ahead = written / rate - (time.monotonic() - start)
+            if ahead > 0:
+                time.sleep(ahead)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,11 +1,30 @@
 #! /bin/env python
 import argparse
 import os
-import pathlib
+import subprocess
+import sys
+import time
+import unittest
 
-from gpttrace.cmd import cmd
-from gpttrace.execute import execute
-from gpttrace.utils.common import pretty_print
+from gpttrace.utils.lazy import SUBCOMMAND_BACKENDS, profile_imports
+
+# Cold start budget for `gpttrace --help`, in seconds.
+HELP_STARTUP_BUDGET = 1.0
+# Modules that must not be imported just to parse the command line.
+HEAVY_MODULES = ["openai", "aiohttp", "langchain", "llama_index", "litellm", "pygments", "prompt_toolkit"]
+
+
+def print_startup_profile(subcommand: str) -> None:
+    """
+    Print the import cost of every module the subcommand needs.
+
+    :param subcommand: The name of the subcommand, a key of `SUBCOMMAND_BACKENDS`.
+    """
+    costs = profile_imports(SUBCOMMAND_BACKENDS[subcommand])
+    print(f"Import cost for `{subcommand}` (incremental):")
+    for name, seconds in costs:
+        print(f"  {name:<24} {seconds * 1000:9.1f} ms")
+    print(f"  {'total':<24} {sum(seconds for _, seconds in costs) * 1000:9.1f} ms")
 
 
 def main() -> None:
@@ -21,6 +40,10 @@ def main() -> None:
         help="Use the bcc tool to complete the trace task",
         nargs=2,
         metavar=("CMD_NAME", "QUERY"))
+    parser.add_argument(
+        "-r", "--route",
+        help="Pick the bcc tool that fits the query and use it to complete the trace task",
+        metavar="QUERY")
     parser.add_argument(
         "-v", "--verbose",
         help="Show more details",
@@ -29,18 +52,137 @@ def main() -> None:
         "-k", "--key",
         help="Openai api key, see `https://platform.openai.com/docs/quickstart/add-your-api-key` or passed through `OPENAI_API_KEY`",
         metavar="OPENAI_API_KEY")
-    parser.add_argument('input_string', type=str, help='Your question or request for a bpf program')
+    parser.add_argument(
+        "--json",
+        help="Run bpftrace with `-f json` and parse its output into tables",
+        action="store_true")
+    parser.add_argument(
+        "--no-cache",
+        help="Always ask the model for a new program instead of reusing a cached one",
+        action="store_true")
+    parser.add_argument(
+        "--candidates",
+        help="Ask for N candidate programs at once and run the first that passes validation",
+        type=int,
+        default=1,
+        metavar="N")
+    parser.add_argument(
+        "--batch",
+        help="Run the requests of a JSON lines or YAML file without a terminal, see `--allow-probes`",
+        metavar="FILE")
+    parser.add_argument(
+        "--batch-output",
+        help="Where `--batch` writes its results as JSON lines",
+        default="batch_results.jsonl",
+        metavar="FILE")
+    parser.add_argument(
+        "--parallel",
+        help="Number of batch requests in flight at once",
+        type=int,
+        default=4,
+        metavar="N")
+    parser.add_argument(
+        "--exec-parallel",
+        help="Number of bpftrace commands a batch runs at once",
+        type=int,
+        default=1,
+        metavar="N")
+    parser.add_argument(
+        "--allow-probes",
+        help="Comma separated probe types batch programs may attach to without approval at the terminal",
+        metavar="TYPES")
+    parser.add_argument(
+        "--history",
+        help="List the latest runs, or the runs whose request or program contains every word of QUERY",
+        nargs="?",
+        const="",
+        metavar="QUERY")
+    parser.add_argument(
+        "--daemon",
+        help="Stay resident with the backends loaded and serve requests over a local socket",
+        action="store_true")
+    parser.add_argument(
+        "--no-daemon",
+        help="Run the request in this process even if a daemon is listening",
+        action="store_true")
+    parser.add_argument(
+        "--profile-startup",
+        help="Report the import cost of each module the command needs and exit",
+        action="store_true")
+    parser.add_argument('input_string', type=str, nargs="?", help='Your question or request for a bpf program')
     args = parser.parse_args()
 
+    if args.profile_startup:
+        print_startup_profile("cmd" if args.cmd is not None or args.route is not None else "execute")
+        return
+    if args.history is not None:
+        from pathlib import Path
+        from gpttrace.config import cfg
+        from gpttrace.history import HistoryStore, format_runs
+        store = HistoryStore(Path(cfg.get("HISTORY_PATH")))
+        runs = store.search(args.history)
+        print(format_runs(runs) if runs else "No runs found.")
+        store.close()
+        return
     if os.getenv('OPENAI_API_KEY', args.key) is None:
-        print(f"Either provide your access token through `-k` or through environment variable {OPENAI_API_KEY}")
+        print("Either provide your access token through `-k` or through environment variable `OPENAI_API_KEY`")
         return
+    if args.key is not None:
+        # cfg prefers the environment over the config file.
+        os.environ["OPENAI_API_KEY"] = args.key
+    if args.daemon:
+        from gpttrace.daemon import serve
+        serve()
+        return
+    # Backends are imported per subcommand so `--help` stays fast.
     if args.cmd is not None:
+        from gpttrace.cmd import cmd
         cmd(args.cmd[0], args.cmd[1], args.verbose)
+    elif args.route is not None:
+        from gpttrace.cmd import route_cmd
+        route_cmd(args.route, args.verbose)
+    elif args.batch is not None:
+        from gpttrace.batch import ApprovalPolicy, load_jobs, run_batch
+        run_batch(load_jobs(args.batch), args.batch_output, args.parallel, args.exec_parallel,
+                  ApprovalPolicy.from_config(args.allow_probes), use_cache=not args.no_cache,
+                  candidates=args.candidates)
     elif args.input_string is not None:
-        execute(args.input_string, args.verbose)
+        if not args.no_daemon and args.key is None:
+            # The daemon keeps the backends loaded; with `-k` the request needs its own key.
+            from gpttrace.daemon import run_client
+            options = {"verbose": args.verbose, "json": args.json, "use_cache": not args.no_cache,
+                       "candidates": args.candidates}
+            if run_client(args.input_string, options) is not None:
+                return
+        from gpttrace.approval import CommandRejected
+        from gpttrace.execute import execute
+        try:
+            execute(args.input_string, args.verbose, json_output=args.json, use_cache=not args.no_cache,
+                    candidates=args.candidates)
+        except CommandRejected:
+            print("Aborting...")
     else:
         parser.print_help()
 
+
+class TestStartup(unittest.TestCase):
+    def test_help_cold_start_budget(self):
+        best = float("inf")
+        for _ in range(3):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, "-m", "gpttrace", "--help"],
+                           stdout=subprocess.DEVNULL, check=True)
+            best = min(best, time.perf_counter() - start)
+        print(f"gpttrace --help: {best * 1000:.1f} ms")
+        self.assertLess(best, HELP_STARTUP_BUDGET)
+
+    def test_help_imports_no_backend(self):
+        code = "import sys, gpttrace.GPTtrace; print(','.join(sorted(sys.modules)))"
+        output = subprocess.check_output([sys.executable, "-c", code], text=True)
+        loaded = output.strip().split(",")
+        for module in HEAVY_MODULES:
+            self.assertNotIn(module, loaded)
+
+
 if __name__ == "__main__":
     main()
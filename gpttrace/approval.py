@@ -0,0 +1,127 @@
+import hashlib
+import io
+import json
+import os
+import tempfile
+import threading
+import unittest
+from pathlib import Path
+from unittest import mock
+from typing import List, Optional, Set
+
+from gpttrace.config import cfg
+
+_lock = threading.Lock()
+
+
+class CommandRejected(Exception):
+    """
+    A command was not approved to run.
+    """
+
+
+class CredentialsRequired(CommandRejected):
+    """
+    sudo needed a password to run a command where nobody can type it.
+    """
+
+
+def command_program(command: List[str]) -> Optional[str]:
+    """
+    :param command: A bpftrace command line.
+    :return: The program passed with `-e`, or None if there is none.
+    """
+    for i, arg in enumerate(command[:-1]):
+        if arg == "-e":
+            return command[i + 1]
+    return None
+
+
+def program_hash(program: str) -> str:
+    """
+    :param program: A bpftrace program.
+    :return: The hex SHA-256 digest of the program, ignoring surrounding whitespace.
+    """
+    return hashlib.sha256(program.strip().encode("utf-8")).hexdigest()
+
+
+def load_approved_programs(path: Optional[Path] = None) -> Set[str]:
+    """
+    :param path: The file of approved program hashes, defaults to `APPROVED_PROGRAMS_PATH`.
+    :return: The hashes of the programs a user approved to run.
+    """
+    path = Path(path if path is not None else cfg.get("APPROVED_PROGRAMS_PATH"))
+    if not path.exists():
+        return set()
+    with open(path, "r", encoding="utf-8") as file:
+        return set(json.load(file))
+
+
+def record_approved_program(program: str, path: Optional[Path] = None) -> None:
+    """
+    Remembers that a user approved a program, so batch runs may run it unattended.
+
+    A file that cannot be read or written is reported, not raised: the
+    program was approved and still runs, it is only not remembered.
+
+    :param program: The approved bpftrace program.
+    :param path: The file of approved program hashes, defaults to `APPROVED_PROGRAMS_PATH`.
+    """
+    path = Path(path if path is not None else cfg.get("APPROVED_PROGRAMS_PATH"))
+    with _lock:
+        tmp_path = None
+        try:
+            approved = load_approved_programs(path)
+            digest = program_hash(program)
+            if digest in approved:
+                return
+            approved.add(digest)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=path.name + ".")
+            with os.fdopen(fd, "w", encoding="utf-8") as file:
+                json.dump(sorted(approved), file)
+            os.replace(tmp_path, path)
+        except (OSError, ValueError) as err:
+            print(f"Could not remember the approved program in {path}: {err}")
+            if tmp_path is not None and os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+
+
+def confirm_on_tty(command: List[str], timeout: int) -> bool:
+    """
+    Asks the user at the terminal whether to run a command, remembering approved programs.
+
+    :param command: The command to run.
+    :param timeout: Seconds after which the command will be killed.
+    :return: Whether the user approved the command.
+    """
+    print("The bpf program to run is: " + ' '.join(command))
+    print("timeout: " + str(timeout))
+    user_input = input("Enter 'y' to proceed: ")
+    if user_input.lower() != 'y':
+        return False
+    program = command_program(command)
+    if program is not None:
+        record_approved_program(program)
+    return True
+
+
+class TestApproval(unittest.TestCase):
+    def test_record_and_load(self):
+        with tempfile.TemporaryDirectory() as data_dir:
+            path = Path(data_dir) / "approved.json"
+            self.assertEqual(load_approved_programs(path), set())
+            command = ["sudo", "bpftrace", "-e", "BEGIN { exit(); }\n"]
+            record_approved_program(command_program(command), path)
+            record_approved_program("BEGIN { exit(); }", path)
+            self.assertEqual(load_approved_programs(path), {program_hash("BEGIN { exit(); }")})
+
+    def test_failed_write_still_approves(self):
+        with tempfile.TemporaryDirectory() as data_dir:
+            # The parent of the file is a file, so it cannot be written.
+            path = Path(data_dir) / "approved.json" / "approved.json"
+            Path(data_dir, "approved.json").write_text("[]")
+            with mock.patch("gpttrace.approval.cfg", {"APPROVED_PROGRAMS_PATH": str(path)}), \
+                    mock.patch("builtins.input", return_value="y"), mock.patch("sys.stdout", io.StringIO()) as out:
+                self.assertTrue(confirm_on_tty(["sudo", "bpftrace", "-e", "BEGIN { exit(); }"], 5))
+            self.assertIn("Could not remember the approved program", out.getvalue())
@@ -0,0 +1,324 @@
+import copy
+import json
+import tempfile
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Iterable, List, Optional, Set, TypedDict
+from unittest import mock
+
+from click import UsageError
+
+from gpttrace.approval import CommandRejected, command_program, load_approved_programs, program_hash
+from gpttrace.bpftrace import RunPolicy, bpftrace_command
+from gpttrace.config import cfg
+from gpttrace.execute import execute
+from gpttrace.validate import attach_points, static_check
+
+# Short probe types and the type they stand for.
+PROBE_ALIASES = {
+    "k": "kprobe", "kr": "kretprobe", "u": "uprobe", "ur": "uretprobe", "t": "tracepoint",
+    "U": "usdt", "p": "profile", "i": "interval", "s": "software", "h": "hardware",
+    "w": "watchpoint", "aw": "asyncwatchpoint", "f": "kfunc", "fentry": "kfunc",
+    "fr": "kretfunc", "fexit": "kretfunc", "rt": "rawtracepoint", "it": "iter",
+}
+# Probes that run once in bpftrace itself and attach to nothing in the kernel.
+ALWAYS_ALLOWED = {"BEGIN", "END"}
+# bpftrace options batch runs may pass, and whether each takes a value. Others, such as `-o` that
+# writes a file or `-I` that includes headers, need approval at the terminal.
+ALLOWED_OPTIONS = {"-e": True, "-f": True, "-B": True, "-q": False, "-v": False, "--no-warnings": False}
+
+
+class Job(TypedDict, total=False):
+    # name of the job in the results, defaults to its line number
+    id: str
+    # the request, as it would be typed on the command line
+    request: str
+    # seconds the bpftrace command may run, capped by `BATCH_MAX_TIMEOUT`
+    timeout: int
+    # run bpftrace with `-f json` and parse its output into tables
+    json: bool
+
+
+class JobResult(TypedDict):
+    id: str
+    request: str
+    # "ok", "failed" (retries exhausted), "rejected" (not approved) or "error"
+    status: str
+    command: Optional[str]
+    stderr: Optional[str]
+    explanation: Optional[str]
+    attempts: int
+    tokens: int
+    # seconds from the job starting to its result
+    duration: float
+
+
+class ApprovalPolicy:
+    """
+    Approves bpftrace commands without a terminal.
+
+    A program runs if a user approved the same program at the terminal
+    before, or if it passes the static check and only attaches to the
+    allowed probe types, and in both cases only with the options of
+    `ALLOWED_OPTIONS`. Otherwise it is rejected with the reason.
+    """
+    def __init__(self, probe_types: Iterable[str], approved: Set[str]):
+        """
+        Initializes an ApprovalPolicy object.
+
+        :param probe_types: The probe types that may be attached to, short aliases allowed.
+        :param approved: The hashes of the programs approved at the terminal.
+        """
+        self.probe_types = {PROBE_ALIASES.get(probe_type, probe_type) for probe_type in probe_types}
+        self.approved = approved
+
+    @classmethod
+    def from_config(cls, probe_types: Optional[str] = None) -> "ApprovalPolicy":
+        """
+        :param probe_types: Comma separated probe types, defaults to `BATCH_ALLOWED_PROBES`.
+        :return: The policy of the configured allowlist and the approved programs.
+        """
+        if probe_types is None:
+            probe_types = cfg.get("BATCH_ALLOWED_PROBES")
+        return cls([t.strip() for t in probe_types.split(",") if t.strip()], load_approved_programs())
+
+    def reason(self, command: List[str]) -> str:
+        """
+        :param command: The bpftrace command to run.
+        :return: Why the command may not run, or "" if it may.
+        """
+        program = command_program(command)
+        if program is None:
+            return "not a bpftrace program"
+        # Batch runs use `sudo -n`, see `run_batch`.
+        prefixes = [bpftrace_command(non_interactive=True), bpftrace_command()]
+        prefix = next((prefix for prefix in prefixes if command[:len(prefix)] == prefix), None)
+        if prefix is None:
+            return "not the configured bpftrace command"
+        options = command[len(prefix):]
+        i = 0
+        while i < len(options):
+            if options[i] == "--unsafe":
+                return "unsafe programs need approval at the terminal"
+            if options[i] not in ALLOWED_OPTIONS:
+                return f"option not allowed: {options[i]}"
+            i += 2 if ALLOWED_OPTIONS[options[i]] else 1
+        # Only the program was approved, so its options are checked first.
+        if program_hash(program) in self.approved:
+            return ""
+        error = static_check(program)
+        if error:
+            return error
+        for probe in attach_points(program):
+            probe_type = probe.split(":")[0]
+            if probe_type in ALWAYS_ALLOWED:
+                continue
+            if PROBE_ALIASES.get(probe_type, probe_type) not in self.probe_types:
+                return f"probe type not allowed: {probe}"
+        return ""
+
+    def __call__(self, command: List[str], timeout: int) -> bool:
+        """
+        A `RunPolicy` confirm callback.
+
+        :raises CommandRejected: With the reason, if the command may not run.
+        """
+        reason = self.reason(command)
+        if reason:
+            raise CommandRejected(reason)
+        return True
+
+
+def load_jobs(path: Path) -> List[Job]:
+    """
+    Reads the jobs of a batch run.
+
+    `.yaml` and `.yml` files hold a list of jobs or a mapping with a `jobs`
+    list; anything else is read as JSON lines. A job is either a request
+    string or a mapping with a `request` and the optional `Job` fields.
+
+    :param path: The path of the jobs file.
+    :return: The jobs, each with an `id`.
+    """
+    path = Path(path)
+    with open(path, "r", encoding="utf-8") as file:
+        if path.suffix in (".yaml", ".yml"):
+            try:
+                import yaml
+            except ImportError as err:
+                raise UsageError("Reading YAML jobs needs PyYAML: `pip install pyyaml`") from err
+            entries = yaml.safe_load(file) or []
+            if isinstance(entries, dict):
+                entries = entries.get("jobs", [])
+        else:
+            entries = [json.loads(line) for line in file if line.strip() and not line.startswith("#")]
+    jobs = []
+    for i, entry in enumerate(entries, 1):
+        job: Job = {"request": entry} if isinstance(entry, str) else dict(entry)
+        if not job.get("request"):
+            raise UsageError(f"Job {i} in {path} has no request")
+        job["id"] = str(job.get("id", i))
+        jobs.append(job)
+    return jobs
+
+
+def run_job(job: Job, policy: RunPolicy, use_cache: bool = True, candidates: int = 1) -> JobResult:
+    """
+    Runs one job without a terminal.
+
+    :param job: The job to run.
+    :param policy: How its bpftrace commands are approved and run.
+    :param use_cache: Whether to look up and store programs in the program cache.
+    :param candidates: The number of candidate programs requested per attempt.
+    :return: The result of the job.
+    """
+    start = time.perf_counter()
+    result: JobResult = {"id": job["id"], "request": job["request"], "status": "error", "command": None,
+                         "stderr": None, "explanation": None, "attempts": 0, "tokens": 0, "duration": 0.0}
+    if job.get("timeout") is not None:
+        max_timeout = int(job["timeout"])
+        if policy.max_timeout is not None:
+            max_timeout = min(max_timeout, policy.max_timeout)
+        # A copy keeps the lock, the budget and the other settings of the batch.
+        policy = copy.copy(policy)
+        policy.max_timeout = max_timeout
+    try:
+        outcome = execute(job["request"], json_output=bool(job.get("json")), use_cache=use_cache,
+                          candidates=candidates, policy=policy)
+    except CommandRejected as err:
+        result.update(status="rejected", stderr=str(err))
+    except Exception as err:
+        result["stderr"] = f"{type(err).__name__}: {err}"
+    else:
+        attempts = outcome["attempts"]
+        res = outcome["result"]
+        result.update(
+            status="ok" if outcome["explanation"] is not None else "failed",
+            command=res["command"] if res is not None else None,
+            stderr=res["stderr"] if res is not None else None,
+            explanation=outcome["explanation"],
+            attempts=len(attempts),
+            tokens=sum(r["prompt_tokens"] + r["completion_tokens"] for r in attempts))
+    result["duration"] = time.perf_counter() - start
+    return result
+
+
+def run_batch(jobs: List[Job], output_path: Path, parallel: int = 4, exec_parallel: int = 1,
+              approval: Optional[ApprovalPolicy] = None, use_cache: bool = True,
+              candidates: int = 1) -> List[JobResult]:
+    """
+    Runs jobs concurrently without a terminal.
+
+    Up to `parallel` jobs ask the model for programs at once, but only
+    `exec_parallel` bpftrace commands run at once, so the traces do not
+    perturb each other. Results are appended to the output file as JSON
+    lines as soon as each job finishes.
+
+    :param jobs: The jobs to run.
+    :param output_path: The JSON lines file the results are written to.
+    :param parallel: The number of jobs in flight at once.
+    :param exec_parallel: The number of bpftrace commands running at once.
+    :param approval: Decides which commands may run, defaults to `ApprovalPolicy.from_config()`.
+    :param use_cache: Whether to look up and store programs in the program cache.
+    :param candidates: The number of candidate programs requested per attempt.
+    :return: The results, in the order of the jobs.
+    """
+    approval = approval if approval is not None else ApprovalPolicy.from_config()
+    # Nobody can type a sudo password for a worker thread.
+    policy = RunPolicy(approval, threading.BoundedSemaphore(exec_parallel),
+                       int(cfg.get("BATCH_MAX_TIMEOUT")), echo=False, non_interactive=True)
+    write_lock = threading.Lock()
+    output_path = Path(output_path)
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(output_path, "w", encoding="utf-8") as output:
+
+        def run(job: Job) -> JobResult:
+            result = run_job(job, policy, use_cache, candidates)
+            with write_lock:
+                output.write(json.dumps(result) + "\n")
+                output.flush()
+                print(f"[{result['id']}] {result['status']} in {result['duration']:.1f}s")
+            return result
+
+        with ThreadPoolExecutor(max_workers=max(1, parallel)) as pool:
+            results = list(pool.map(run, jobs))
+    counts = {}
+    for result in results:
+        counts[result["status"]] = counts.get(result["status"], 0) + 1
+    print(f"{len(results)} jobs: " + ", ".join(f"{n} {status}" for status, n in sorted(counts.items())))
+    return results
+
+
+def _command(program: str, *flags: str) -> List[str]:
+    return bpftrace_command() + [*flags, "-e", program]
+
+
+class TestBatch(unittest.TestCase):
+    def test_approval_policy(self):
+        approved = "kprobe:vfs_read { @ = count(); }"
+        policy = ApprovalPolicy(["t", "profile"], {program_hash(approved)})
+        self.assertEqual(policy.reason(_command("BEGIN { } t:syscalls:sys_enter_openat { }")), "")
+        self.assertEqual(policy.reason(_command("profile:hz:99 { @[kstack] = count(); }")), "")
+        self.assertEqual(policy.reason(_command(approved)), "")
+        self.assertEqual(policy.reason(_command(approved, "-f", "json", "-q")), "")
+        self.assertEqual(policy.reason(bpftrace_command(non_interactive=True) + ["-e", approved]), "")
+        self.assertEqual(policy.reason(_command(approved, "-o", "/etc/cron.d/x")), "option not allowed: -o")
+        self.assertEqual(policy.reason(_command("BEGIN { }", "-I", "/tmp")), "option not allowed: -I")
+        self.assertEqual(policy.reason(["bpftrace", "-e", approved]), "not the configured bpftrace command")
+        self.assertEqual(policy.reason(_command("kprobe:vfs_write { }")), "probe type not allowed: kprobe:vfs_write")
+        self.assertEqual(policy.reason(_command("t:a:b { system(\"ls\"); }", "--unsafe")),
+                         "unsafe programs need approval at the terminal")
+        self.assertEqual(policy.reason(_command("t:a:b {")), "ERROR: missing '}'")
+        with self.assertRaises(CommandRejected):
+            policy(_command("u:/bin/bash:readline { }"), 10)
+
+    def test_job_timeout_keeps_the_policy(self):
+        policy = RunPolicy(ApprovalPolicy(["tracepoint"], set()), threading.BoundedSemaphore(1), 60, echo=False,
+                           budget=mock.sentinel.budget, non_interactive=True)
+        with mock.patch("gpttrace.batch.execute", side_effect=RuntimeError) as fake_execute:
+            run_job({"id": "1", "request": "trace open", "timeout": 5}, policy)
+        used = fake_execute.call_args.kwargs["policy"]
+        self.assertEqual((used.max_timeout, used.budget, used.non_interactive, used.lock, used.echo),
+                         (5, mock.sentinel.budget, True, policy.lock, False))
+        self.assertEqual(policy.max_timeout, 60)
+
+    def test_load_jobs(self):
+        with tempfile.TemporaryDirectory() as data_dir:
+            path = Path(data_dir) / "jobs.jsonl"
+            path.write_text('"count syscalls by process"\n\n{"id": "io", "request": "trace block io", "timeout": 5}\n')
+            jobs = load_jobs(path)
+        self.assertEqual(jobs, [{"request": "count syscalls by process", "id": "1"},
+                                {"id": "io", "request": "trace block io", "timeout": 5}])
+
+    def test_run_batch_serializes_execution(self):
+        running = []
+        peak = []
+
+        def fake_execute(request, json_output, use_cache, candidates, policy):
+            self.assertTrue(policy.non_interactive)
+            command = _command("t:syscalls:sys_enter_openat { }" if "open" in request else "k:vfs_read { }")
+            policy.confirm(command, policy.max_timeout)
+            with policy.lock:
+                running.append(request)
+                peak.append(len(running))
+                time.sleep(0.02)
+                running.remove(request)
+            res = {"command": " ".join(command), "stdout": "", "stderr": "", "returncode": 0}
+            attempt = {"prompt_tokens": 10, "completion_tokens": 5}
+            return {"attempts": [attempt], "result": res, "explanation": "done"}
+
+        jobs = [{"id": str(i), "request": "trace open"} for i in range(6)] + [{"id": "k", "request": "vfs read"}]
+        with tempfile.TemporaryDirectory() as data_dir, \
+                mock.patch("gpttrace.batch.execute", side_effect=fake_execute):
+            output_path = Path(data_dir) / "results.jsonl"
+            results = run_batch(jobs, output_path, parallel=4, exec_parallel=1,
+                                approval=ApprovalPolicy(["tracepoint"], set()))
+            written = [json.loads(line) for line in output_path.read_text().splitlines()]
+        self.assertEqual(max(peak), 1)
+        self.assertEqual([r["status"] for r in results], ["ok"] * 6 + ["rejected"])
+        self.assertEqual(results[-1]["stderr"], "probe type not allowed: k:vfs_read")
+        self.assertEqual(results[0]["tokens"], 15)
+        self.assertEqual(sorted(r["id"] for r in written), sorted(job["id"] for job in jobs))
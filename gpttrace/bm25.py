@@ -0,0 +1,202 @@
+import re
+import tempfile
+import time
+import unittest
+from pathlib import Path
+from typing import Dict, List
+
+import numpy as np
+
+from gpttrace.example_index import document_hash
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9_]+")
+STOP_WORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "by", "code", "for", "from", "in", "is",
+    "it", "of", "on", "or", "that", "the", "this", "to", "with", "write", "bpf", "example",
+}
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    Splits text into lowercase terms for lexical matching.
+
+    Identifiers such as `sys_enter_openat` are kept whole and also split into
+    their parts, so both the exact probe name and its words can match.
+
+    :param text: The text to tokenize.
+    :return: The terms of the text.
+    """
+    terms = []
+    for token in TOKEN_PATTERN.findall(text.lower()):
+        parts = [part for part in token.split("_") if part]
+        if len(parts) > 1:
+            terms.extend(parts)
+        terms.append(token.strip("_"))
+    return [term for term in terms if term and term not in STOP_WORDS]
+
+
+class BM25Index:
+    """
+    An inverted index over a fixed corpus with precomputed BM25 weights.
+
+    Postings are stored in CSR form: the postings of term `t` are
+    `doc_ids[indptr[t]:indptr[t + 1]]` with their BM25 contributions in the
+    same slice of `weights`. A query is a single `np.bincount` over the
+    postings of its terms.
+    """
+    def __init__(self, documents: List[str], vocab: List[str], indptr: np.ndarray,
+                 doc_ids: np.ndarray, weights: np.ndarray, hashes: List[str]):
+        """
+        Initializes a BM25Index object. Use `build` or `load` instead of calling this directly.
+
+        :param documents: The documents of the corpus.
+        :param vocab: The terms of the corpus, in posting order.
+        :param indptr: The offsets of each term's postings.
+        :param doc_ids: The document of each posting.
+        :param weights: The BM25 weight of each posting.
+        :param hashes: The content hash of each document.
+        """
+        self.documents = documents
+        self.vocab: Dict[str, int] = {term: i for i, term in enumerate(vocab)}
+        self.indptr = indptr
+        self.doc_ids = doc_ids
+        self.weights = weights
+        self.hashes = hashes
+
+    @classmethod
+    def build(cls, documents: List[str], k1: float = 1.5, b: float = 0.75) -> "BM25Index":
+        """
+        Builds the index for a corpus.
+
+        :param documents: The documents of the corpus.
+        :param k1: The BM25 term frequency saturation.
+        :param b: The BM25 length normalization.
+        :return: The index.
+        """
+        doc_terms = [tokenize(document) for document in documents]
+        lengths = np.array([len(terms) for terms in doc_terms], dtype=np.float32)
+        avg_length = float(lengths.mean()) if len(documents) else 0.0
+        postings: Dict[str, Dict[int, int]] = {}
+        for doc_id, terms in enumerate(doc_terms):
+            for term in terms:
+                counts = postings.setdefault(term, {})
+                counts[doc_id] = counts.get(doc_id, 0) + 1
+
+        vocab = sorted(postings)
+        indptr = np.zeros(len(vocab) + 1, dtype=np.int64)
+        doc_ids = []
+        weights = []
+        for i, term in enumerate(vocab):
+            counts = postings[term]
+            idf = np.log(1 + (len(documents) - len(counts) + 0.5) / (len(counts) + 0.5))
+            for doc_id, tf in counts.items():
+                norm = k1 * (1 - b + b * lengths[doc_id] / avg_length)
+                doc_ids.append(doc_id)
+                weights.append(idf * tf * (k1 + 1) / (tf + norm))
+            indptr[i + 1] = len(doc_ids)
+        hashes = [document_hash(document) for document in documents]
+        return cls(list(documents), vocab, indptr, np.array(doc_ids, dtype=np.int32),
+                   np.array(weights, dtype=np.float32), hashes)
+
+    def save(self, path: Path) -> None:
+        """
+        Serializes the index to a `.npz` file.
+
+        :param path: The destination path.
+        """
+        vocab = sorted(self.vocab, key=self.vocab.get)
+        with open(path, "wb") as file:
+            np.savez(file, vocab=np.array(vocab, dtype=str), indptr=self.indptr,
+                     doc_ids=self.doc_ids, weights=self.weights,
+                     hashes=np.array(self.hashes, dtype=str))
+
+    @classmethod
+    def load(cls, path: Path, documents: List[str]) -> "BM25Index":
+        """
+        Loads an index saved with `save`, rebuilding it if the corpus changed.
+
+        :param path: The path of the `.npz` file.
+        :param documents: The current documents of the corpus.
+        :return: The index.
+        """
+        hashes = [document_hash(document) for document in documents]
+        if Path(path).exists():
+            with np.load(path) as data:
+                if data["hashes"].tolist() == hashes:
+                    return cls(list(documents), data["vocab"].tolist(), data["indptr"],
+                               data["doc_ids"], data["weights"], hashes)
+        index = cls.build(documents)
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        index.save(path)
+        return index
+
+    def scores(self, query: str) -> np.ndarray:
+        """
+        Scores every document against the query.
+
+        :param query: The query text.
+        :return: The BM25 score of each document.
+        """
+        term_ids = {self.vocab[term] for term in tokenize(query) if term in self.vocab}
+        if not term_ids:
+            return np.zeros(len(self.documents), dtype=np.float32)
+        slices = [np.arange(self.indptr[i], self.indptr[i + 1]) for i in term_ids]
+        postings = np.concatenate(slices)
+        return np.bincount(self.doc_ids[postings], weights=self.weights[postings],
+                           minlength=len(self.documents))
+
+    def rank(self, query: str, k: int = 2) -> List[int]:
+        """
+        Finds the positions of the documents that best match the query.
+
+        :param query: The query text.
+        :param k: The number of documents to return.
+        :return: The indexes of the best matching documents, best first.
+        """
+        scores = self.scores(query)
+        k = min(k, len(scores))
+        if k == 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        return top[np.argsort(-scores[top], kind="stable")].tolist()
+
+    def search(self, query: str, k: int = 2) -> List[str]:
+        """
+        Finds the documents that best match the query.
+
+        :param query: The query text.
+        :param k: The number of documents to return.
+        :return: The best matching documents, best first.
+        """
+        return [self.documents[i] for i in self.rank(query, k)]
+
+
+class TestBM25Index(unittest.TestCase):
+    docs = [
+        "example: count syscalls by process name\n@[comm] = count();",
+        "example: trace block io latency with a histogram\nkprobe:blk_account_io_start",
+        "example: files opened by process\ntracepoint:syscalls:sys_enter_openat",
+    ]
+
+    def test_search(self):
+        index = BM25Index.build(self.docs)
+        self.assertEqual(index.search("which files are opened", k=1), [self.docs[2]])
+        self.assertEqual(index.search("sys_enter_openat", k=1), [self.docs[2]])
+        self.assertEqual(index.search("block io", k=1), [self.docs[1]])
+
+    def test_save_and_load(self):
+        with tempfile.TemporaryDirectory() as index_dir:
+            path = Path(index_dir) / "bm25.npz"
+            BM25Index.build(self.docs).save(path)
+            index = BM25Index.load(path, self.docs)
+            self.assertEqual(index.search("syscalls", k=1), [self.docs[0]])
+            # A changed corpus is rebuilt instead of served stale.
+            index = BM25Index.load(path, self.docs[:2])
+            self.assertEqual(len(index.documents), 2)
+
+    def test_query_latency(self):
+        index = BM25Index.build(self.docs * 30)
+        start = time.perf_counter()
+        for _ in range(100):
+            index.search("count page faults by process")
+        self.assertLess((time.perf_counter() - start) / 100, 0.001)
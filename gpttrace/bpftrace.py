@@ -1,10 +1,21 @@
 #!/bin/python
+import contextlib
+import re
+import shlex
 import subprocess
-import openai
 import json
-import unittest
 import threading
-from typing import List, TypedDict
+import unittest
+from typing import Callable, List, Optional, Tuple, TypedDict
+
+from gpttrace.capture import LineCallback, capture_output
+from gpttrace import llm
+from gpttrace.approval import CommandRejected, CredentialsRequired, confirm_on_tty
+from gpttrace.config import cfg
+from gpttrace.watchdog import ResourceBudget, ResourceUsage, Watchdog
+
+# How `sudo -n` reports that it could not run the command, e.g. "sudo: a password is required".
+SUDO_ERROR = re.compile(r"^sudo: ")
 
 functions = [
     {
@@ -96,57 +107,116 @@ functions = [
     }
 ]
 
-class CommandResult(TypedDict):
+class _CommandResult(TypedDict):
     command: str
     stdout: str
     stderr: str
     returncode: int
 
-def run_command_with_timeout(command: List[str], timeout: int) -> CommandResult:
+class CommandResult(_CommandResult, total=False):
+    # token usage of the model call that produced the command
+    usage: dict
+    # CPU, memory and output of the command as seen by the watchdog
+    resources: ResourceUsage
+
+def bpftrace_command(non_interactive: bool = False) -> List[str]:
+    """
+    :param non_interactive: Whether sudo must fail instead of asking for a password, for checks run in the background.
+    :return: The command that runs bpftrace, from `BPFTRACE_COMMAND`.
+    """
+    command = shlex.split(cfg.get("BPFTRACE_COMMAND"))
+    if non_interactive and command[:1] == ["sudo"]:
+        command.insert(1, "-n")
+    return command
+
+
+class RunPolicy:
+    """
+    How commands are approved and run.
+
+    The default asks at the terminal. Unattended runs pass their own
+    `confirm`, a lock that caps how many commands run at once on the host,
+    and a cap on how long each may run. Every command also runs under a
+    resource budget, see `Watchdog`.
+    """
+    def __init__(self, confirm: Callable[[List[str], int], bool] = confirm_on_tty,
+                 lock: Optional[threading.Semaphore] = None, max_timeout: Optional[int] = None,
+                 echo: bool = True, budget: Optional[ResourceBudget] = None, non_interactive: bool = False):
+        """
+        Initializes a RunPolicy object.
+
+        :param confirm: Called with the command and its timeout; the command runs only if it returns True.
+            It may also raise `CommandRejected` with the reason itself.
+        :param lock: Held while a command runs.
+        :param max_timeout: The longest a command may run, in seconds, whatever the model asked for.
+        :param echo: Whether to print the output of commands as it arrives.
+        :param budget: The CPU, memory and output rate a command may use, defaults to the configured budget.
+        :param non_interactive: Whether sudo must fail instead of asking for a password, for runs
+            whose process has no terminal of its own, such as the daemon's.
+        """
+        self.confirm = confirm
+        self.lock = lock
+        self.max_timeout = max_timeout
+        self.echo = echo
+        self.budget = budget
+        self.non_interactive = non_interactive
+
+
+def run_command_with_timeout(command: List[str], timeout: int,
+                             on_line: Optional[LineCallback] = None,
+                             policy: Optional[RunPolicy] = None) -> CommandResult:
     """
     This function runs a command with a timeout.
+
+    Output is streamed to the terminal line by line while the command runs.
+    Only the tail of each stream is kept in the result.
+
+    :param command: The command to run.
+    :param timeout: Seconds after which the command is killed.
+    :param on_line: Called with the stream name ("stdout" or "stderr") and each output line.
+    :param policy: How the command is approved and run, defaults to asking at the terminal.
+    :return: The result of the command.
+    :raises CommandRejected: If the command was not approved.
+    :raises CredentialsRequired: If the policy is non-interactive and sudo needed a password.
     """
-    print("The bpf program to run is: " + ' '.join(command))
-    print("timeout: " + str(timeout))
-    user_input = input("Enter 'y' to proceed: ")
-    if user_input.lower() != 'y':
-        print("Aborting...")
-        exit()
+    policy = policy if policy is not None else RunPolicy()
+    if policy.max_timeout is not None:
+        timeout = min(timeout, policy.max_timeout)
+    if not policy.confirm(command, timeout):
+        raise CommandRejected(' '.join(command))
+    budget = policy.budget if policy.budget is not None else ResourceBudget.from_config()
+    with policy.lock if policy.lock is not None else contextlib.nullcontext():
+        result = _run_command(command, timeout, on_line, policy.echo, budget)
+    if policy.non_interactive and result["returncode"] != 0 and SUDO_ERROR.match(result["stderr"]):
+        # Not the program's fault: retrying with another one would fail the same way.
+        raise CredentialsRequired(result["stderr"].strip())
+    return result
+
+
+def _run_command(command: List[str], timeout: int, on_line: Optional[LineCallback],
+                 echo: bool, budget: ResourceBudget) -> CommandResult:
     # Start the process
-    with subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True) as process:
-        timer = threading.Timer(timeout, process.kill)
-        stdout = ""
-        stderr = ""
+    with subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE) as process:
+        stdout, stderr = "", ""
+        watchdog = Watchdog(process, budget)
         try:
-            # Set a timer to kill the process if it doesn't finish within the timeout
-            timer.start()
-            while process.poll() is None:
-                # Only try to read output if the process is still running
-                if process.stdout.readable():
-                    line = process.stdout.read()
-                    print(line, end='')
-                    stdout += line
-            # Wait for the process to finish and get the output
-            last_stdout, last_stderr = process.communicate()
-            stdout += last_stdout
-            stderr += last_stderr
+            stdout, stderr, _ = capture_output(process, timeout, on_line, echo, watchdog)
         except Exception as e:
             print("Exception: " + str(e))
-        finally:
-            # Make sure the timer is canceled
-            timer.cancel()
-            if process.poll() is None and process.stdout.readable():
-                stdout += process.stdout.read()
-                print(stdout)
-            if process.poll() is None and process.stderr.readable():
-                stderr += process.stderr.read()
-                print(stderr)
-            return {
-                "command": ' '.join(command),
-                "stdout": stdout,
-                "stderr": stderr,
-                "returncode": process.returncode
-            }
+            process.kill()
+            # Not a success: the output was lost with the exception.
+            stderr = f"ERROR: reading the output failed: {type(e).__name__}: {e}"
+        process.wait()
+        if watchdog.usage["exceeded"] is not None:
+            print(f"Stopped by the resource watchdog with {watchdog.usage['signal']}: "
+                  f"{watchdog.usage['exceeded']}")
+        return {
+            "command": ' '.join(command),
+            "stdout": stdout,
+            "stderr": stderr,
+            "returncode": process.returncode,
+            "resources": watchdog.usage
+        }
 
 
 def construct_command(operation: dict) -> list:
@@ -183,43 +253,104 @@ def construct_command(operation: dict) -> list:
     return cmd
 
 
-def run_bpftrace(prompt: str, verbose: bool = False) -> CommandResult:
+def request_function_call(prompt: str, verbose: bool = False, model: Optional[str] = None) -> Tuple[dict, dict]:
     """
-    This function sends a list of messages and functions to the GPT model
-    and runs the function call returned by the model.
+    This function sends the prompt and the available functions to the GPT model.
+
+    :param prompt: The prompt to send.
+    :param verbose: Whether to print the model's response.
+    :param model: The model to ask, defaults to `GENERATION_MODEL`.
+    :return: The response message and the token usage reported for the call.
+    """
+    response_messages, usage = request_function_calls(prompt, 1, verbose, model)
+    return response_messages[0], usage
 
-    Parameters:
-    messages (list): A list of dictionaries where each dictionary represents a message.
 
-    Returns:
-    None
+def request_function_calls(prompt: str, n: int, verbose: bool = False,
+                           model: Optional[str] = None) -> Tuple[List[dict], dict]:
+    """
+    This function asks the GPT model for several candidate function calls in one request.
+
+    :param prompt: The prompt to send.
+    :param n: The number of candidates.
+    :param verbose: Whether to print the model's responses.
+    :param model: The model to ask, defaults to `GENERATION_MODEL`.
+    :return: The response message of each candidate and the token usage reported for the call.
     """
     # Send the conversation and available functions to GPT
     messages = [{"role": "user", "content": prompt}]
-    response = openai.ChatCompletion.create(
-        model="gpt-3.5-turbo",
-        messages=messages,
+    response = llm.chat(
+        messages,
+        model or cfg.get("GENERATION_MODEL"),
         functions=functions,
         function_call="auto",  # auto is default, but we'll be explicit
+        n=n,
     )
-    response_message = response["choices"][0]["message"]
+    response_messages = [choice["message"] for choice in response["choices"]]
     if verbose:
-        print(response_message)
+        for response_message in response_messages:
+            print(response_message)
+    return response_messages, dict(response.get("usage", {}))
+
+
+def run_function_call(response_message: dict, on_line: Optional[LineCallback] = None,
+                      output_format: Optional[str] = None,
+                      policy: Optional[RunPolicy] = None) -> CommandResult:
+    """
+    This function runs the function call returned by the model.
+
+    :param response_message: The response message of the model.
+    :param on_line: Called with the stream name and each output line of the bpftrace command.
+    :param output_format: Force this bpftrace output format (`-f`), e.g. "json".
+    :param policy: How the bpftrace command is approved and run, defaults to asking at the terminal.
+    :return: The result of the function call, or the message content if there is none.
+    :raises CommandRejected: If the bpftrace command was not approved.
+    """
     # Check if GPT wanted to call a function
     if response_message.get("function_call"):
-        full_command = ["sudo"]
         if response_message["function_call"]["name"] == "bpftrace":
             # call bpftrace function
-            full_command.append(response_message["function_call"]["name"])
-            args = json.loads(response_message["function_call"]["arguments"])
+            full_command = bpftrace_command(policy is not None and policy.non_interactive)
+            try:
+                args = json.loads(response_message["function_call"]["arguments"])
+            except json.JSONDecodeError as err:
+                return {
+                    "command": " ".join(full_command + [response_message["function_call"]["arguments"]]),
+                    "stdout": "",
+                    "stderr": f"ERROR: invalid function call arguments: {err}",
+                    "returncode": 1
+                }
+            if output_format is not None:
+                args["format"] = output_format
+                # output must reach the pipe to be parsed
+                args.pop("outputFile", None)
 
+            # validate imports this module, so import it here.
+            from gpttrace.validate import check_attach_points
+            error = check_attach_points(args.get("program", ""))
+            if error != "":
+                # Rejected before asking the user to run it.
+                return {
+                    "command": " ".join(full_command + construct_command(args)),
+                    "stdout": "",
+                    "stderr": error,
+                    "returncode": 1
+                }
+            mode = cfg.get("OVERHEAD_MODE")
+            if mode != "off" and args.get("program"):
+                from gpttrace.overhead import analyze_program, format_report
+                report = analyze_program(args["program"])
+                if report["output_before"] != report["output_after"]:
+                    print(format_report(report))
+                    if mode == "rewrite":
+                        args["program"] = report["program"]
             command = construct_command(args)
             full_command.extend(command)
             timeout = 300  # default is running for 5 mins
             if args.get("timeout"):
                 timeout = args["timeout"]
             # run the bpftrace command
-            res = run_command_with_timeout(full_command, int(timeout))
+            res = run_command_with_timeout(full_command, int(timeout), on_line, policy)
             if args.get("continue") and res["stderr"] == "":
                 # continue conversation
                 res["stderr"] = "The conversation shall not complete."
@@ -239,6 +370,12 @@ def run_bpftrace(prompt: str, verbose: bool = False) -> CommandResult:
                 "returncode": 0
             }
             return res
+        return {
+            "command": response_message["function_call"]["name"],
+            "stdout": "",
+            "stderr": "Unknown function: " + response_message["function_call"]["name"],
+            "returncode": 1
+        }
     else:
         # not function call
         return {
@@ -249,6 +386,21 @@ def run_bpftrace(prompt: str, verbose: bool = False) -> CommandResult:
         }
 
 
+def run_bpftrace(prompt: str, verbose: bool = False) -> CommandResult:
+    """
+    This function sends a list of messages and functions to the GPT model
+    and runs the function call returned by the model.
+
+    :param prompt: The prompt to send.
+    :param verbose: Whether to print the model's response.
+    :return: The result of the function call, with the token usage of the model call.
+    """
+    response_message, usage = request_function_call(prompt, verbose)
+    res = run_function_call(response_message)
+    res["usage"] = usage
+    return res
+
+
 class TestRunBpftrace(unittest.TestCase):
     def test_summary(self):
         res = run_bpftrace("tracing with Count page faults by process for 3s")
@@ -299,3 +451,11 @@ class TestRunBpftrace(unittest.TestCase):
         self.assert_(result["stdout"] != "")
         self.assertEqual(result["command"], "ls -l")
         self.assertEqual(result["returncode"], 0)
+
+    def test_non_interactive_sudo_failure(self):
+        command = ["sh", "-c", "echo 'sudo: a password is required' >&2; exit 1"]
+        policy = RunPolicy(lambda command, timeout: True, echo=False, non_interactive=True)
+        with self.assertRaises(CredentialsRequired):
+            run_command_with_timeout(command, 5, policy=policy)
+        result = run_command_with_timeout(command, 5, policy=RunPolicy(lambda command, timeout: True, echo=False))
+        self.assertEqual(result["returncode"], 1)
@@ -0,0 +1,235 @@
+import codecs
+import os
+import selectors
+import signal
+import subprocess
+import sys
+import time
+import unittest
+from collections import deque
+from typing import TYPE_CHECKING, Callable, Optional, TextIO, Tuple
+from unittest import mock
+
+if TYPE_CHECKING:
+    from gpttrace.watchdog import Watchdog
+
+# How much of each stream is kept for the model, the most recent text wins.
+STDOUT_LIMIT = 1 << 20
+STDERR_LIMIT = 64 << 10
+# How long a timed out process has to exit after SIGINT, e.g. for bpftrace to print its maps, before SIGKILL.
+INTERRUPT_GRACE = 5.0
+# How long to keep draining the pipes after the process was killed.
+DRAIN_GRACE = 2.0
+READ_SIZE = 1 << 16
+
+LineCallback = Callable[[str, str], None]
+
+
+def fan_out(*callbacks: LineCallback) -> LineCallback:
+    """
+    Combines several line callbacks into one.
+
+    :param callbacks: The callbacks to call, in order, for every line.
+    :return: The combined callback.
+    """
+    def on_line(stream: str, line: str) -> None:
+        for callback in callbacks:
+            callback(stream, line)
+    return on_line
+
+
+class RingBuffer:
+    """
+    Keeps the most recent lines of a stream, up to a limit in characters.
+    """
+    def __init__(self, limit: int):
+        """
+        Initializes a RingBuffer object.
+
+        :param limit: The maximum number of characters to keep.
+        """
+        self.limit = limit
+        self.lines = deque()
+        self.size = 0
+        self.dropped = 0
+
+    def append(self, line: str) -> None:
+        """
+        Adds a line, dropping the oldest lines if the buffer is full.
+
+        :param line: The line to add, including its newline if any.
+        """
+        self.lines.append(line)
+        self.size += len(line)
+        while self.size > self.limit and len(self.lines) > 1:
+            self.size -= len(self.lines.popleft())
+            self.dropped += 1
+
+    def getvalue(self) -> str:
+        """
+        :return: The buffered text.
+        """
+        return "".join(self.lines)
+
+
+class _LineSplitter:
+    """
+    Decodes the bytes of one pipe and splits them into lines.
+    """
+    def __init__(self, name: str, buffer: RingBuffer, echo: Optional[TextIO],
+                 on_line: Optional[LineCallback]):
+        self.name = name
+        self.buffer = buffer
+        self.echo = echo
+        self.on_line = on_line
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self.partial = ""
+
+    def feed(self, data: bytes, final: bool = False) -> None:
+        text = self.partial + self.decoder.decode(data, final)
+        lines = text.split("\n")
+        self.partial = "" if final else lines.pop()
+        for i, line in enumerate(lines):
+            if final and i == len(lines) - 1:
+                if line == "":
+                    break
+                self._emit(line)
+            else:
+                self._emit(line + "\n")
+
+    def _emit(self, line: str) -> None:
+        self.buffer.append(line)
+        if self.echo is not None:
+            self.echo.write(line)
+            self.echo.flush()
+        if self.on_line is not None:
+            self.on_line(self.name, line)
+
+
+def capture_output(process: subprocess.Popen, timeout: float,
+                   on_line: Optional[LineCallback] = None,
+                   echo: bool = True, watchdog: Optional["Watchdog"] = None) -> Tuple[str, str, bool]:
+    """
+    Streams the stdout and stderr of a process until it exits or times out.
+
+    Both pipes are read as data arrives, so a chatty stderr cannot fill its
+    pipe and block the process, and nothing runs while the process is idle.
+
+    :param process: A process started with binary `stdout=PIPE` and `stderr=PIPE`.
+    :param timeout: Seconds after which the process gets SIGINT, and SIGKILL if it has not exited
+        `INTERRUPT_GRACE` seconds later.
+    :param on_line: Called with the stream name ("stdout" or "stderr") and each line.
+    :param echo: Whether to print the lines to the terminal as they arrive.
+    :param watchdog: Sampled between reads; it stops the process if it goes over its resource budget.
+    :return: The tail of stdout, the tail of stderr, and whether the process timed out.
+    """
+    stdout = RingBuffer(STDOUT_LIMIT)
+    stderr = RingBuffer(STDERR_LIMIT)
+    splitters = {}
+    selector = selectors.DefaultSelector()
+    for name, pipe, buffer, stream in (("stdout", process.stdout, stdout, sys.stdout),
+                                       ("stderr", process.stderr, stderr, sys.stderr)):
+        splitter = _LineSplitter(name, buffer, stream if echo else None, on_line)
+        selector.register(pipe, selectors.EVENT_READ, splitter)
+        splitters[name] = splitter
+
+    deadline = time.monotonic() + timeout
+    timed_out = killed = False
+    with selector:
+        while selector.get_map():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                if killed:
+                    # The pipes are still held open, e.g. by a child of the process.
+                    break
+                if timed_out:
+                    killed = True
+                    process.kill()
+                    deadline = time.monotonic() + DRAIN_GRACE
+                    continue
+                timed_out = True
+                # Like Ctrl-C: bpftrace runs its END probes and prints its maps before it exits.
+                if process.poll() is None:
+                    try:
+                        process.send_signal(signal.SIGINT)
+                    except ProcessLookupError:
+                        pass
+                deadline = time.monotonic() + INTERRUPT_GRACE
+                continue
+            if watchdog is not None:
+                remaining = min(remaining, watchdog.timeout(time.monotonic()))
+            for key, _ in selector.select(timeout=remaining):
+                data = os.read(key.fd, READ_SIZE)
+                if data:
+                    key.data.feed(data)
+                    if watchdog is not None:
+                        watchdog.add_output(len(data))
+                else:
+                    key.data.feed(b"", final=True)
+                    selector.unregister(key.fileobj)
+            if watchdog is not None:
+                watchdog.check(time.monotonic())
+    for splitter in splitters.values():
+        if splitter.partial:
+            splitter.feed(b"", final=True)
+    if watchdog is not None:
+        watchdog.sample(time.monotonic())
+    return stdout.getvalue(), stderr.getvalue(), timed_out
+
+
+def _run(code: str, timeout: float, on_line: Optional[LineCallback] = None) -> Tuple[str, str, bool]:
+    with subprocess.Popen([sys.executable, "-c", code], stdout=subprocess.PIPE,
+                          stderr=subprocess.PIPE) as process:
+        result = capture_output(process, timeout, on_line, echo=False)
+        process.wait()
+    return result
+
+
+class TestCaptureOutput(unittest.TestCase):
+    def test_lines_and_partial_line(self):
+        lines = []
+        stdout, stderr, timed_out = _run(
+            "import sys; print('a'); print('b', file=sys.stderr); sys.stdout.write('c')",
+            5, lambda name, line: lines.append((name, line)))
+        self.assertEqual(stdout, "a\nc")
+        self.assertEqual(stderr, "b\n")
+        self.assertFalse(timed_out)
+        self.assertIn(("stdout", "c"), lines)
+
+    def test_large_stderr_does_not_block(self):
+        stdout, stderr, timed_out = _run(
+            "import sys; sys.stderr.write('x' * 99 + '\\n') or None\n"
+            "for _ in range(100000): sys.stderr.write('e' * 99 + '\\n')\n"
+            "print('done')", 30)
+        self.assertFalse(timed_out)
+        self.assertEqual(stdout, "done\n")
+        self.assertLessEqual(len(stderr), STDERR_LIMIT)
+        self.assertTrue(stderr.endswith("e" * 99 + "\n"))
+
+    def test_timeout(self):
+        start = time.monotonic()
+        stdout, _, timed_out = _run("import time\n"
+                                    "try:\n"
+                                    "    time.sleep(30)\n"
+                                    "except KeyboardInterrupt:\n"
+                                    "    print('@maps: 1')\n", 0.5)
+        self.assertTrue(timed_out)
+        self.assertEqual(stdout, "@maps: 1\n")
+        self.assertLess(time.monotonic() - start, 5)
+
+    def test_timeout_escalates_to_sigkill(self):
+        start = time.monotonic()
+        with mock.patch(f"{__name__}.INTERRUPT_GRACE", 0.5):
+            _, _, timed_out = _run("import signal, time\n"
+                                   "signal.signal(signal.SIGINT, signal.SIG_IGN)\n"
+                                   "print('start', flush=True)\n"
+                                   "time.sleep(30)\n", 0.5)
+        self.assertTrue(timed_out)
+        self.assertLess(time.monotonic() - start, 5)
+
+    def test_ring_buffer(self):
+        buffer = RingBuffer(10)
+        for line in ["aaaa\n", "bbbb\n", "cccc\n"]:
+            buffer.append(line)
+        self.assertEqual(buffer.getvalue(), "bbbb\ncccc\n")
+        self.assertEqual(buffer.dropped, 1)
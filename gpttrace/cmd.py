@@ -1,12 +1,17 @@
 import subprocess
-import openai
 import json
+import re
+from pathlib import Path
+from typing import List, Optional
 
-from langchain.chains.conversation.memory import ConversationBufferMemory
-from langchain.chat_models import ChatOpenAI
-from langchain.chains import ConversationChain
 from gpttrace.prompt import func_call_prompt
+from gpttrace import llm
 from gpttrace.config import cfg
+from gpttrace.schema_registry import SchemaRegistry
+from gpttrace.tool_router import ToolRouter
+
+_schema_registry = None
+_tool_router = None
 
 def cmd(cmd_name: str, query: str, verbose=False) -> None:
     """
@@ -16,28 +21,49 @@ def cmd(cmd_name: str, query: str, verbose=False) -> None:
     :param query: The task that the user wants to accomplish with `cmd`.
     :param verbose: Whether to print extra information.
     """
-    func_call = None
-    functions = get_predifine_funcs()
-    for func in functions:
-        # Gets the predefined function call
-        if func["name"] == cmd_name:
-            func_call = func
-            break
+    registry = get_schema_registry()
+    func_call = registry.get(cmd_name)
     if func_call is None:
-        # Generate a function call based on a given command
-        func_call = gen_func_call(cmd_name, verbose)
+        # Generate a function call based on a given command and keep it for next time
+        help_doc = get_command_help(cmd_name)
+        func_call = parse_func_call(gen_func_call(cmd_name, verbose, help_doc))
+        registry.put_generated(cmd_name, func_call, help_doc)
+    call_bcc_tools(query, [func_call])
+
+
+def route_cmd(query: str, verbose=False) -> None:
+    """
+    Pick the bcc tools that match the query, let the model choose one and execute it.
+
+    :param query: The task that the user wants to accomplish.
+    :param verbose: Whether to print extra information.
+    """
+    names = get_tool_router().route(query, int(cfg.get("TOOL_ROUTER_TOP_K")))
+    if verbose:
+        print("Candidate bcc tools: " + ", ".join(names))
+    registry = get_schema_registry()
+    call_bcc_tools(query, [registry.get(name) for name in names])
+
+
+def call_bcc_tools(query: str, func_calls: List[dict]) -> None:
+    """
+    Offer the function calls of some bcc tools to the model and execute the one it calls.
+
+    :param query: The task that the user wants to accomplish.
+    :param func_calls: The function call schemas of the candidate tools.
+    """
     messages = [{"role": "user", "content": query}]
-    response = openai.ChatCompletion.create(
-        model=cfg.get("DEFAULT_MODEL"),
-        messages=messages,
-        functions=[func_call],
+    response = llm.chat(
+        messages,
+        cfg.get("DEFAULT_MODEL"),
+        functions=func_calls,
         function_call="auto",
     )
     response_message = response["choices"][0]["message"]
     if response_message.get("function_call"):
         cmd_name = response_message["function_call"]["name"]
         args = json.loads(response_message["function_call"]["arguments"])
-        func_descript = get_specify_func(functions, cmd_name)
+        func_descript = get_schema_registry().get(cmd_name)
         exec_cmd(cmd_name, args, func_descript)
     else:
         print("LLM does not call any bcc tools.")
@@ -77,34 +103,58 @@ def exec_cmd(cmd_name: str, args: str, func_descript: json) -> None:
         print("\u001b[1;31m\bFailed to execute command!\u001b[0m")
         print(err)
 
-def get_predifine_funcs() -> str:
+def get_schema_registry() -> SchemaRegistry:
     """
-    Gets the JSON format description information of the predefined function call.
+    Gets the registry of bcc tool function calls, loading it once per process.
 
-    :return: List of JSON-formatted function calls.
+    :return: The schema registry.
     """
-    func_path = cfg.get("BCC_FUNC_CALL_PATH")
-    with open(func_path, 'r', encoding='utf-8') as file:
-        data = file.read()
-    functions = json.loads(data)
-    return functions
+    global _schema_registry
+    if _schema_registry is None:
+        _schema_registry = SchemaRegistry(Path(cfg.get("BCC_FUNC_CALL_PATH")),
+                                          Path(cfg.get("GENERATED_FUNC_CALL_PATH")),
+                                          get_command_help)
+    return _schema_registry
 
-def gen_func_call(cmd_name: str, verbose: bool) -> str:
+def get_tool_router() -> ToolRouter:
+    """
+    Gets the router that ranks bcc tools for a query, loading it once per process.
+
+    :return: The tool router.
+    """
+    global _tool_router
+    if _tool_router is None:
+        _tool_router = ToolRouter(get_schema_registry(), Path(cfg.get("TOOL_ROUTER_PATH")))
+    return _tool_router
+
+def parse_func_call(response: str) -> dict:
+    """
+    Parses a function call generated by the model.
+
+    :param response: The model's answer, a JSON object optionally inside a ```json block.
+    :return: The function call.
+    """
+    match = re.search(r"```(?:json)?\s*(.*?)```", response, re.DOTALL)
+    if match:
+        response = match.group(1)
+    return json.loads(response)
+
+def gen_func_call(cmd_name: str, verbose: bool, help_doc: Optional[str] = None) -> str:
     """
     Generates a funciton call for the given command.
 
     :param cmd_name: Name of command.
     :verbose: Whether to print extra information.
+    :param help_doc: Help documentation for the command, fetched if not given.
     :return: The function call in JSON format corresponding to the command.
     """
-    model_name = cfg.get("DEFAULT_MODEL")
-    llm = ChatOpenAI(model=model_name,temperature=0)
-    agent_chain = ConversationChain(llm=llm, verbose=verbose,
-                    memory=ConversationBufferMemory())
-    help_doc = get_command_help(cmd_name)
+    if help_doc is None:
+        help_doc = get_command_help(cmd_name)
     prompt = func_call_prompt(cmd_name, help_doc)
-    response = agent_chain.predict(input=prompt)
-    return response
+    if verbose:
+        print("Prompt: " + prompt)
+    response = llm.chat([{"role": "user", "content": prompt}], cfg.get("DEFAULT_MODEL"), temperature=0)
+    return response["choices"][0]["message"]["content"]
 
 def get_command_help(command) -> str:
     """
@@ -119,19 +169,6 @@ def get_command_help(command) -> str:
     except subprocess.CalledProcessError as err:
         return f"Error executing help command: {err.output}"
 
-def get_specify_func(functions, cmd_name) -> json:
-    """
-    Gets the JSON format description of the function call for the specified command.
-
-    :param functions: A predefined list of function calls.
-    :param cmd_name: A specific command.
-    :return func: The function call corresponding to cmd.
-    """
-    for func in functions:
-        if func.get('name') == cmd_name:
-            return func
-    return None
-
 
 def is_positional_arg(cmd_name, arg) -> bool:
     """
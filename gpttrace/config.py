@@ -14,17 +14,95 @@ OPENAI_API_KEY = "OPENAI_API_KEY"
 PROJECT_ROOT_PATH = Path(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 DOC_PATH = PROJECT_ROOT_PATH / "bpf_tutorial"/ "src"
 DATA_SAVE_PATH = PROJECT_ROOT_PATH / "data_save"
-VECTOR_DATABASE_PATH = DATA_SAVE_PATH / "vector_database"
 BCC_FUNC_CALL_PATH = DATA_SAVE_PATH / "funcs.json"
+GENERATED_FUNC_CALL_PATH = DATA_SAVE_PATH / "generated_funcs.json"
+TOOLS_PATH = PROJECT_ROOT_PATH / "tools"
+EXAMPLE_INDEX_PATH = DATA_SAVE_PATH / "example_index"
+PROGRAM_CACHE_PATH = DATA_SAVE_PATH / "program_cache.json"
+TOOL_ROUTER_PATH = DATA_SAVE_PATH / "tool_router.npz"
+PROBE_CATALOG_PATH = DATA_SAVE_PATH / "probe_catalog"
+# Per user, not per checkout, like the other settings that decide what may run.
+APPROVED_PROGRAMS_PATH = GPT_TRACE_CONFIG_FOLDER / "approved_programs.json"
+MODEL_STATS_PATH = DATA_SAVE_PATH / "model_stats.json"
+DOC_INDEX_PATH = DATA_SAVE_PATH / "doc_index"
+# Holds the output of every trace, so it is per user like the approvals.
+HISTORY_PATH = GPT_TRACE_CONFIG_FOLDER / "history.sqlite3"
 MODEL_NAME = "gpt-3.5-turbo-0613"
 
 DEFAULT_CONFIG = {
     "DEFAULT_MODEL": os.getenv("DEFAULT_MODEL", "gpt-3.5-turbo"),
     "OPENAI_API_KEY": os.getenv("OPENAI_API_KEY", "OPENAI_API_KEY"),
+    "OPENAI_API_BASE": os.getenv("OPENAI_API_BASE", "https://api.openai.com/v1"),
+    # Models per task: writing programs, explaining their output, and other providers via litellm.
+    "GENERATION_MODEL": os.getenv("GENERATION_MODEL", "gpt-3.5-turbo"),
+    "EXPLAIN_MODEL": os.getenv("EXPLAIN_MODEL", "gpt-3.5-turbo-0613"),
+    # Writes the programs once GENERATION_MODEL failed ESCALATE_AFTER times or returned unparsable arguments.
+    "STRONG_MODEL": os.getenv("STRONG_MODEL", "gpt-4"),
+    "ESCALATE_AFTER": os.getenv("ESCALATE_AFTER", "2"),
+    # Latency, success rate and token spend of each model tier.
+    "MODEL_STATS_PATH": os.getenv("MODEL_STATS_PATH", MODEL_STATS_PATH),
+    "LITELLM_MODEL": os.getenv("LITELLM_MODEL", "claude-instant-1"),
+    # "0" waits for the whole explanation instead of printing it as it streams in.
+    "STREAM_EXPLAIN": os.getenv("STREAM_EXPLAIN", "1"),
+    # Seconds a model call may take, retries included.
+    "LLM_TIMEOUT": os.getenv("LLM_TIMEOUT", "120"),
+    "LLM_MAX_RETRIES": os.getenv("LLM_MAX_RETRIES", "5"),
+    # Model calls in flight at once.
+    "LLM_CONCURRENCY": os.getenv("LLM_CONCURRENCY", "8"),
     "DATA_SAVE_PATH": os.getenv("DATA_SAVE_PATH", DATA_SAVE_PATH),
-    "VECTOR_DATABASE_PATH": os.getenv("VECTOR_DATABASE_PATH", VECTOR_DATABASE_PATH),
     "BCC_FUNC_CALL_PATH": os.getenv("BCC_FUNC_CALL_PATH", BCC_FUNC_CALL_PATH),
+    "GENERATED_FUNC_CALL_PATH": os.getenv("GENERATED_FUNC_CALL_PATH", GENERATED_FUNC_CALL_PATH),
     "DOC_PATH": os.getenv("DOC_PATH", DOC_PATH),
+    "DOC_INDEX_PATH": os.getenv("DOC_INDEX_PATH", DOC_INDEX_PATH),
+    # Number of document chunks added to a query.
+    "DOC_TOP_K": os.getenv("DOC_TOP_K", "3"),
+    "TOOLS_PATH": os.getenv("TOOLS_PATH", TOOLS_PATH),
+    "EXAMPLE_INDEX_PATH": os.getenv("EXAMPLE_INDEX_PATH", EXAMPLE_INDEX_PATH),
+    # One of "vector", "bm25" or "hybrid".
+    "EXAMPLE_RETRIEVER": os.getenv("EXAMPLE_RETRIEVER", "vector"),
+    # "tiktoken" counts prompt tokens exactly; anything else, or tiktoken missing, estimates them.
+    "TOKENIZER": os.getenv("TOKENIZER", "tiktoken"),
+    # Tokens of the context window left for the completion and the function definitions.
+    "COMPLETION_TOKEN_RESERVE": os.getenv("COMPLETION_TOKEN_RESERVE", "1024"),
+    # Most tokens a prompt may use whatever the context window, to cap the cost of a request.
+    "PROMPT_TOKEN_CEILING": os.getenv("PROMPT_TOKEN_CEILING", "6000"),
+    # Token budget of the output summary sent with the explain prompt.
+    "EXPLAIN_TOKEN_BUDGET": os.getenv("EXPLAIN_TOKEN_BUDGET", "1024"),
+    "PROGRAM_CACHE_PATH": os.getenv("PROGRAM_CACHE_PATH", PROGRAM_CACHE_PATH),
+    "PROGRAM_CACHE_SIZE": os.getenv("PROGRAM_CACHE_SIZE", "256"),
+    # Seconds a cached program stays valid.
+    "PROGRAM_CACHE_TTL": os.getenv("PROGRAM_CACHE_TTL", str(7 * 24 * 3600)),
+    "TOOL_ROUTER_PATH": os.getenv("TOOL_ROUTER_PATH", TOOL_ROUTER_PATH),
+    # Number of bcc tool schemas sent to the model when the tool is not given.
+    "TOOL_ROUTER_TOP_K": os.getenv("TOOL_ROUTER_TOP_K", "3"),
+    "PROBE_CATALOG_PATH": os.getenv("PROBE_CATALOG_PATH", PROBE_CATALOG_PATH),
+    # Number of kernel probes matching the request that are listed in the prompt.
+    "PROBE_PROMPT_LIMIT": os.getenv("PROBE_PROMPT_LIMIT", "20"),
+    # How bpftrace is run, e.g. "sudo bpftrace" or the path of a stand-in for benchmarks.
+    "BPFTRACE_COMMAND": os.getenv("BPFTRACE_COMMAND", "sudo bpftrace"),
+    # Resource budget of a bpftrace command and its children, "0" for no limit. Over budget for
+    # WATCHDOG_SUSTAIN samples in a row, it gets SIGINT, and SIGKILL WATCHDOG_KILL_AFTER seconds later.
+    "WATCHDOG_MAX_CPU_PERCENT": os.getenv("WATCHDOG_MAX_CPU_PERCENT", "50"),
+    "WATCHDOG_MAX_RSS_MB": os.getenv("WATCHDOG_MAX_RSS_MB", "1024"),
+    "WATCHDOG_MAX_OUTPUT_MBPS": os.getenv("WATCHDOG_MAX_OUTPUT_MBPS", "8"),
+    # Seconds between samples of /proc.
+    "WATCHDOG_INTERVAL": os.getenv("WATCHDOG_INTERVAL", "0.5"),
+    "WATCHDOG_SUSTAIN": os.getenv("WATCHDOG_SUSTAIN", "3"),
+    "WATCHDOG_KILL_AFTER": os.getenv("WATCHDOG_KILL_AFTER", "5"),
+    # Seconds after the start, while bpftrace compiles the program, before the budget applies.
+    "WATCHDOG_GRACE": os.getenv("WATCHDOG_GRACE", "3"),
+    # Programs that print on every event of a hot probe: "warn" only, "rewrite" them into map
+    # aggregations or sampled output, or "off".
+    "OVERHEAD_MODE": os.getenv("OVERHEAD_MODE", "warn"),
+    # Hashes of the programs approved at the terminal, which batch runs may run unattended.
+    "APPROVED_PROGRAMS_PATH": os.getenv("APPROVED_PROGRAMS_PATH", APPROVED_PROGRAMS_PATH),
+    # Comma separated probe types batch runs may attach to without approval.
+    "BATCH_ALLOWED_PROBES": os.getenv("BATCH_ALLOWED_PROBES", "tracepoint,profile,interval"),
+    # Seconds a batch job's bpftrace command may run.
+    "BATCH_MAX_TIMEOUT": os.getenv("BATCH_MAX_TIMEOUT", "60"),
+    # Every request with its program, output, timings and tokens; "0" keeps no history.
+    "HISTORY_PATH": os.getenv("HISTORY_PATH", HISTORY_PATH),
+    "RECORD_HISTORY": os.getenv("RECORD_HISTORY", "1"),
     "MODEL_NAME": os.getenv("MODEL_NAME", MODEL_NAME)
 }
 
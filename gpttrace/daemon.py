@@ -0,0 +1,387 @@
+import io
+import json
+import os
+import signal
+import socket
+import socketserver
+import stat
+import struct
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from pathlib import Path
+from typing import Any, BinaryIO, Callable, Dict, List, Optional
+from unittest import mock
+
+# Only the standard library is imported at the top, so the client stays fast;
+# the server imports the backends when it starts.
+
+_output = threading.local()
+
+
+def socket_path() -> Path:
+    """
+    :return: The path of the daemon socket: `GPTTRACE_SOCKET`, or a per-user path.
+    """
+    if os.getenv("GPTTRACE_SOCKET"):
+        return Path(os.environ["GPTTRACE_SOCKET"])
+    if os.getenv("XDG_RUNTIME_DIR"):
+        return Path(os.environ["XDG_RUNTIME_DIR"]) / "gpttrace.sock"
+    return Path(tempfile.gettempdir()) / f"gpttrace-{os.getuid()}" / "daemon.sock"
+
+
+def send_message(file: BinaryIO, message: Dict[str, Any]) -> None:
+    """
+    Writes one message of the daemon protocol: a JSON object on its own line.
+    """
+    file.write(json.dumps(message).encode("utf-8") + b"\n")
+    file.flush()
+
+
+def read_message(file: BinaryIO) -> Optional[Dict[str, Any]]:
+    """
+    :return: The next message of the daemon protocol, or None if the peer closed the connection.
+    """
+    line = file.readline()
+    return json.loads(line) if line else None
+
+
+class _RoutedOutput(io.TextIOBase):
+    """
+    Stands in for `sys.stdout` in the daemon, sending each request thread's output to its client.
+    """
+    def __init__(self, fallback: Any):
+        self.fallback = fallback
+
+    def write(self, text: str) -> int:
+        channel = getattr(_output, "channel", None)
+        if channel is None:
+            return self.fallback.write(text)
+        channel.send({"type": "output", "data": text})
+        return len(text)
+
+    def flush(self) -> None:
+        if getattr(_output, "channel", None) is None:
+            self.fallback.flush()
+
+    def isatty(self) -> bool:
+        # Clients get plain text; highlighting would need the client's terminal.
+        return False
+
+
+class _Channel:
+    """
+    The connection of one request, shared by its output and its confirmations.
+    """
+    def __init__(self, rfile: BinaryIO, wfile: BinaryIO):
+        self.rfile = rfile
+        self.wfile = wfile
+        self.lock = threading.Lock()
+
+    def send(self, message: Dict[str, Any]) -> None:
+        with self.lock:
+            send_message(self.wfile, message)
+
+    def confirm(self, command: List[str], timeout: int) -> bool:
+        """
+        A `RunPolicy` confirm callback that asks at the client's terminal.
+        """
+        from gpttrace.approval import command_program, record_approved_program
+
+        self.send({"type": "confirm", "command": command, "timeout": timeout})
+        reply = read_message(self.rfile)
+        if reply is None or not reply.get("ok"):
+            return False
+        program = command_program(command)
+        if program is not None:
+            record_approved_program(program)
+        return True
+
+
+def peer_uid(connection: socket.socket) -> Optional[int]:
+    """
+    :param connection: A connected Unix socket.
+    :return: The user id of the peer, or None where `SO_PEERCRED` is not supported.
+    """
+    if not hasattr(socket, "SO_PEERCRED"):
+        return None
+    credentials = connection.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i"))
+    _, uid, _ = struct.unpack("3i", credentials)
+    return uid
+
+
+class DaemonHandler(socketserver.StreamRequestHandler):
+    """
+    Serves one client request: `{"type": "execute", "input": ..., "options": {...}}`.
+
+    The output of the request is sent back as `output` messages, a command
+    waiting for confirmation as a `confirm` message the client answers, and
+    the end as a `done` message with the status.
+    """
+    def handle(self) -> None:
+        uid = peer_uid(self.request)
+        if uid is not None and uid != os.getuid():
+            send_message(self.wfile, {"type": "done", "status": "error", "message": "permission denied"})
+            return
+        request = read_message(self.rfile)
+        if request is None:
+            return
+        channel = _Channel(self.rfile, self.wfile)
+        _output.channel = channel
+        try:
+            status = self.server.dispatch(request, channel)
+            message = ""
+        except Exception as err:
+            status, message = "error", f"{type(err).__name__}: {err}"
+        finally:
+            _output.channel = None
+        try:
+            channel.send({"type": "done", "status": status, "message": message})
+        except OSError:
+            # The client went away.
+            pass
+
+
+class Daemon(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Keeps the backends loaded and runs client requests, each in its own thread.
+    """
+    daemon_threads = True
+
+    def __init__(self, path: Path, execute: Callable[..., dict]):
+        """
+        Initializes a Daemon object listening on a socket only its user can connect to.
+
+        :param path: The path of the socket.
+        :param execute: Runs a request, `gpttrace.execute.execute`.
+        """
+        self.path = Path(path)
+        self.execute = execute
+        self.path.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+        _check_private_directory(self.path.parent)
+        if self.path.exists():
+            if _connectable(self.path):
+                raise RuntimeError(f"A daemon is already listening on {self.path}")
+            # Left behind by a daemon that did not exit cleanly.
+            self.path.unlink()
+        old_umask = os.umask(0o177)
+        try:
+            super().__init__(str(self.path), DaemonHandler)
+        finally:
+            os.umask(old_umask)
+        os.chmod(self.path, stat.S_IRUSR | stat.S_IWUSR)
+
+    def dispatch(self, request: Dict[str, Any], channel: _Channel) -> str:
+        """
+        :param request: The request of a client.
+        :param channel: The connection of the request.
+        :return: The status of the request: "ok", "failed", "rejected" or "error".
+        """
+        from gpttrace.approval import CommandRejected, CredentialsRequired
+        from gpttrace.bpftrace import RunPolicy
+
+        if request.get("type") != "execute":
+            raise ValueError(f"unknown request type: {request.get('type')}")
+        options = request.get("options", {})
+        try:
+            outcome = self.execute(request["input"], options.get("verbose", False),
+                                   json_output=options.get("json", False),
+                                   use_cache=options.get("use_cache", True),
+                                   candidates=options.get("candidates", 1),
+                                   # Nobody can type a sudo password at the daemon.
+                                   policy=RunPolicy(channel.confirm, non_interactive=True))
+        except CredentialsRequired as err:
+            print(f"The daemon cannot run bpftrace: {err}\n"
+                  "Allow your user to run bpftrace with sudo without a password, "
+                  "or run the request here with --no-daemon.")
+            return "error"
+        except CommandRejected:
+            print("Aborting...")
+            return "rejected"
+        return "ok" if outcome["explanation"] is not None else "failed"
+
+    def server_close(self) -> None:
+        super().server_close()
+        if self.path.exists():
+            self.path.unlink()
+
+
+def _check_private_directory(path: Path) -> None:
+    """
+    :param path: The directory of the socket.
+    :raises RuntimeError: If the directory is a symlink, or another user owns it or may enter it,
+        since they could then replace the socket.
+    """
+    info = os.lstat(path)
+    if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() or stat.S_IMODE(info.st_mode) & 0o077:
+        raise RuntimeError(f"{path} must be a directory owned by you with mode 0700 to hold the daemon socket")
+
+
+def _connectable(path: Path) -> bool:
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(str(path))
+            return True
+        except OSError:
+            return False
+
+
+def warm_up() -> None:
+    """
+    Loads what the first request would otherwise load: the backends, the
+    indexes, the probe catalog, the tokenizer and the model client.
+    """
+    from gpttrace import llm
+    from gpttrace.config import cfg
+    from gpttrace.examples import get_bm25_index, get_example_index
+    from gpttrace.probe_catalog import get_probe_catalog
+    from gpttrace.tokens import get_encoding
+
+    retriever = cfg.get("EXAMPLE_RETRIEVER")
+    steps = [("model client", llm.get_client), ("probe catalog", get_probe_catalog),
+             ("tokenizer", lambda: get_encoding(cfg.get("GENERATION_MODEL")))]
+    if retriever in ("bm25", "hybrid"):
+        steps.append(("bm25 index", get_bm25_index))
+    if retriever in ("vector", "hybrid"):
+        steps.append(("example index", get_example_index))
+    for name, load in steps:
+        start = time.perf_counter()
+        try:
+            load()
+        except Exception as err:
+            print(f"Could not load the {name}: {err}")
+            continue
+        print(f"Loaded the {name} in {(time.perf_counter() - start) * 1000:.0f} ms")
+
+
+def serve(path: Optional[Path] = None) -> None:
+    """
+    Runs the daemon until it is interrupted.
+
+    :param path: The path of the socket, defaults to `socket_path()`.
+    """
+    from gpttrace.execute import execute
+
+    warm_up()
+    sys.stdout = _RoutedOutput(sys.stdout)
+    server = Daemon(path or socket_path(), execute)
+    print(f"Listening on {server.path}")
+    # Stopped by a service manager: remove the socket too.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def run_client(user_input: str, options: Dict[str, Any], path: Optional[Path] = None) -> Optional[str]:
+    """
+    Runs a request on the daemon, printing its output and asking for confirmation here.
+
+    :param user_input: The user's request.
+    :param options: The options of `execute`: verbose, json, use_cache and candidates.
+    :param path: The path of the socket, defaults to `socket_path()`.
+    :return: The status of the request, or None if no daemon of this user is listening.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(str(path or socket_path()))
+    except OSError:
+        sock.close()
+        return None
+    uid = peer_uid(sock)
+    if uid is not None and uid != os.getuid():
+        # Whoever listens there would see the request and choose what to run.
+        sock.close()
+        print(f"Ignoring the daemon socket {path or socket_path()}: it is served by user {uid}.")
+        return None
+    with sock, sock.makefile("rb") as rfile, sock.makefile("wb") as wfile:
+        send_message(wfile, {"type": "execute", "input": user_input, "options": options})
+        while True:
+            message = read_message(rfile)
+            if message is None:
+                print("The daemon closed the connection.")
+                return "error"
+            if message["type"] == "output":
+                sys.stdout.write(message["data"])
+                sys.stdout.flush()
+            elif message["type"] == "confirm":
+                print("The bpf program to run is: " + ' '.join(message["command"]))
+                print("timeout: " + str(message["timeout"]))
+                user_answer = input("Enter 'y' to proceed: ")
+                send_message(wfile, {"type": "confirm", "ok": user_answer.lower() == 'y'})
+            elif message["type"] == "done":
+                if message.get("message"):
+                    print(message["message"])
+                return message["status"]
+
+
+class TestDaemon(unittest.TestCase):
+    def test_round_trip_with_confirmation(self):
+        from gpttrace.approval import CredentialsRequired
+
+        def fake_execute(user_input, verbose, json_output, use_cache, candidates, policy):
+            print(f"running {user_input}")
+            confirmed = policy.confirm(["sudo", "bpftrace", "-e", "BEGIN { exit(); }"], 5)
+            print("confirmed" if confirmed else "declined")
+            return {"explanation": "done" if confirmed else None}
+
+        with tempfile.TemporaryDirectory() as data_dir:
+            path = Path(data_dir) / "run" / "daemon.sock"
+            server = Daemon(path, fake_execute)
+            thread = threading.Thread(target=server.serve_forever, daemon=True)
+            original = sys.stdout
+            sys.stdout = _RoutedOutput(original)
+            thread.start()
+            try:
+                self.assertEqual(stat.S_IMODE(os.stat(path).st_mode), 0o600)
+                client_output = io.StringIO()
+                with mock.patch("sys.stdout", client_output), \
+                        mock.patch("builtins.input", return_value="y"), \
+                        mock.patch.dict(os.environ, {"APPROVED_PROGRAMS_PATH": str(Path(data_dir) / "ok.json")}):
+                    status = run_client("trace opens", {}, path)
+                self.assertEqual(status, "ok")
+                self.assertIn("running trace opens\n", client_output.getvalue())
+                self.assertIn("The bpf program to run is: sudo bpftrace -e BEGIN { exit(); }",
+                              client_output.getvalue())
+                self.assertIn("confirmed\n", client_output.getvalue())
+                with mock.patch("sys.stdout", io.StringIO()), mock.patch("builtins.input", return_value="n"):
+                    self.assertEqual(run_client("trace opens", {}, path), "failed")
+                server.execute = mock.Mock(side_effect=CredentialsRequired("sudo: a password is required"))
+                client_output = io.StringIO()
+                with mock.patch("sys.stdout", client_output):
+                    self.assertEqual(run_client("trace opens", {}, path), "error")
+                self.assertIn("The daemon cannot run bpftrace: sudo: a password is required",
+                              client_output.getvalue())
+                self.assertTrue(server.execute.call_args.kwargs["policy"].non_interactive)
+            finally:
+                sys.stdout = original
+                server.shutdown()
+                server.server_close()
+            self.assertFalse(path.exists())
+            self.assertIsNone(run_client("trace opens", {}, path))
+
+    def test_socket_owner_checks(self):
+        with tempfile.TemporaryDirectory() as data_dir:
+            shared = Path(data_dir) / "shared"
+            shared.mkdir(mode=0o755)
+            os.chmod(shared, 0o755)
+            with self.assertRaises(RuntimeError):
+                Daemon(shared / "daemon.sock", mock.Mock())
+            path = Path(data_dir) / "run" / "daemon.sock"
+            server = Daemon(path, mock.Mock())
+            thread = threading.Thread(target=server.serve_forever, daemon=True)
+            thread.start()
+            try:
+                with mock.patch("gpttrace.daemon.peer_uid", return_value=os.getuid() + 1), \
+                        mock.patch("sys.stdout", io.StringIO()) as output:
+                    self.assertIsNone(run_client("trace opens", {}, path))
+                self.assertIn("it is served by user", output.getvalue())
+                server.execute.assert_not_called()
+            finally:
+                server.shutdown()
+                server.server_close()
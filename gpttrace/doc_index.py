@@ -0,0 +1,300 @@
+import json
+import os
+import re
+import tempfile
+import unittest
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from gpttrace.example_index import FakeEmbeddings, _write_atomic, document_hash
+
+MANIFEST_NAME = "manifest.json"
+PARTS_DIR = "parts"
+# Version of the part files; a manifest of another version is rebuilt.
+PART_FORMAT = 2
+# Characters per chunk; paragraphs are not split unless they are longer.
+CHUNK_SIZE = 1500
+# Chunks sent to the embedding model per request.
+EMBED_BATCH_SIZE = 64
+HEADING = re.compile(r"#{1,6} ")
+FENCE = re.compile(r"\s*(```|~~~)")
+
+
+def _sections(text: str) -> List[List[Tuple[str, bool]]]:
+    """
+    :param text: A Markdown document.
+    :return: The sections of the document, each split at headings, as its paragraphs and fenced
+        code blocks, with whether each is a code block. Lines in code blocks are never headings.
+    """
+    sections: List[List[Tuple[str, bool]]] = [[]]
+    block: List[str] = []
+    fence: Optional[str] = None
+
+    def end_block(is_fence: bool = False) -> None:
+        if any(line.strip() for line in block):
+            sections[-1].append(("\n".join(block).strip("\n"), is_fence))
+        block.clear()
+
+    for line in text.split("\n"):
+        if fence is not None:
+            block.append(line)
+            if line.strip().startswith(fence) and len(block) > 1:
+                end_block(True)
+                fence = None
+            continue
+        match = FENCE.match(line)
+        if HEADING.match(line):
+            end_block()
+            sections.append([])
+        elif match:
+            end_block()
+            fence = match.group(1)
+        elif not line.strip():
+            end_block()
+            continue
+        block.append(line)
+    # An unterminated code block runs to the end of the document.
+    end_block(fence is not None)
+    return [section for section in sections if section]
+
+
+def chunk_markdown(text: str, size: int = CHUNK_SIZE) -> List[str]:
+    """
+    Splits a Markdown document into chunks at headings and paragraphs.
+
+    Each chunk starts with the heading it belongs to, so it can be
+    understood on its own. A paragraph longer than `size` is cut, but a
+    fenced code block never is: a chunk holding one may be longer.
+
+    :param text: The document.
+    :param size: The maximum number of characters of a chunk, except for code blocks.
+    :return: The chunks, in document order.
+    """
+    chunks = []
+    for blocks in _sections(text):
+        heading = blocks[0][0] if HEADING.match(blocks[0][0]) else ""
+        section = "\n\n".join(block for block, _ in blocks)
+        if len(section) <= size:
+            chunks.append(section)
+            continue
+        chunk = ""
+        for block, is_fence in blocks:
+            if chunk and len(chunk) + len(block) + 2 > size:
+                chunks.append(chunk)
+                chunk = heading if heading and block != heading else ""
+            chunk = f"{chunk}\n\n{block}" if chunk else block
+            while not is_fence and len(chunk) > size:
+                chunks.append(chunk[:size])
+                chunk = chunk[size:]
+        if chunk.strip():
+            chunks.append(chunk)
+    return chunks
+
+
+def load_and_chunk(path: str) -> Tuple[str, List[str]]:
+    """
+    Reads and chunks one document; runs in a worker process.
+
+    :param path: The path of the document.
+    :return: The hash of its content and its chunks.
+    """
+    with open(path, "r", encoding="utf-8", errors="replace") as file:
+        text = file.read()
+    return document_hash(text), chunk_markdown(text)
+
+
+class DocIndex:
+    """
+    An embedding index of a documentation tree, maintained file by file.
+
+    Each file's chunks and vectors are stored as one part named after the
+    file's content hash, and the manifest maps files to parts. A sync only
+    chunks and embeds files whose content changed, and records every part
+    in the manifest as soon as it is written, so an interrupted sync resumes
+    with the files that were not finished.
+    """
+    def __init__(self, index_dir: Path, embeddings: Any):
+        """
+        Initializes a DocIndex object.
+
+        :param index_dir: The directory that holds the manifest and the parts.
+        :param embeddings: An embedding model with `embed_documents` and `embed_query`.
+        """
+        self.index_dir = Path(index_dir)
+        self.embeddings = embeddings
+        self.model = getattr(embeddings, "model", type(embeddings).__name__)
+        self.chunks: List[str] = []
+        self.vectors = np.zeros((0, 0), dtype=np.float32)
+
+    def _load_manifest(self) -> Dict[str, Any]:
+        """
+        :return: The manifest, or an empty one if it is missing or built with another model.
+        """
+        manifest_path = self.index_dir / MANIFEST_NAME
+        if manifest_path.exists():
+            with open(manifest_path, "r", encoding="utf-8") as file:
+                manifest = json.load(file)
+            if manifest.get("model") == self.model and manifest.get("format") == PART_FORMAT:
+                return manifest
+        return {"model": self.model, "format": PART_FORMAT, "files": {}}
+
+    def _save_manifest(self, manifest: Dict[str, Any]) -> None:
+        _write_atomic(self.index_dir / MANIFEST_NAME, json.dumps(manifest).encode("utf-8"))
+
+    def _write_part(self, digest: str, chunks: List[str], vectors: List[List[float]]) -> None:
+        matrix = np.asarray(vectors, dtype=np.float32).reshape(len(chunks), -1)
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        matrix /= np.where(norms == 0, 1, norms)
+        fd, tmp_path = tempfile.mkstemp(dir=self.index_dir / PARTS_DIR, suffix=".npz")
+        with os.fdopen(fd, "wb") as file:
+            # Fixed width strings load without unpickling anything.
+            np.savez(file, vectors=matrix, chunks=np.asarray(chunks, dtype=np.str_))
+        os.replace(tmp_path, self.index_dir / PARTS_DIR / f"{digest}.npz")
+
+    def sync(self, paths: List[Path], root: Path, workers: Optional[int] = None) -> int:
+        """
+        Brings the index in line with the given documents and loads it.
+
+        :param paths: The documents to index.
+        :param root: The directory the manifest paths are relative to.
+        :param workers: The number of processes that read and chunk the documents, 1 to stay in this process.
+        :return: The number of documents that had to be chunked and embedded.
+        """
+        (self.index_dir / PARTS_DIR).mkdir(parents=True, exist_ok=True)
+        manifest = self._load_manifest()
+        names = [str(Path(path).relative_to(root)) for path in paths]
+        # Files that were deleted are dropped first.
+        for name in set(manifest["files"]) - set(names):
+            del manifest["files"][name]
+        # Reading every file is cheap next to embedding it; a changed hash is what matters.
+        if workers == 1 or len(paths) < 2:
+            results = [load_and_chunk(str(path)) for path in paths]
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                results = list(pool.map(load_and_chunk, [str(path) for path in paths], chunksize=16))
+        changed = []
+        for name, (digest, chunks) in zip(names, results):
+            part = self.index_dir / PARTS_DIR / f"{digest}.npz"
+            if manifest["files"].get(name) == digest and part.exists():
+                continue
+            if part.exists():
+                # Same content under another name, or a part whose manifest entry was not saved.
+                manifest["files"][name] = digest
+                self._save_manifest(manifest)
+                continue
+            changed.append((name, digest, chunks))
+
+        # Chunks of several files share a batch; a file's part is written once all its chunks are embedded.
+        batch: List[Tuple[int, str]] = []
+        vectors: Dict[int, List[List[float]]] = {i: [] for i in range(len(changed))}
+
+        def flush() -> None:
+            embedded = self.embeddings.embed_documents([chunk for _, chunk in batch]) if batch else []
+            for (i, _), vector in zip(batch, embedded):
+                vectors[i].append(vector)
+            batch.clear()
+            finished = [i for i in vectors if len(vectors[i]) == len(changed[i][2])]
+            for i in finished:
+                name, digest, chunks = changed[i]
+                if chunks:
+                    self._write_part(digest, chunks, vectors[i])
+                    manifest["files"][name] = digest
+                else:
+                    manifest["files"].pop(name, None)
+                del vectors[i]
+            if finished:
+                self._save_manifest(manifest)
+
+        for i, (_, _, chunks) in enumerate(changed):
+            for chunk in chunks:
+                batch.append((i, chunk))
+                if len(batch) >= EMBED_BATCH_SIZE:
+                    flush()
+        flush()
+        self._save_manifest(manifest)
+        self._remove_unused_parts(manifest)
+        self._load(manifest)
+        return len(changed)
+
+    def _remove_unused_parts(self, manifest: Dict[str, Any]) -> None:
+        used = set(manifest["files"].values())
+        for part in (self.index_dir / PARTS_DIR).glob("*.npz"):
+            if part.stem not in used:
+                part.unlink()
+
+    def _load(self, manifest: Dict[str, Any]) -> None:
+        chunks, matrices = [], []
+        for digest in sorted(set(manifest["files"].values())):
+            with np.load(self.index_dir / PARTS_DIR / f"{digest}.npz") as part:
+                chunks += part["chunks"].tolist()
+                matrices.append(part["vectors"])
+        self.chunks = chunks
+        self.vectors = np.concatenate(matrices) if matrices else np.zeros((0, 0), dtype=np.float32)
+
+    def search(self, query: str, k: int = 3) -> List[str]:
+        """
+        Finds the chunks closest to the query by cosine similarity.
+
+        :param query: The user's request.
+        :param k: The maximum number of chunks to return.
+        :return: The most similar chunks, best first.
+        """
+        if len(self.chunks) == 0 or k <= 0:
+            return []
+        vector = np.asarray(self.embeddings.embed_query(query), dtype=np.float32)
+        scores = self.vectors @ vector
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [self.chunks[i] for i in top]
+
+
+class _CountingEmbeddings(FakeEmbeddings):
+    def __init__(self):
+        super().__init__()
+        self.requests = 0
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        self.requests += 1
+        return super().embed_documents(texts)
+
+
+class TestDocIndex(unittest.TestCase):
+    def test_chunking(self):
+        text = "# Title\n\nintro\n\n## Part\n\n" + "\n\n".join(["word " * 50] * 4)
+        chunks = chunk_markdown(text, size=600)
+        self.assertEqual(chunks[0], "# Title\n\nintro")
+        self.assertTrue(all(chunk.startswith("## Part") for chunk in chunks[1:]))
+        self.assertTrue(all(len(chunk) <= 600 for chunk in chunks))
+
+    def test_chunking_keeps_code_blocks(self):
+        code = "```c\n# include <linux/sched.h>\n\n" + "int x;\n" * 100 + "```"
+        text = "# Title\n\nintro\n\n## Part\n\nbefore\n\n" + code + "\n\nafter"
+        chunks = chunk_markdown(text, size=200)
+        self.assertEqual(chunks, ["# Title\n\nintro", "## Part\n\nbefore", "## Part\n\n" + code,
+                                  "## Part\n\nafter"])
+
+    def test_incremental_sync(self):
+        with tempfile.TemporaryDirectory() as docs_dir, tempfile.TemporaryDirectory() as index_dir:
+            root = Path(docs_dir)
+            for name, body in [("a.md", "# Kprobes\n\nkprobe attach kernel function"),
+                               ("b.md", "# Uprobes\n\nuprobe attach user function"),
+                               ("c.md", "# Maps\n\nmaps store histogram counts")]:
+                (root / name).write_text(body)
+            paths = sorted(root.glob("*.md"))
+            embeddings = _CountingEmbeddings()
+            self.assertEqual(DocIndex(index_dir, embeddings).sync(paths, root, workers=1), 3)
+            # All three files were embedded in one batch.
+            self.assertEqual(embeddings.requests, 1)
+            index = DocIndex(index_dir, embeddings)
+            self.assertEqual(index.sync(paths, root, workers=2), 0)
+            self.assertEqual(index.search("histogram counts maps", k=1), ["# Maps\n\nmaps store histogram counts"])
+            (root / "b.md").write_text("# Uprobes\n\nuprobe attach user space function")
+            (root / "c.md").unlink()
+            index = DocIndex(index_dir, embeddings)
+            self.assertEqual(index.sync(sorted(root.glob("*.md")), root, workers=1), 1)
+            self.assertEqual(len(index.search("anything", k=10)), 2)
+            self.assertEqual(len(list((Path(index_dir) / PARTS_DIR).glob("*.npz"))), 2)
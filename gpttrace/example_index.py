@@ -0,0 +1,181 @@
+import hashlib
+import json
+import os
+import tempfile
+import unittest
+from pathlib import Path
+from typing import Any, Dict, List
+
+import numpy as np
+
+MANIFEST_NAME = "manifest.json"
+VECTORS_NAME = "vectors.f32"
+
+
+def document_hash(document: str) -> str:
+    """
+    Computes the content address of an example.
+
+    :param document: The example text.
+    :return: The hex SHA-256 digest of the text.
+    """
+    return hashlib.sha256(document.encode("utf-8")).hexdigest()
+
+
+def _write_atomic(path: Path, data: bytes) -> None:
+    """
+    Writes a file so that readers never observe a partially written state.
+
+    :param path: The destination path.
+    :param data: The bytes to write.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=path.name + ".")
+    with os.fdopen(fd, "wb") as file:
+        file.write(data)
+    os.replace(tmp_path, path)
+
+
+class ExampleIndex:
+    """
+    A content-addressed embedding index for the bpftrace examples.
+
+    Every example is keyed by the hash of its text. Vectors are stored as a
+    raw float32 matrix in `index_dir` and memory-mapped on load, so only
+    examples whose hash is not yet in the index are sent to the embedding model.
+    """
+    def __init__(self, index_dir: Path, embeddings: Any):
+        """
+        Initializes an ExampleIndex object.
+
+        :param index_dir: The directory that holds the manifest and the vector file.
+        :param embeddings: An embedding model with `embed_documents` and `embed_query`.
+        """
+        self.index_dir = Path(index_dir)
+        self.embeddings = embeddings
+        self.model = getattr(embeddings, "model", type(embeddings).__name__)
+        self.documents: List[str] = []
+        self.vectors = np.zeros((0, 0), dtype=np.float32)
+
+    def _load_manifest(self) -> Dict[str, Any]:
+        """
+        Reads the manifest of the index on disk.
+
+        :return: The manifest, or an empty one if it is missing or built with another model.
+        """
+        manifest_path = self.index_dir / MANIFEST_NAME
+        vectors_path = self.index_dir / VECTORS_NAME
+        if not (manifest_path.exists() and vectors_path.exists()):
+            return {"hashes": []}
+        with open(manifest_path, "r", encoding="utf-8") as file:
+            manifest = json.load(file)
+        if manifest.get("model") != self.model:
+            return {"hashes": []}
+        return manifest
+
+    def _map_vectors(self, rows: int, dim: int) -> np.ndarray:
+        """
+        Memory-maps the vector file.
+
+        :param rows: The number of vectors in the file.
+        :param dim: The dimension of each vector.
+        :return: A read-only (rows, dim) float32 matrix.
+        """
+        if rows == 0:
+            return np.zeros((0, dim), dtype=np.float32)
+        return np.memmap(self.index_dir / VECTORS_NAME, dtype=np.float32,
+                         mode="r", shape=(rows, dim))
+
+    def sync(self, documents: List[str]) -> int:
+        """
+        Brings the index in line with the given examples.
+
+        Examples already in the index are reused, new or changed ones are
+        embedded, and removed ones are dropped.
+
+        :param documents: The current example texts.
+        :return: The number of examples that had to be embedded.
+        """
+        manifest = self._load_manifest()
+        old_hashes = manifest["hashes"]
+        dim = manifest.get("dim", 0)
+        old_vectors = self._map_vectors(len(old_hashes), dim)
+        old_rows = {digest: row for row, digest in enumerate(old_hashes)}
+
+        hashes = [document_hash(document) for document in documents]
+        missing = [i for i, digest in enumerate(hashes) if digest not in old_rows]
+        self.documents = list(documents)
+        if not missing and hashes == old_hashes:
+            self.vectors = old_vectors
+            return 0
+
+        new_vectors = {}
+        if missing:
+            embedded = self.embeddings.embed_documents([documents[i] for i in missing])
+            for i, vector in zip(missing, embedded):
+                new_vectors[i] = vector
+            dim = len(embedded[0])
+        matrix = np.zeros((len(documents), dim), dtype=np.float32)
+        for i, digest in enumerate(hashes):
+            matrix[i] = new_vectors[i] if i in new_vectors else old_vectors[old_rows[digest]]
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        matrix /= np.where(norms == 0, 1, norms)
+
+        self.index_dir.mkdir(parents=True, exist_ok=True)
+        _write_atomic(self.index_dir / VECTORS_NAME, matrix.tobytes())
+        manifest = {"model": self.model, "dim": dim, "hashes": hashes}
+        _write_atomic(self.index_dir / MANIFEST_NAME, json.dumps(manifest).encode("utf-8"))
+        self.vectors = self._map_vectors(len(hashes), dim)
+        return len(missing)
+
+    def search(self, query: str, k: int = 2) -> List[str]:
+        """
+        Finds the examples closest to the query by cosine similarity.
+
+        :param query: The user's request.
+        :param k: The number of examples to return.
+        :return: The most similar examples, best first.
+        """
+        if len(self.documents) == 0:
+            return []
+        vector = np.asarray(self.embeddings.embed_query(query), dtype=np.float32)
+        scores = self.vectors @ vector
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [self.documents[i] for i in top]
+
+
+class FakeEmbeddings:
+    """
+    A deterministic embedding model that counts how many texts it embeds.
+    """
+    model = "fake"
+
+    def __init__(self):
+        self.embedded = 0
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        self.embedded += len(texts)
+        return [self.embed_query(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        vector = [0.0] * 16
+        for word in text.split():
+            vector[int(document_hash(word), 16) % 16] += 1.0
+        return vector
+
+
+class TestExampleIndex(unittest.TestCase):
+    def test_incremental_sync(self):
+        with tempfile.TemporaryDirectory() as index_dir:
+            embeddings = FakeEmbeddings()
+            docs = ["count syscalls by process", "trace block io latency", "files opened by process"]
+            self.assertEqual(ExampleIndex(index_dir, embeddings).sync(docs), 3)
+            # A fresh process reuses every vector on disk.
+            index = ExampleIndex(index_dir, embeddings)
+            self.assertEqual(index.sync(docs), 0)
+            self.assertEqual(index.search("block io latency", k=1), ["trace block io latency"])
+            # Only the changed example is embedded again.
+            docs[1] = "trace block io size"
+            self.assertEqual(ExampleIndex(index_dir, embeddings).sync(docs), 1)
+            self.assertEqual(embeddings.embedded, 4)
@@ -1,7 +1,12 @@
-import os
-from langchain.document_loaders import JSONLoader
-from langchain.vectorstores import FAISS
-from langchain.embeddings.openai import OpenAIEmbeddings
+import json
+import threading
+import time
+import unittest
+from contextvars import ContextVar
+from pathlib import Path
+from typing import Callable, Dict, List
+
+from gpttrace.config import cfg
 # from langchain.embeddings.openai import OpenAIEmbeddings
 # from langchain.vectorstores import DocArrayInMemorySearch
 # from langchain.document_loaders import DirectoryLoader
@@ -54,33 +59,193 @@ bpftrace -e 'tracepoint:syscalls:sys_enter_openat /cgroup == cgroupid("/sys/fs/c
 
 """
 
+_example_index = None
+_bm25_index = None
+
+
+def load_example_corpus() -> List[str]:
+    """
+    Loads the bpftrace examples used for retrieval.
+
+    The corpus is every entry of `examples.json` plus any `.bt` program under
+    the tools directory that has not been summarized into it yet.
+
+    :return: The example texts.
+    """
+    tools_path = Path(cfg.get("TOOLS_PATH"))
+    with open(tools_path / "examples.json", "r", encoding="utf-8") as file:
+        documents = [item["content"] for item in json.load(file)["data"]]
+    summarized = set()
+    if (tools_path / "output.json").exists():
+        with open(tools_path / "output.json", "r", encoding="utf-8") as file:
+            summarized = {item["bpf"] for item in json.load(file)}
+    for bt_path in sorted(tools_path.glob("*.bt")):
+        source = bt_path.read_text(encoding="utf-8")
+        if source not in summarized:
+            documents.append(f"example: {bt_path.name}\n\n```\n{source}\n```\n")
+    return documents
+
+
+def get_example_index() -> "ExampleIndex":
+    """
+    Gets the embedding index of the examples, loading it once per process.
+
+    :return: The example index, synced with the current corpus.
+    """
+    global _example_index
+    if _example_index is None:
+        from langchain.embeddings.openai import OpenAIEmbeddings
+        from gpttrace.example_index import ExampleIndex
+
+        index = ExampleIndex(Path(cfg.get("EXAMPLE_INDEX_PATH")), OpenAIEmbeddings())
+        embedded = index.sync(load_example_corpus())
+        if embedded:
+            print(f"Embedded {embedded} new or changed examples.")
+        _example_index = index
+    return _example_index
+
+
+def get_bm25_index() -> "BM25Index":
+    """
+    Gets the lexical index of the examples, loading it once per process.
+
+    :return: The BM25 index, rebuilt first if the corpus changed.
+    """
+    global _bm25_index
+    if _bm25_index is None:
+        from gpttrace.bm25 import BM25Index
+
+        index_path = Path(cfg.get("EXAMPLE_INDEX_PATH")) / "bm25.npz"
+        _bm25_index = BM25Index.load(index_path, load_example_corpus())
+    return _bm25_index
+
+
+def reciprocal_rank_fusion(rankings: List[List[str]], k: int = 60) -> List[str]:
+    """
+    Merges several rankings of the same documents into one.
+
+    :param rankings: Lists of documents, each ordered best first.
+    :param k: The rank smoothing constant.
+    :return: The documents ordered by their fused score.
+    """
+    scores = {}
+    for ranking in rankings:
+        for rank, document in enumerate(ranking):
+            scores[document] = scores.get(document, 0.0) + 1.0 / (k + rank + 1)
+    return sorted(scores, key=scores.get, reverse=True)
+
+
 def get_bpftrace_basic_examples(query: str) -> str:
-    loader = JSONLoader(
-        file_path='./tools/examples.json',
-        jq_schema='.data[].content',
-        json_lines=True
-    )
-    documents = loader.load()
-    embeddings = OpenAIEmbeddings()
-
-    # Check if the vector database files exist
-    if not (os.path.exists("./data_save/vector_db.faiss") and os.path.exists("./data_save/vector_db.pkl")):
-        db = FAISS.from_documents(documents, embeddings)
-        db.save_local("./data_save", index_name="vector_db")
+    retriever = cfg.get("EXAMPLE_RETRIEVER")
+    if retriever == "bm25":
+        results = get_bm25_index().search(query, k=2)
+    elif retriever == "hybrid":
+        results = reciprocal_rank_fusion([
+            get_example_index().search(query, k=4),
+            get_bm25_index().search(query, k=4),
+        ])[:2]
     else:
-        # Load an existing FAISS vector store
-        db = FAISS.load_local("./data_save", index_name="vector_db", embeddings=embeddings)
+        results = get_example_index().search(query, k=2)
+    return "\n".join(results)
+
+class RetrievalMemo:
+    """
+    Remembers the examples retrieved for each user request, so a retry chain
+    pays for retrieval once.
+    """
+    def __init__(self):
+        """
+        Initializes an empty RetrievalMemo object.
+        """
+        self.results: Dict[str, str] = {}
+        self.hits = 0
+        self.misses = 0
+        # seconds spent retrieving, on misses
+        self.seconds = 0.0
+
+    def get(self, text: str, retrieve: Callable[[str], str]) -> str:
+        """
+        Returns the memoized examples for a request, retrieving them on first use.
+
+        :param text: User request.
+        :param retrieve: The function that retrieves examples for a request.
+        :return: The examples.
+        """
+        if text in self.results:
+            self.hits += 1
+            return self.results[text]
+        self.misses += 1
+        start = time.perf_counter()
+        examples = retrieve(text)
+        self.seconds += time.perf_counter() - start
+        self.results[text] = examples
+        return examples
+
+    def clear(self) -> None:
+        """
+        Forgets every memoized result and resets the counters.
+        """
+        self.results.clear()
+        self.hits = 0
+        self.misses = 0
+        self.seconds = 0.0
+
+    def stats(self) -> Dict[str, int]:
+        """
+        :return: The number of hits and misses since the last `clear`.
+        """
+        return {"hits": self.hits, "misses": self.misses}
+
+
+# The memo of the request being handled, so requests run by different threads do not share one.
+example_memo: "ContextVar[RetrievalMemo]" = ContextVar("example_memo")
+
+
+def start_example_memo() -> RetrievalMemo:
+    """
+    Gives the request being handled a new, empty RetrievalMemo.
+
+    :return: The memo.
+    """
+    memo = RetrievalMemo()
+    example_memo.set(memo)
+    return memo
 
-    results = db.search(query, search_type='similarity')
-    results = [result.page_content for result in results]
-    return "\n".join(results[:2])
 
 def construct_bpftrace_examples(text: str) -> str:
-    examples = get_bpftrace_basic_examples(text)
+    memo = example_memo.get(None) or start_example_memo()
+    examples = memo.get(text, get_bpftrace_basic_examples)
     # docs = db.similarity_search(text)
     # examples += "\n The following is a more complex example: \n"
     # examples += docs[0].page_content
     return examples
 
+class TestRetrievalMemo(unittest.TestCase):
+    def test_retry_chain_retrieves_once(self):
+        calls = []
+        memo = RetrievalMemo()
+        for _ in range(5):
+            examples = memo.get("count page faults", lambda text: calls.append(text) or "examples")
+            self.assertEqual(examples, "examples")
+        self.assertEqual(calls, ["count page faults"])
+        self.assertEqual(memo.stats(), {"hits": 4, "misses": 1})
+
+    def test_memo_per_thread(self):
+        memos = []
+
+        def request():
+            memo = start_example_memo()
+            memo.get("count page faults", lambda text: "examples")
+            memos.append(example_memo.get())
+
+        threads = [threading.Thread(target=request) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertIsNot(memos[0], memos[1])
+        self.assertEqual([memo.stats() for memo in memos], [{"hits": 0, "misses": 1}] * 2)
+
+
 if __name__ == "__main__":
     get_bpftrace_basic_examples("Trace allocations and display each individual allocator function call")
@@ -1,25 +1,54 @@
 import os
+import re
 import json
-import shutil
 import tempfile
-import openai
-from litellm import completion
+import threading
+import time
+import unittest
+from pathlib import Path
+from unittest import mock
+from typing import Callable, Dict, List, Optional, TypedDict
 
-from gpttrace.utils.common import get_doc_content_for_query, init_conversation
-from gpttrace.prompt import construct_running_prompt, construct_prompt_on_error, construct_prompt_for_explain
-from gpttrace.bpftrace import run_bpftrace
+from gpttrace.prompt import (PROMPT_VERSION, prompt_for_explain_sections, prompt_on_error_sections,
+                             running_prompt_sections)
+from gpttrace.model_router import STRONG, ModelRouter
+from gpttrace.program_cache import ProgramCache
+from gpttrace.bpftrace import (CommandResult, RunPolicy, request_function_call, request_function_calls,
+                                run_function_call)
+from gpttrace.capture import fan_out
+from gpttrace.history import HistoryStore, RunRecord, close_history_writer, get_history_writer
+from gpttrace import llm
+from gpttrace.config import cfg
+from gpttrace.examples import start_example_memo
+from gpttrace.reducer import OutputReducer, cleared_maps
+from gpttrace.tokens import PromptAssembler
+from gpttrace.trace_data import TraceTables
+from gpttrace.utils.common import StreamingMarkdownPrinter, pretty_print
+from gpttrace.validate import candidate_command, validate_candidates
 
+# The part of a failed command's stderr that is kept in the attempt history.
+STDERR_LIMIT = 512
+# The stages of a request, in the order they run.
+STAGES = ["retrieval", "prompt", "llm", "exec", "explain"]
 
-def call_gpt_api(prompt: str) -> str:
+
+def call_gpt_api(prompt: str, on_token: Optional[Callable[[str], None]] = None) -> str:
     """
     This function sends a list of messages to the GPT model
+
+    :param prompt: The prompt to send.
+    :param on_token: If given, the answer is streamed and this is called with each piece as it arrives.
+    :return: The whole answer.
     """
     messages = [{"role": "user", "content": prompt}]
-    response = openai.ChatCompletion.create(
-        model="gpt-3.5-turbo-0613",
-        messages=messages,
-    )
-    return response["choices"][0]["message"]["content"]
+    if on_token is None:
+        response = llm.chat(messages, cfg.get("EXPLAIN_MODEL"))
+        return response["choices"][0]["message"]["content"]
+    content = []
+    for delta in llm.stream_chat(messages, cfg.get("EXPLAIN_MODEL")):
+        on_token(delta)
+        content.append(delta)
+    return "".join(content)
 
 def call_litellm(prompt: str) -> str:
     """
@@ -29,43 +58,489 @@ def call_litellm(prompt: str) -> str:
     messages = [{"role": "user", "content": prompt}]
     # see supported models here: 
     # https://litellm.readthedocs.io/en/latest/supported/
-    response = completion(
-        model="claude-instant-1",
-        messages=messages,
-    )
+    response = llm.chat_litellm(messages, cfg.get("LITELLM_MODEL"))
     return response["choices"][0]["message"]["content"]
 
-def execute(user_input: str, verbose: bool = False, retry: int = 5, previous_prompt: str = None, output: str = None) -> None:
+class AttemptRecord(TypedDict):
+    attempt: int
+    command: str
+    # stderr truncated to STDERR_LIMIT characters
+    stderr: str
+    error_class: str
+    # whether the program came from the program cache instead of the model
+    cached: bool
+    prompt_tokens: int
+    completion_tokens: int
+    # seconds spent waiting for the model and running the command
+    llm_latency: float
+    exec_latency: float
+    # tokens of each prompt section after trimming, empty for cached programs
+    prompt_sections: Dict[str, int]
+    # the model that wrote the program, "" for cached programs
+    model: str
+
+
+class ExecuteResult(TypedDict):
+    attempts: List[AttemptRecord]
+    # the result of the last attempt, None if no attempt was made
+    result: Optional[CommandResult]
+    explanation: Optional[str]
+    # seconds from the explain request to its first token and to its end
+    explain_ttft: Optional[float]
+    explain_latency: Optional[float]
+    # the parsed `-f json` output of the last attempt, if requested
+    tables: Optional[TraceTables]
+    # seconds spent per stage over all attempts: "retrieval", "prompt", "llm", "exec" and "explain"
+    stage_times: Dict[str, float]
+
+
+def classify_error(stderr: str) -> str:
+    """
+    Reduce an error message to a class, so repeated failures can be recognized.
+
+    :param stderr: The stderr of the failed command.
+    :return: The first error line without source locations and numbers.
+    """
+    for line in stderr.splitlines():
+        line = line.strip()
+        if line:
+            # bpftrace prefixes errors with the location, e.g. "stdin:1:1-25: ERROR: ..."
+            line = re.sub(r"^\S+:\d+:\d+(-\d+)?:\s*", "", line)
+            line = re.sub(r"\b\d+\b", "N", line)
+            return line[:120]
+    return "unknown error"
+
+
+def make_attempt_record(attempt: int, command: str, stderr: str, cached: bool, usage: dict,
+                        llm_latency: float, exec_latency: float,
+                        prompt_sections: Optional[Dict[str, int]] = None, model: str = "") -> AttemptRecord:
+    """
+    Build the history entry of one attempt.
+
+    :param attempt: The number of the attempt, starting at 1.
+    :param command: The command that was run or rejected.
+    :param stderr: The error of the command, "" if it succeeded.
+    :param cached: Whether the program came from the program cache.
+    :param usage: The token usage of the model call.
+    :param llm_latency: Seconds spent waiting for the model.
+    :param exec_latency: Seconds spent running the command.
+    :param prompt_sections: The tokens of each section of the prompt.
+    :param model: The model that wrote the program.
+    :return: The attempt record.
+    """
+    return {
+        "attempt": attempt,
+        "command": command,
+        "stderr": stderr if len(stderr) <= STDERR_LIMIT else stderr[:STDERR_LIMIT] + "...",
+        "error_class": classify_error(stderr) if stderr != "" else "",
+        "cached": cached,
+        "prompt_tokens": usage.get("prompt_tokens", 0),
+        "completion_tokens": usage.get("completion_tokens", 0),
+        "llm_latency": llm_latency,
+        "exec_latency": exec_latency,
+        "prompt_sections": dict(prompt_sections or {}),
+        "model": model,
+    }
+
+
+def print_prompt_sections(assembler: PromptAssembler) -> None:
+    """
+    Print the tokens of each section of a prompt and the sections that were trimmed to fit.
+
+    :param assembler: The assembler the prompt was built with.
+    """
+    counts = ", ".join(f"{name} {count}" for name, count in assembler.counts.items())
+    trimmed = f", trimmed: {', '.join(assembler.trimmed)}" if assembler.trimmed else ""
+    print(f"Prompt tokens: {counts} ({assembler.total()} of {assembler.budget}{trimmed})")
+
+
+def print_attempt_stats(attempts: List[AttemptRecord]) -> None:
+    """
+    Print the token and latency cost of each attempt.
+
+    :param attempts: The attempts made by `execute`.
+    """
+    for record in attempts:
+        print(f"attempt {record['attempt']}: "
+              f"tokens {record['prompt_tokens']}+{record['completion_tokens']}, "
+              f"llm {record['llm_latency']:.2f}s, exec {record['exec_latency']:.2f}s, "
+              f"{record['error_class'] or 'ok'}")
+    total_tokens = sum(r["prompt_tokens"] + r["completion_tokens"] for r in attempts)
+    print(f"total: {len(attempts)} attempts, {total_tokens} tokens")
+
+
+_program_caches: Dict[str, ProgramCache] = {}
+_program_caches_lock = threading.Lock()
+
+
+def get_program_cache() -> ProgramCache:
+    """
+    Open the program cache configured in `cfg`, once per process, so the
+    requests of a batch or of the daemon share it.
+
+    :return: The program cache.
+    """
+    path = Path(cfg.get("PROGRAM_CACHE_PATH"))
+    with _program_caches_lock:
+        cache = _program_caches.get(str(path))
+        if cache is None:
+            cache = _program_caches[str(path)] = ProgramCache(path, int(cfg.get("PROGRAM_CACHE_SIZE")),
+                                                              float(cfg.get("PROGRAM_CACHE_TTL")))
+        return cache
+
+
+def get_model_router() -> ModelRouter:
+    """
+    Open the model router configured in `cfg`.
+
+    :return: The model router.
+    """
+    return ModelRouter(Path(cfg.get("MODEL_STATS_PATH")), cfg.get("GENERATION_MODEL"),
+                       cfg.get("STRONG_MODEL"), int(cfg.get("ESCALATE_AFTER")))
+
+
+def function_call_program(response_message: dict) -> str:
+    """
+    :param response_message: The response message of the model.
+    :return: The bpftrace program of the function call, or "" if there is none.
+    """
+    function_call = response_message.get("function_call")
+    if not function_call or function_call["name"] != "bpftrace":
+        return ""
+    try:
+        return json.loads(function_call["arguments"]).get("program", "")
+    except (json.JSONDecodeError, AttributeError):
+        return ""
+
+
+def record_run(user_input: str, started: float, program: str, outcome: ExecuteResult) -> None:
+    """
+    Queues the request for the run history, unless `RECORD_HISTORY` is "0".
+
+    :param user_input: The user's request.
+    :param started: The time the request started, in seconds since the epoch.
+    :param program: The bpftrace program of the last attempt.
+    :param outcome: The outcome of the request.
+    """
+    if cfg.get("RECORD_HISTORY") == "0" or not outcome["attempts"]:
+        return
+    attempts = outcome["attempts"]
+    result = outcome["result"]
+    record: RunRecord = {
+        "started": started,
+        "request": user_input,
+        "program": program,
+        "command": attempts[-1]["command"],
+        "status": "ok" if outcome["explanation"] is not None else "failed",
+        "returncode": result["returncode"] if result is not None else None,
+        "stderr": result["stderr"] if result is not None else attempts[-1]["stderr"],
+        "stdout": result["stdout"] if result is not None else "",
+        "explanation": outcome["explanation"],
+        "attempts": len({record["attempt"] for record in attempts}),
+        "model": attempts[-1]["model"],
+        "prompt_tokens": sum(record["prompt_tokens"] for record in attempts),
+        "completion_tokens": sum(record["completion_tokens"] for record in attempts),
+        "stage_times": outcome["stage_times"],
+    }
+    get_history_writer(Path(cfg.get("HISTORY_PATH"))).record(record)
+
+
+def execute(user_input: str, verbose: bool = False, retry: int = 5, token_budget: Optional[int] = None,
+            json_output: bool = False, use_cache: bool = True, candidates: int = 1,
+            policy: Optional[RunPolicy] = None) -> ExecuteResult:
     """
     Convert the user request into a BPF command and execute it.
 
+    Failed attempts are retried up to `retry` times in total. Each retry
+    prompt carries a compact history of the previous attempts instead of
+    the previous prompt. If a program ran successfully for the same request
+    before, the first attempt reuses it without asking the model.
+
+    With `candidates` > 1 the model is asked for that many programs at once,
+    they are checked in parallel (static check and `bpftrace -d` dry run), and
+    the first one that passes is run. If none passes, their errors feed the
+    next attempt.
+
+    Every request is added to the run history, see `record_run`.
+
+    Programs are written by `GENERATION_MODEL` until `ESCALATE_AFTER`
+    attempts failed or the model returned arguments that do not parse, and
+    by `STRONG_MODEL` from then on, see `ModelRouter`.
+
     :param user_input: The user's request.
-    :param need_train: Whether to use the vector database.
     :param verbose: Whether to print extra information.
+    :param retry: The maximum number of attempts.
+    :param token_budget: Stop retrying once the attempts have used this many tokens.
+    :param json_output: Whether to run bpftrace with `-f json` and parse its output into tables.
+    :param use_cache: Whether to look up and store programs in the program cache.
+    :param candidates: The number of candidate programs requested per attempt.
+    :param policy: How bpftrace commands are approved and run, defaults to asking at the terminal.
+        If it does not echo output, the explanation is not printed either.
+    :return: The record of every attempt, the last result, its explanation and tables.
+    :raises CommandRejected: If a bpftrace command was not approved.
     """
-    if retry == 0:
-        print("Retry times exceeded...")
-    # agent_chain, index = init_conversation(need_train, verbose)
-    # print("Sending query to ChatGPT: " + user_input)
-    if previous_prompt is None:
-        prompt = construct_running_prompt(user_input)
+    echo = policy is None or policy.echo
+    started = time.time()
+    program = ""
+    example_memo = start_example_memo()
+    attempts: List[AttemptRecord] = []
+    outcome: ExecuteResult = {"attempts": attempts, "result": None, "explanation": None, "tables": None,
+                              "explain_ttft": None, "explain_latency": None,
+                              "stage_times": dict.fromkeys(STAGES, 0.0)}
+    stage_times = outcome["stage_times"]
+    cache = get_program_cache() if use_cache else None
+    cache_key = ProgramCache.key(user_input, cfg.get("GENERATION_MODEL"), PROMPT_VERSION)
+    cached_call = cache.get(cache_key) if cache is not None else None
+    router = get_model_router()
+    spent_tokens = 0
+    for attempt in range(1, retry + 1):
+        start = time.perf_counter()
+        cached = attempt == 1 and cached_call is not None
+        prompt_end = start
+        sections = {}
+        tier, model = None, ""
+        if cached:
+            print("Using the cached program for this request.")
+            response_message, usage = {"role": "assistant", "content": None, "function_call": cached_call}, {}
+        else:
+            if attempts:
+                assembler = prompt_on_error_sections(user_input, attempts)
+            else:
+                assembler = running_prompt_sections(user_input)
+            prompt = assembler.build()
+            sections = assembler.counts
+            prompt_end = time.perf_counter()
+            stage_times["prompt"] += prompt_end - start
+            if verbose is True:
+                print("Prompt: " + prompt)
+                print_prompt_sections(assembler)
+            tier = router.tier(attempts)
+            model = router.model(tier)
+            if tier == STRONG and verbose is True:
+                print(f"Escalated to {model}.")
+            if candidates > 1:
+                response_messages, usage = request_function_calls(prompt, candidates, verbose, model)
+                errors = validate_candidates(response_messages)
+                passed = [message for message, error in zip(response_messages, errors) if error == ""]
+                if not passed:
+                    spent_tokens += usage.get("total_tokens", 0)
+                    latency = time.perf_counter() - start
+                    stage_times["llm"] += latency - (prompt_end - start)
+                    router.record(tier, latency - (prompt_end - start), usage.get("total_tokens", 0), False)
+                    for i, (message, error) in enumerate(zip(response_messages, errors)):
+                        # The usage of the request is counted once, on its first candidate.
+                        attempts.append(make_attempt_record(attempt, candidate_command(message), error, False,
+                                                            usage if i == 0 else {}, latency, 0.0, sections,
+                                                            model))
+                    print(f"All {len(response_messages)} candidates failed validation.")
+                    if token_budget is not None and spent_tokens >= token_budget:
+                        print(f"Token budget of {token_budget} exhausted after {attempt} attempts.")
+                        break
+                    print("retry time " + str(retry - attempt) + "...")
+                    continue
+                response_message = passed[0]
+            else:
+                response_message, usage = request_function_call(prompt, verbose, model)
+        llm_latency = time.perf_counter() - start
+        stage_times["llm"] += llm_latency - (prompt_end - start)
+        program = function_call_program(response_message)
+        cleared = cleared_maps(program)
+        reducer = OutputReducer(cleared=cleared)
+        if json_output:
+            outcome["tables"] = TraceTables(cleared)
+            res = run_function_call(response_message, fan_out(reducer.on_line, outcome["tables"].on_line), "json",
+                                    policy)
+        else:
+            res = run_function_call(response_message, reducer.on_line, policy=policy)
+        outcome["result"] = res
+        exec_latency = time.perf_counter() - start - llm_latency
+        stage_times["exec"] += exec_latency
+        spent_tokens += usage.get("total_tokens", 0)
+        stderr = res["stderr"]
+        attempts.append(make_attempt_record(attempt, res["command"], stderr, cached, usage,
+                                            llm_latency, exec_latency, sections, model))
+        if tier is not None:
+            router.record(tier, llm_latency - (prompt_end - start), usage.get("total_tokens", 0), stderr == "")
+        function_call = response_message.get("function_call")
+        if cache is not None and function_call and function_call["name"] == "bpftrace":
+            if stderr == "":
+                cache.put(cache_key, user_input, function_call)
+            elif cached:
+                cache.invalidate(cache_key)
+        if stderr == "":
+            # success
+            if verbose is True:
+                print(f"Example retrieval: {example_memo.stats()}")
+            if echo:
+                print("AI explanation:")
+            explain_stage_start = time.perf_counter()
+            if reducer.lines == 0:
+                reducer.feed_text(res["stdout"])
+            output = reducer.summary(int(cfg.get("EXPLAIN_TOKEN_BUDGET")), cfg.get("EXPLAIN_MODEL"))
+            assembler = prompt_for_explain_sections(user_input, output)
+            prompt = assembler.build()
+            if verbose is True:
+                print("Prompt: " + prompt)
+                print_prompt_sections(assembler)
+            explain_start = time.perf_counter()
+            if echo and cfg.get("STREAM_EXPLAIN") != "0":
+                printer = StreamingMarkdownPrinter()
+
+                def on_token(delta: str) -> None:
+                    if outcome["explain_ttft"] is None:
+                        outcome["explain_ttft"] = time.perf_counter() - explain_start
+                    printer.feed(delta)
+
+                explain = call_gpt_api(prompt, on_token)
+                printer.close()
+            else:
+                explain = call_gpt_api(prompt)
+                outcome["explain_ttft"] = time.perf_counter() - explain_start
+                if echo:
+                    pretty_print(explain)
+            outcome["explain_latency"] = time.perf_counter() - explain_start
+            outcome["explanation"] = explain
+            stage_times["explain"] = time.perf_counter() - explain_stage_start
+            break
+        if echo:
+            print("output: " + json.dumps(res))
+        if token_budget is not None and spent_tokens >= token_budget:
+            print(f"Token budget of {token_budget} exhausted after {attempt} attempts.")
+            break
+        print("retry time " + str(retry - attempt) + "...")
     else:
-        prompt = construct_prompt_on_error(
-            previous_prompt, user_input, output)
+        print("Retry times exceeded...")
+    # Retrieval runs while the first prompt is built.
+    stage_times["retrieval"] = example_memo.seconds
+    stage_times["prompt"] = max(0.0, stage_times["prompt"] - example_memo.seconds)
+    router.save()
+    record_run(user_input, started, program, outcome)
     if verbose is True:
-        print("Prompt: " + prompt)
-    res = run_bpftrace(prompt, verbose)
-    if res["stderr"] != '':
-        print("output: " + json.dumps(res))
-        print("retry time " + str(retry) + "...")
-        # retry
-        res = execute(user_input, verbose, retry - 1, prompt, json.dumps(res))
-    else:
-        # success
-        print("AI explanation:")
-        prompt = construct_prompt_for_explain(user_input, res["stdout"])
-        if verbose is True:
-            print("Prompt: " + prompt)
-        explain = call_gpt_api(prompt)
-        print(explain)
+        print_attempt_stats(attempts)
+        if outcome["explain_latency"] is not None:
+            ttft = "-" if outcome["explain_ttft"] is None else f"{outcome['explain_ttft']:.2f}s"
+            print(f"explain: first token {ttft}, total {outcome['explain_latency']:.2f}s")
+        print("stages: " + ", ".join(f"{stage} {stage_times[stage]:.2f}s" for stage in STAGES))
+        resources = (outcome["result"] or {}).get("resources")
+        if resources is not None:
+            print(f"resources: cpu {resources['cpu_seconds']:.2f}s (peak {resources['peak_cpu_percent']:.0f}%), "
+                  f"rss peak {resources['peak_rss_mb']:.0f} MB, output {resources['output_mb']:.1f} MB "
+                  f"(peak {resources['peak_output_mb_per_s']:.1f} MB/s)")
+        if cache is not None:
+            print(f"Program cache: {cache.stats()}")
+        print(f"Model tiers: {router.stats()}")
+    return outcome
+
+
+class TestExecute(unittest.TestCase):
+    def setUp(self):
+        stats_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(stats_dir.cleanup)
+        env = mock.patch.dict(os.environ, {"MODEL_STATS_PATH": os.path.join(stats_dir.name, "model_stats.json"),
+                                           "HISTORY_PATH": os.path.join(stats_dir.name, "history.sqlite3"),
+                                           "GENERATION_MODEL": "fast-model", "STRONG_MODEL": "strong-model",
+                                           "ESCALATE_AFTER": "2"})
+        env.start()
+        self.addCleanup(env.stop)
+        self.addCleanup(close_history_writer, Path(os.environ["HISTORY_PATH"]))
+        # No probe catalog: building one lists the probes of this machine and writes it to data_save.
+        for target in ("gpttrace.prompt.get_probe_catalog", "gpttrace.validate.get_probe_catalog"):
+            catalog = mock.patch(target, return_value=None)
+            catalog.start()
+            self.addCleanup(catalog.stop)
+
+    def test_retry_budget_and_compact_history(self):
+        prompts = []
+        failure = {"command": "sudo bpftrace -e 'tracepoint:foo:bar {}'", "stdout": "",
+                   "stderr": "stdin:1:1-20: ERROR: tracepoint not found: foo:bar", "returncode": 1}
+        usage = {"prompt_tokens": 100, "completion_tokens": 20, "total_tokens": 120}
+        with mock.patch("gpttrace.prompt.construct_bpftrace_examples", return_value="examples"), \
+                mock.patch("gpttrace.execute.request_function_call",
+                           side_effect=lambda prompt, verbose, model: prompts.append(prompt) or ({}, usage)), \
+                mock.patch("gpttrace.execute.run_function_call", return_value=failure):
+            attempts = execute("trace foo", retry=3, use_cache=False)["attempts"]
+        self.assertEqual(len(attempts), 3)
+        self.assertEqual(attempts[0]["error_class"], "ERROR: tracepoint not found: foo:bar")
+        self.assertEqual(attempts[-1]["prompt_tokens"], 100)
+        # The retry prompt lists attempts instead of nesting the previous prompt.
+        self.assertEqual(prompts[2].count("supportive assistant"), 1)
+        self.assertEqual(prompts[2].count("(seen 2 times)"), 1)
+        self.assertEqual(list(attempts[0]["prompt_sections"]), ["system", "examples", "request"])
+        self.assertIn("history", attempts[2]["prompt_sections"])
+        # Two failures escalate the rest of the request to the strong model.
+        self.assertEqual([r["model"] for r in attempts], ["fast-model", "fast-model", "strong-model"])
+        stats = get_model_router().stats()
+        self.assertEqual((stats["fast"]["attempts"], stats["strong"]["attempts"]), (2, 1))
+
+    def test_token_budget(self):
+        failure = {"command": "c", "stdout": "", "stderr": "ERROR", "returncode": 1}
+        usage = {"prompt_tokens": 100, "completion_tokens": 20, "total_tokens": 120}
+        with mock.patch("gpttrace.prompt.construct_bpftrace_examples", return_value="examples"), \
+                mock.patch("gpttrace.execute.request_function_call", return_value=({}, usage)), \
+                mock.patch("gpttrace.execute.run_function_call", return_value=failure):
+            attempts = execute("trace foo", retry=5, token_budget=200, use_cache=False)["attempts"]
+        self.assertEqual(len(attempts), 2)
+
+    def test_cached_program_skips_the_model(self):
+        success = {"command": "sudo bpftrace -e x", "stdout": "@: 1\n", "stderr": "", "returncode": 0}
+        message = {"role": "assistant", "content": None,
+                   "function_call": {"name": "bpftrace", "arguments": '{"program": "x"}'}}
+        with tempfile.TemporaryDirectory() as cache_dir, \
+                mock.patch.dict(os.environ, {"PROGRAM_CACHE_PATH": os.path.join(cache_dir, "cache.json")}), \
+                mock.patch("gpttrace.prompt.construct_bpftrace_examples", return_value="examples"), \
+                mock.patch("gpttrace.execute.call_gpt_api", return_value="explanation"), \
+                mock.patch("gpttrace.execute.request_function_call", return_value=(message, {})) as request, \
+                mock.patch("gpttrace.execute.run_function_call", return_value=success):
+            execute("count page faults")
+            outcome = execute("Count page faults.")
+        self.assertEqual(request.call_count, 1)
+        self.assertTrue(outcome["attempts"][0]["cached"])
+        get_history_writer(Path(os.environ["HISTORY_PATH"])).flush()
+        runs = HistoryStore(Path(os.environ["HISTORY_PATH"])).search("page faults")
+        self.assertEqual([(run["request"], run["program"], run["status"]) for run in runs],
+                         [("Count page faults.", "x", "ok"), ("count page faults", "x", "ok")])
+        self.assertEqual(list(outcome["stage_times"]), STAGES)
+        self.assertEqual(outcome["stage_times"]["prompt"], 0.0)
+        self.assertGreater(outcome["stage_times"]["explain"], 0.0)
+
+    def test_candidates_validated_before_running(self):
+        def message(program):
+            return {"role": "assistant", "content": None,
+                    "function_call": {"name": "bpftrace", "arguments": json.dumps({"program": program})}}
+        success = {"command": "sudo bpftrace -e x", "stdout": "@: 1\n", "stderr": "", "returncode": 0}
+        rounds = [[message("kprobe:vfs_read {"), message("syscall:open { }")],
+                  [message("kprobe:vfs_read {"), message("kprobe:vfs_read { @ = count(); }")]]
+        usage = {"prompt_tokens": 100, "completion_tokens": 40, "total_tokens": 140}
+        with mock.patch("gpttrace.prompt.construct_bpftrace_examples", return_value="examples"), \
+                mock.patch("gpttrace.execute.call_gpt_api", return_value="explanation"), \
+                mock.patch("gpttrace.validate.shutil.which", return_value=None), \
+                mock.patch("gpttrace.execute.request_function_calls",
+                           side_effect=lambda prompt, n, verbose, model: (rounds.pop(0), usage)), \
+                mock.patch("gpttrace.execute.run_function_call", return_value=success) as run:
+            outcome = execute("count reads", use_cache=False, candidates=2)
+        self.assertEqual(run.call_count, 1)
+        self.assertEqual(run.call_args[0][0], message("kprobe:vfs_read { @ = count(); }"))
+        self.assertEqual([record["attempt"] for record in outcome["attempts"]], [1, 1, 2])
+        self.assertEqual(outcome["attempts"][1]["error_class"], "ERROR: invalid probe type: syscall:open")
+        self.assertEqual(sum(record["prompt_tokens"] for record in outcome["attempts"]), 200)
+
+    def test_streamed_explanation_records_time_to_first_token(self):
+        success = {"command": "sudo bpftrace -e x", "stdout": "@: 1\n", "stderr": "", "returncode": 0}
+        message = {"role": "assistant", "content": None,
+                   "function_call": {"name": "bpftrace", "arguments": '{"program": "x"}'}}
+
+        def stream(prompt, on_token):
+            for delta in ["The ", "count ", "is 1."]:
+                on_token(delta)
+                time.sleep(0.05)
+            return "The count is 1."
 
+        with mock.patch("gpttrace.prompt.construct_bpftrace_examples", return_value="examples"), \
+                mock.patch.dict(os.environ, {"STREAM_EXPLAIN": "1"}), \
+                mock.patch("gpttrace.execute.call_gpt_api", side_effect=stream), \
+                mock.patch("gpttrace.execute.request_function_call", return_value=(message, {})), \
+                mock.patch("gpttrace.execute.run_function_call", return_value=success):
+            outcome = execute("count page faults", use_cache=False)
+        self.assertEqual(outcome["explanation"], "The count is 1.")
+        self.assertLess(outcome["explain_ttft"], 0.05)
+        self.assertGreater(outcome["explain_latency"], 0.1)
@@ -0,0 +1,355 @@
+import atexit
+import hashlib
+import io
+import json
+import os
+import queue
+import sqlite3
+import stat
+import tempfile
+import threading
+import time
+import unittest
+import zlib
+from pathlib import Path
+from typing import Dict, List, Optional, TypedDict
+from unittest import mock
+
+# Outputs up to this size are kept in the run row; larger ones go to the blobs table, compressed.
+INLINE_OUTPUT_LIMIT = 4096
+# Most runs written in one transaction.
+WRITE_BATCH_SIZE = 256
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    started REAL NOT NULL,
+    request TEXT NOT NULL,
+    program TEXT NOT NULL,
+    command TEXT NOT NULL,
+    status TEXT NOT NULL,
+    returncode INTEGER,
+    stderr TEXT NOT NULL,
+    stdout TEXT,
+    stdout_digest TEXT NOT NULL,
+    stdout_bytes INTEGER NOT NULL,
+    explanation TEXT,
+    attempts INTEGER NOT NULL,
+    model TEXT NOT NULL,
+    prompt_tokens INTEGER NOT NULL,
+    completion_tokens INTEGER NOT NULL,
+    stage_times TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS runs_started ON runs (started);
+CREATE TABLE IF NOT EXISTS blobs (
+    digest TEXT PRIMARY KEY,
+    data BLOB NOT NULL
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS runs_fts USING fts5 (
+    request, program, content='runs', content_rowid='id', tokenize='unicode61'
+);
+CREATE TRIGGER IF NOT EXISTS runs_fts_insert AFTER INSERT ON runs BEGIN
+    INSERT INTO runs_fts (rowid, request, program) VALUES (new.id, new.request, new.program);
+END;
+CREATE TRIGGER IF NOT EXISTS runs_fts_delete AFTER DELETE ON runs BEGIN
+    INSERT INTO runs_fts (runs_fts, rowid, request, program) VALUES ('delete', old.id, old.request, old.program);
+END;
+"""
+# The columns `search` and `recent` return; the full output is read with `get`.
+SUMMARY_COLUMNS = "id, started, request, program, status, returncode, stdout_bytes, attempts, model"
+
+
+class RunRecord(TypedDict):
+    # seconds since the epoch when the request started
+    started: float
+    request: str
+    # the bpftrace program of the last attempt, "" if none was generated
+    program: str
+    command: str
+    # "ok" if the last attempt ran and was explained, otherwise "failed"
+    status: str
+    returncode: Optional[int]
+    stderr: str
+    stdout: str
+    explanation: Optional[str]
+    attempts: int
+    # the model that wrote the last program, "" for cached programs
+    model: str
+    prompt_tokens: int
+    completion_tokens: int
+    # seconds per stage, see `gpttrace.execute.STAGES`
+    stage_times: Dict[str, float]
+
+
+def fts_query(text: str) -> str:
+    """
+    Turns free text into an FTS5 query matching runs that contain every word.
+
+    :param text: The words to look for; the last one also matches as a prefix.
+    :return: The FTS5 query.
+    """
+    words = [word.replace('"', '""') for word in text.split()]
+    terms = [f'"{word}"' for word in words]
+    if terms:
+        terms[-1] += "*"
+    return " ".join(terms)
+
+
+class HistoryStore:
+    """
+    A SQLite database of every request run, searchable by request and program text.
+
+    Outputs larger than `INLINE_OUTPUT_LIMIT` are stored compressed in a
+    separate table, keyed by their digest, so the run rows stay small and
+    repeated outputs are stored once.
+    """
+    def __init__(self, path: Path):
+        """
+        Initializes a HistoryStore object, creating the database if needed.
+
+        The outputs of traces run as root are stored, so only the user may
+        read the database; SQLite gives its WAL files the same mode.
+
+        :param path: The path of the database.
+        """
+        self.path = Path(path)
+        self.path.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+        os.close(os.open(self.path, os.O_CREAT | os.O_RDWR, 0o600))
+        if stat.S_IMODE(os.stat(self.path).st_mode) & 0o077:
+            # Created by an older version with the default umask.
+            os.chmod(self.path, 0o600)
+        self.connection = sqlite3.connect(str(self.path), check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(SCHEMA)
+
+    def add(self, records: List[RunRecord]) -> None:
+        """
+        Writes runs in one transaction.
+
+        :param records: The runs.
+        """
+        rows, blobs = [], []
+        for record in records:
+            stdout = record["stdout"].encode("utf-8", errors="replace")
+            digest = hashlib.sha256(stdout).hexdigest()
+            inline = record["stdout"] if len(stdout) <= INLINE_OUTPUT_LIMIT else None
+            if inline is None:
+                blobs.append((digest, zlib.compress(stdout, 6)))
+            rows.append((record["started"], record["request"], record["program"], record["command"],
+                         record["status"], record["returncode"], record["stderr"], inline, digest, len(stdout),
+                         record["explanation"], record["attempts"], record["model"], record["prompt_tokens"],
+                         record["completion_tokens"], json.dumps(record["stage_times"])))
+        with self.connection:
+            self.connection.executemany("INSERT OR IGNORE INTO blobs (digest, data) VALUES (?, ?)", blobs)
+            self.connection.executemany(
+                "INSERT INTO runs (started, request, program, command, status, returncode, stderr, stdout, "
+                "stdout_digest, stdout_bytes, explanation, attempts, model, prompt_tokens, completion_tokens, "
+                "stage_times) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+    def _rows(self, sql: str, params: tuple) -> List[dict]:
+        cursor = self.connection.execute(sql, params)
+        names = [column[0] for column in cursor.description]
+        return [dict(zip(names, row)) for row in cursor.fetchall()]
+
+    def search(self, text: str, limit: int = 20) -> List[dict]:
+        """
+        Finds runs whose request or program contains every word of the text.
+
+        :param text: The words to look for.
+        :param limit: The maximum number of runs to return.
+        :return: The matching runs, most recent first.
+        """
+        query = fts_query(text)
+        if not query:
+            return self.recent(limit)
+        columns = ", ".join(f"runs.{column.strip()}" for column in SUMMARY_COLUMNS.split(","))
+        # Ordering by rowid walks the FTS index backwards instead of sorting every match.
+        return self._rows(f"SELECT {columns} FROM runs_fts JOIN runs ON runs.id = runs_fts.rowid "
+                          "WHERE runs_fts MATCH ? ORDER BY runs_fts.rowid DESC LIMIT ?", (query, limit))
+
+    def recent(self, limit: int = 20) -> List[dict]:
+        """
+        :param limit: The maximum number of runs to return.
+        :return: The latest runs, most recent first.
+        """
+        return self._rows(f"SELECT {SUMMARY_COLUMNS} FROM runs ORDER BY id DESC LIMIT ?", (limit,))
+
+    def get(self, run_id: int) -> Optional[dict]:
+        """
+        :param run_id: The id of a run.
+        :return: Every column of the run with its full output, or None if there is no such run.
+        """
+        rows = self._rows("SELECT * FROM runs WHERE id = ?", (run_id,))
+        if not rows:
+            return None
+        run = rows[0]
+        if run["stdout"] is None:
+            blob = self.connection.execute("SELECT data FROM blobs WHERE digest = ?",
+                                           (run["stdout_digest"],)).fetchone()
+            run["stdout"] = zlib.decompress(blob[0]).decode("utf-8") if blob else ""
+        run["stage_times"] = json.loads(run["stage_times"])
+        return run
+
+    def close(self) -> None:
+        self.connection.close()
+
+
+class HistoryWriter:
+    """
+    Writes runs to a HistoryStore from a background thread.
+
+    `record` only queues the run, so a request never waits for the disk;
+    the writer commits whatever is queued in one transaction. Queued runs
+    are written before the process exits.
+    """
+    def __init__(self, path: Path):
+        """
+        Initializes a HistoryWriter object and starts its thread.
+
+        :param path: The path of the database.
+        """
+        self.path = Path(path)
+        self.queue: "queue.Queue[Optional[RunRecord]]" = queue.Queue()
+        self.thread = threading.Thread(target=self._run, name="gpttrace-history", daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def record(self, record: RunRecord) -> None:
+        """
+        Queues a run to be written.
+
+        :param record: The run.
+        """
+        self.queue.put(record)
+
+    def _run(self) -> None:
+        store = None
+        running = True
+        while running:
+            batch = [self.queue.get()]
+            while len(batch) < WRITE_BATCH_SIZE:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if None in batch:
+                running = False
+            records = [record for record in batch if record is not None]
+            try:
+                if records:
+                    if store is None:
+                        store = HistoryStore(self.path)
+                    store.add(records)
+            except Exception as err:
+                # Losing history must not break tracing, nor stop the thread that `flush` waits for.
+                print(f"Could not record the run history: {type(err).__name__}: {err}")
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+        if store is not None:
+            store.close()
+
+    def flush(self) -> None:
+        """
+        Waits until every queued run is written.
+        """
+        self.queue.join()
+
+    def close(self) -> None:
+        """
+        Writes the queued runs and stops the thread.
+        """
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+
+_writers: Dict[str, HistoryWriter] = {}
+_writers_lock = threading.Lock()
+
+
+def get_history_writer(path: Path) -> HistoryWriter:
+    """
+    :param path: The path of the database.
+    :return: The writer of the database, started once per process.
+    """
+    with _writers_lock:
+        writer = _writers.get(str(path))
+        if writer is None or not writer.thread.is_alive():
+            writer = _writers[str(path)] = HistoryWriter(path)
+        return writer
+
+
+def close_history_writer(path: Path) -> None:
+    """
+    Writes the queued runs of a database and stops its writer, if it was started.
+
+    :param path: The path of the database.
+    """
+    with _writers_lock:
+        writer = _writers.pop(str(path), None)
+    if writer is not None:
+        writer.close()
+
+
+def format_runs(runs: List[dict]) -> str:
+    """
+    :param runs: Runs as returned by `search` or `recent`.
+    :return: A table of the runs, one line each.
+    """
+    lines = []
+    for run in runs:
+        started = time.strftime("%Y-%m-%d %H:%M", time.localtime(run["started"]))
+        program = " ".join(run["program"].split())
+        lines.append(f"{run['id']:>6}  {started}  {run['status']:<8}  {run['request'][:40]:<40}  {program[:60]}")
+    return "\n".join(lines)
+
+
+def _run_record(request: str, program: str, stdout: str = "", started: float = 0.0) -> RunRecord:
+    return {"started": started, "request": request, "program": program, "command": f"bpftrace -e '{program}'",
+            "status": "ok", "returncode": 0, "stderr": "", "stdout": stdout, "explanation": "fine",
+            "attempts": 1, "model": "gpt-3.5-turbo", "prompt_tokens": 100, "completion_tokens": 20,
+            "stage_times": {"exec": 1.5}}
+
+
+class TestHistory(unittest.TestCase):
+    def test_bad_record_does_not_stop_the_writer(self):
+        with tempfile.TemporaryDirectory() as data_dir:
+            path = Path(data_dir) / "history.sqlite3"
+            writer = HistoryWriter(path)
+            bad = dict(_run_record("bad", ""), stage_times={"exec": object()})
+            with mock.patch("sys.stdout", io.StringIO()) as output:
+                writer.record(bad)
+                writer.flush()
+            self.assertIn("Could not record the run history: TypeError", output.getvalue())
+            writer.record(_run_record("good", ""))
+            writer.close()
+            store = HistoryStore(path)
+            self.assertEqual([run["request"] for run in store.recent()], ["good"])
+            store.close()
+
+    def test_search_and_outputs(self):
+        with tempfile.TemporaryDirectory() as data_dir:
+            path = Path(data_dir) / "history.sqlite3"
+            writer = HistoryWriter(path)
+            large = "4001 cat /etc/passwd\n" * 1000
+            writer.record(_run_record("Count page faults by process", "software:page-faults:1 { @[comm] = count(); }"))
+            writer.record(_run_record("Which files are opened", "tracepoint:syscalls:sys_enter_openat {}", large))
+            writer.record(_run_record("Files opened by cat", "tracepoint:syscalls:sys_enter_openat {}", large))
+            writer.close()
+            store = HistoryStore(path)
+            self.assertEqual(stat.S_IMODE(os.stat(path).st_mode), 0o600)
+            self.assertEqual([run["id"] for run in store.search("open")], [3, 2])
+            self.assertEqual([run["id"] for run in store.search("page-faults count")], [1])
+            self.assertEqual([run["id"] for run in store.search("cat openat")], [3])
+            self.assertEqual([run["id"] for run in store.recent(2)], [3, 2])
+            run = store.get(2)
+            self.assertEqual(run["stdout"], large)
+            self.assertEqual(run["stage_times"], {"exec": 1.5})
+            self.assertIsNone(store.get(4))
+            # The two identical outputs are stored once, compressed.
+            count, size = store.connection.execute("SELECT COUNT(*), SUM(LENGTH(data)) FROM blobs").fetchone()
+            self.assertEqual(count, 1)
+            self.assertLess(size, len(large) // 10)
+            store.close()
@@ -0,0 +1,478 @@
+import asyncio
+import atexit
+import json
+import queue
+import random
+import threading
+import time
+import unittest
+from contextlib import asynccontextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, AsyncIterator, Awaitable, Iterator, List, Optional, TypeVar
+
+import aiohttp
+
+from gpttrace.config import cfg
+
+# Statuses worth retrying: rate limiting and transient server errors.
+RETRY_STATUSES = {408, 409, 429, 500, 502, 503, 504}
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 8.0
+# Seconds an idle pooled connection is kept open.
+KEEPALIVE_TIMEOUT = 60
+
+T = TypeVar("T")
+
+_client = None
+_loop_thread = None
+_lock = threading.Lock()
+
+
+class LLMError(Exception):
+    """
+    A model call failed for good: a non-retryable status, or retries or time ran out.
+    """
+    def __init__(self, message: str, status: Optional[int] = None):
+        """
+        Initializes a LLMError object.
+
+        :param message: What went wrong.
+        :param status: The HTTP status of the last response, if there was one.
+        """
+        super().__init__(message)
+        self.status = status
+
+
+class LLMClient:
+    """
+    An async client for OpenAI compatible chat completion APIs.
+
+    Connections are pooled and kept alive, each call has a deadline that
+    covers all of its retries, rate limiting and server errors are retried
+    with jittered exponential backoff (honoring `Retry-After`), and a
+    semaphore bounds the number of calls in flight.
+    """
+    def __init__(self, api_base: str, api_key: str, timeout: float = 60, max_retries: int = 5,
+                 concurrency: int = 8):
+        """
+        Initializes a LLMClient object. The HTTP session is opened on first use.
+
+        :param api_base: The base URL of the API, e.g. `https://api.openai.com/v1`.
+        :param api_key: The API key, sent as a bearer token.
+        :param timeout: The default deadline of a call in seconds, retries included.
+        :param max_retries: The number of retries after the first try.
+        :param concurrency: The maximum number of calls in flight.
+        """
+        self.api_base = api_base.rstrip("/")
+        self.api_key = api_key
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.concurrency = concurrency
+        self.counters = {"calls": 0, "retries": 0, "failures": 0}
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.concurrency, keepalive_timeout=KEEPALIVE_TIMEOUT)
+            self._session = aiohttp.ClientSession(connector=connector, headers={
+                "Authorization": f"Bearer {self.api_key}",
+                "Content-Type": "application/json",
+            })
+        return self._session
+
+    def limiter(self) -> asyncio.Semaphore:
+        """
+        :return: The semaphore that bounds the calls in flight.
+        """
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        return self._semaphore
+
+    async def chat(self, messages: List[dict], model: str, timeout: Optional[float] = None,
+                   **params: Any) -> dict:
+        """
+        Requests a chat completion.
+
+        :param messages: The conversation.
+        :param model: The model to use.
+        :param timeout: The deadline of the call in seconds, retries included.
+        :param params: Other request fields, e.g. `functions`, `function_call`, `n`, `max_tokens`.
+        :return: The response, with `choices` and `usage`.
+        """
+        payload = dict(params, model=model, messages=messages)
+        async with self._post("/chat/completions", payload, self._deadline(timeout)) as response:
+            return await response.json()
+
+    async def stream_chat(self, messages: List[dict], model: str, timeout: Optional[float] = None,
+                          **params: Any) -> AsyncIterator[str]:
+        """
+        Requests a chat completion as server-sent events and yields its text as it arrives.
+
+        Only the request is retried; once text has been yielded a failure is raised.
+
+        :param messages: The conversation.
+        :param model: The model to use.
+        :param timeout: The deadline of the whole call in seconds, retries and streaming included.
+        :param params: Other request fields, e.g. `max_tokens`.
+        :return: The text deltas of the first choice.
+        """
+        payload = dict(params, model=model, messages=messages, stream=True)
+        async with self._post("/chat/completions", payload, self._deadline(timeout)) as response:
+            try:
+                async for line in response.content:
+                    line = line.strip()
+                    if not line.startswith(b"data:"):
+                        continue
+                    data = line[len(b"data:"):].strip()
+                    if data == b"[DONE]":
+                        break
+                    for choice in json.loads(data).get("choices", []):
+                        delta = choice.get("delta", {}).get("content")
+                        if delta and choice.get("index", 0) == 0:
+                            yield delta
+            except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+                self.counters["failures"] += 1
+                raise LLMError(f"stream interrupted: {type(err).__name__}: {err}") from None
+
+    def _deadline(self, timeout: Optional[float]) -> float:
+        return asyncio.get_running_loop().time() + (timeout if timeout is not None else self.timeout)
+
+    @asynccontextmanager
+    async def _post(self, path: str, payload: dict, deadline: float) -> AsyncIterator[aiohttp.ClientResponse]:
+        """
+        Sends a request, retrying until it gets a 200 response or the deadline passes.
+
+        A slot of the concurrency limit is held while a request is in flight,
+        until the body of the response is read, but not while backing off.
+
+        :param path: The API path, e.g. `/chat/completions`.
+        :param payload: The JSON body.
+        :param deadline: The event loop time at which to give up.
+        :return: The 200 response, whose body is still to be read.
+        """
+        session = self._get_session()
+        loop = asyncio.get_running_loop()
+        self.counters["calls"] += 1
+        error = LLMError("deadline exceeded")
+        for attempt in range(self.max_retries + 1):
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            retry_after = None
+            async with self.limiter():
+                response = None
+                try:
+                    response = await session.post(self.api_base + path, json=payload,
+                                                  timeout=aiohttp.ClientTimeout(total=remaining))
+                    if response.status != 200:
+                        async with response:
+                            body = await response.text()
+                        error = LLMError(f"{response.status}: {body[:500]}", response.status)
+                        retry_after = _parse_retry_after(response.headers.get("Retry-After"))
+                except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+                    error = LLMError(f"{type(err).__name__}: {err}")
+                    response = None
+                if response is not None and response.status == 200:
+                    # Outside the try, so errors while reading the body are not retried.
+                    async with response:
+                        yield response
+                    return
+            if error.status is not None and error.status not in RETRY_STATUSES:
+                break
+            if attempt == self.max_retries:
+                break
+            # Full jitter spreads out clients that were throttled at the same time.
+            delay = random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+            if retry_after is not None:
+                delay = max(delay, retry_after)
+            if loop.time() + delay >= deadline:
+                error = LLMError(f"deadline exceeded, last error: {error}", error.status)
+                break
+            self.counters["retries"] += 1
+            await asyncio.sleep(delay)
+        self.counters["failures"] += 1
+        raise error
+
+    async def close(self) -> None:
+        """
+        Closes the pooled connections.
+        """
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+def _parse_retry_after(value: Optional[str]) -> Optional[float]:
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+class _LoopThread:
+    """
+    An event loop running in a daemon thread, so synchronous code can share
+    one client and its connection pool.
+    """
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="gpttrace-llm", daemon=True)
+        self.thread.start()
+
+
+
+def get_client() -> LLMClient:
+    """
+    Gets the client configured in `cfg`, creating it once per process.
+
+    :return: The client.
+    """
+    global _client
+    with _lock:
+        if _client is None:
+            _client = LLMClient(cfg.get("OPENAI_API_BASE"), cfg.get("OPENAI_API_KEY"),
+                                float(cfg.get("LLM_TIMEOUT")), int(cfg.get("LLM_MAX_RETRIES")),
+                                int(cfg.get("LLM_CONCURRENCY")))
+        return _client
+
+
+def run_sync(coro: Awaitable[T]) -> T:
+    """
+    Runs a coroutine on the shared background event loop and waits for its result.
+
+    :param coro: The coroutine.
+    :return: Its result.
+    """
+    return asyncio.run_coroutine_threadsafe(coro, _get_loop()).result()
+
+
+def _get_loop() -> asyncio.AbstractEventLoop:
+    global _loop_thread
+    with _lock:
+        if _loop_thread is None:
+            _loop_thread = _LoopThread()
+            atexit.register(_close_client)
+    return _loop_thread.loop
+
+
+def _close_client() -> None:
+    if _client is not None:
+        asyncio.run_coroutine_threadsafe(_client.close(), _loop_thread.loop).result(timeout=5)
+
+
+def chat(messages: List[dict], model: str, timeout: Optional[float] = None, **params: Any) -> dict:
+    """
+    Requests a chat completion from synchronous code, see `LLMClient.chat`.
+
+    :param messages: The conversation.
+    :param model: The model to use.
+    :param timeout: The deadline of the call in seconds, retries included.
+    :param params: Other request fields, e.g. `functions`, `function_call`, `n`, `max_tokens`.
+    :return: The response, with `choices` and `usage`.
+    """
+    return run_sync(get_client().chat(messages, model, timeout, **params))
+
+
+def stream_chat(messages: List[dict], model: str, timeout: Optional[float] = None,
+                **params: Any) -> Iterator[str]:
+    """
+    Streams a chat completion to synchronous code, see `LLMClient.stream_chat`.
+
+    :param messages: The conversation.
+    :param model: The model to use.
+    :param timeout: The deadline of the whole call in seconds.
+    :param params: Other request fields, e.g. `max_tokens`.
+    :return: The text deltas as they arrive.
+    """
+    deltas: "queue.Queue[Any]" = queue.Queue()
+    done = object()
+
+    async def pump() -> None:
+        try:
+            async for delta in get_client().stream_chat(messages, model, timeout, **params):
+                deltas.put(delta)
+        except Exception as err:
+            deltas.put(err)
+        finally:
+            deltas.put(done)
+
+    asyncio.run_coroutine_threadsafe(pump(), _get_loop())
+    while True:
+        item = deltas.get()
+        if item is done:
+            return
+        if isinstance(item, Exception):
+            raise item
+        yield item
+
+
+def chat_litellm(messages: List[dict], model: str, timeout: Optional[float] = None) -> dict:
+    """
+    Requests a chat completion from a provider litellm supports, with the same
+    deadline and concurrency limit as the other calls.
+
+    :param messages: The conversation.
+    :param model: The litellm model name, e.g. `claude-instant-1`.
+    :param timeout: The deadline of the call in seconds.
+    :return: The response, with `choices`.
+    """
+    client = get_client()
+
+    async def call() -> dict:
+        from litellm import completion
+        async with client.limiter():
+            loop = asyncio.get_running_loop()
+            future = loop.run_in_executor(None, lambda: completion(model=model, messages=messages))
+            try:
+                return await asyncio.wait_for(future, timeout if timeout is not None else client.timeout)
+            except asyncio.TimeoutError:
+                raise LLMError("deadline exceeded") from None
+
+    return run_sync(call())
+
+
+class _FakeChatServer(BaseHTTPRequestHandler):
+    """
+    A stand-in chat completion API that fails the first `failures` requests.
+    """
+    failures = 0
+    delay = 0.0
+    requests = 0
+    lock = threading.Lock()
+
+    def do_POST(self) -> None:
+        payload = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        if payload["model"] == "missing":
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        with self.lock:
+            type(self).requests += 1
+            fail = type(self).failures > 0
+            type(self).failures -= 1 if fail else 0
+        time.sleep(self.delay)
+        if fail:
+            self.send_response(429 if self.requests % 2 else 503)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        if payload.get("stream"):
+            self._stream(payload["messages"][-1]["content"])
+            return
+        body = json.dumps({
+            "choices": [{"message": {"role": "assistant", "content": payload["messages"][-1]["content"]}}],
+            "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2},
+        }).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        try:
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            # The client gave up, e.g. its deadline passed.
+            pass
+
+    def _stream(self, content: str) -> None:
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.end_headers()
+        for word in content.split(" "):
+            chunk = {"choices": [{"index": 0, "delta": {"content": word + " "}}]}
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+            time.sleep(self.delay)
+        self.wfile.write(b"data: [DONE]\n\n")
+
+    def log_message(self, *args: Any) -> None:
+        pass
+
+
+class TestLLMClient(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), _FakeChatServer)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.api_base = f"http://127.0.0.1:{self.server.server_address[1]}/v1"
+        _FakeChatServer.failures, _FakeChatServer.delay, _FakeChatServer.requests = 0, 0.0, 0
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_throughput_and_tail_latency_with_failures(self):
+        _FakeChatServer.failures = 20
+        _FakeChatServer.delay = 0.005
+        client = LLMClient(self.api_base, "key", timeout=30, concurrency=8)
+
+        async def one(i: int) -> float:
+            start = time.perf_counter()
+            response = await client.chat([{"role": "user", "content": str(i)}], "model")
+            self.assertEqual(response["choices"][0]["message"]["content"], str(i))
+            return time.perf_counter() - start
+
+        async def run() -> List[float]:
+            try:
+                return await asyncio.gather(*[one(i) for i in range(100)])
+            finally:
+                await client.close()
+
+        start = time.perf_counter()
+        latencies = sorted(asyncio.run(run()))
+        elapsed = time.perf_counter() - start
+        print(f"{100 / elapsed:.0f} calls/s, p50 {latencies[50] * 1000:.0f} ms, "
+              f"p99 {latencies[98] * 1000:.0f} ms, {client.counters}")
+        self.assertEqual(client.counters["retries"], 20)
+        self.assertEqual(client.counters["failures"], 0)
+        self.assertEqual(_FakeChatServer.requests, 120)
+
+    def test_deadline_and_fatal_status(self):
+        _FakeChatServer.delay = 1.0
+        client = LLMClient(self.api_base, "key", timeout=0.2)
+
+        async def call() -> dict:
+            try:
+                return await client.chat([{"role": "user", "content": "x"}], "model")
+            finally:
+                await client.close()
+
+        start = time.perf_counter()
+        with self.assertRaises(LLMError):
+            asyncio.run(call())
+        self.assertLess(time.perf_counter() - start, 1.0)
+
+    def test_client_error_is_not_retried(self):
+        client = LLMClient(self.api_base, "key", timeout=5)
+
+        async def call() -> dict:
+            try:
+                return await client.chat([{"role": "user", "content": "x"}], "missing")
+            finally:
+                await client.close()
+
+        with self.assertRaises(LLMError) as context:
+            asyncio.run(call())
+        self.assertEqual(context.exception.status, 404)
+        self.assertEqual(client.counters["retries"], 0)
+
+    def test_stream(self):
+        _FakeChatServer.failures = 1
+        _FakeChatServer.delay = 0.05
+        client = LLMClient(self.api_base, "key", timeout=10)
+
+        async def call() -> List[tuple]:
+            start = time.perf_counter()
+            arrivals = []
+            try:
+                async for delta in client.stream_chat([{"role": "user", "content": "a b c d"}], "model"):
+                    arrivals.append((delta, time.perf_counter() - start))
+            finally:
+                await client.close()
+            return arrivals
+
+        arrivals = asyncio.run(call())
+        self.assertEqual("".join(delta for delta, _ in arrivals), "a b c d ")
+        # The first token arrives well before the last one.
+        self.assertLess(arrivals[0][1], arrivals[-1][1] - 0.1)
+        self.assertEqual(client.counters["retries"], 1)
@@ -0,0 +1,156 @@
+import json
+import os
+import tempfile
+import threading
+import unittest
+from pathlib import Path
+from typing import Dict, List
+
+# The tiers, cheapest first.
+FAST = "fast"
+STRONG = "strong"
+# The error of a function call whose arguments are not valid JSON.
+PARSE_ERROR = "ERROR: invalid function call arguments"
+
+_save_lock = threading.Lock()
+
+
+class ModelRouter:
+    """
+    Picks the model of each generation attempt and keeps per-tier statistics.
+
+    Attempts start on the fast tier and move to the strong tier for the
+    rest of the request once `escalate_after` attempts have failed, or as
+    soon as the model returns function call arguments that do not parse.
+    The latency, success and token spend of each tier are added to a JSON
+    file, so the statistics cover every run.
+    """
+    def __init__(self, path: Path, fast_model: str, strong_model: str, escalate_after: int = 2):
+        """
+        Initializes a ModelRouter object.
+
+        :param path: The path of the statistics file.
+        :param fast_model: The model of the fast tier.
+        :param strong_model: The model of the strong tier.
+        :param escalate_after: The number of failed attempts after which the strong tier is used.
+        """
+        self.path = Path(path)
+        self.models = {FAST: fast_model, STRONG: strong_model}
+        self.escalate_after = escalate_after
+        self.pending = {tier: _empty_stats() for tier in self.models}
+
+    def tier(self, attempts: List[dict]) -> str:
+        """
+        :param attempts: The failed attempts of the request so far, as recorded by `execute`.
+        :return: The tier of the next attempt.
+        """
+        failures = [record for record in attempts if record["stderr"] != ""]
+        if any(record["stderr"].startswith(PARSE_ERROR) for record in failures):
+            return STRONG
+        # With several candidates per attempt, each failed candidate has its own record.
+        failed_attempts = {record["attempt"] for record in failures}
+        if self.escalate_after > 0 and len(failed_attempts) >= self.escalate_after:
+            return STRONG
+        return FAST
+
+    def model(self, tier: str) -> str:
+        """
+        :param tier: `FAST` or `STRONG`.
+        :return: The model of the tier.
+        """
+        return self.models[tier]
+
+    def record(self, tier: str, latency: float, tokens: int, success: bool) -> None:
+        """
+        Counts one attempt of a tier; `save` adds the counts to the statistics file.
+
+        :param tier: The tier the attempt used.
+        :param latency: Seconds spent waiting for the model.
+        :param tokens: The tokens the attempt used.
+        :param success: Whether the program of the attempt ran without error.
+        """
+        stats = self.pending[tier]
+        stats["attempts"] += 1
+        stats["successes"] += int(success)
+        stats["latency"] += latency
+        stats["tokens"] += tokens
+
+    def save(self) -> None:
+        """
+        Adds the pending counts to the statistics file.
+        """
+        if not any(stats["attempts"] for stats in self.pending.values()):
+            return
+        with _save_lock:
+            saved = self.load()
+            for tier, pending in self.pending.items():
+                stats = saved.setdefault(tier, _empty_stats())
+                for key in ("attempts", "successes", "latency", "tokens"):
+                    stats[key] += pending[key]
+                stats["model"] = self.models[tier]
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=self.path.parent, prefix=self.path.name + ".")
+            with os.fdopen(fd, "w", encoding="utf-8") as file:
+                json.dump(saved, file, indent=2)
+            os.replace(tmp_path, self.path)
+        self.pending = {tier: _empty_stats() for tier in self.models}
+
+    def load(self) -> Dict[str, dict]:
+        """
+        :return: The saved totals of each tier.
+        """
+        if not self.path.exists():
+            return {}
+        with open(self.path, "r", encoding="utf-8") as file:
+            return json.load(file)
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        """
+        :return: The success rate, mean latency and tokens per attempt of each tier, pending counts included.
+        """
+        summary = {}
+        saved = self.load()
+        for tier in self.models:
+            stats = _empty_stats()
+            for source in (saved.get(tier, {}), self.pending[tier]):
+                for key in stats:
+                    stats[key] += source.get(key, 0)
+            attempts = stats["attempts"]
+            summary[tier] = {
+                "model": self.models[tier],
+                "attempts": attempts,
+                "success_rate": stats["successes"] / attempts if attempts else 0.0,
+                "mean_latency": stats["latency"] / attempts if attempts else 0.0,
+                "tokens_per_attempt": stats["tokens"] / attempts if attempts else 0.0,
+            }
+        return summary
+
+
+def _empty_stats() -> dict:
+    return {"attempts": 0, "successes": 0, "latency": 0.0, "tokens": 0}
+
+
+class TestModelRouter(unittest.TestCase):
+    def test_escalation_and_stats(self):
+        failed = [{"attempt": attempt, "stderr": "stdin:1:1: ERROR: unknown function"} for attempt in (1, 2)]
+        with tempfile.TemporaryDirectory() as data_dir:
+            path = Path(data_dir) / "model_stats.json"
+            router = ModelRouter(path, "cheap", "smart", escalate_after=2)
+            self.assertEqual(router.tier([]), FAST)
+            self.assertEqual(router.tier(failed[:1]), FAST)
+            # Three failed candidates of one attempt are one failed attempt.
+            self.assertEqual(router.tier(failed[:1] * 3), FAST)
+            self.assertEqual(router.tier(failed), STRONG)
+            self.assertEqual(router.tier([{"attempt": 1, "stderr": PARSE_ERROR + ": Expecting value"}]), STRONG)
+            self.assertEqual(router.model(STRONG), "smart")
+            router.record(FAST, 1.0, 100, False)
+            router.record(STRONG, 3.0, 300, True)
+            router.save()
+            other = ModelRouter(path, "cheap", "smart")
+            other.record(FAST, 2.0, 200, True)
+            other.save()
+            stats = ModelRouter(path, "cheap", "smart").stats()
+        self.assertEqual(stats[FAST]["attempts"], 2)
+        self.assertEqual(stats[FAST]["success_rate"], 0.5)
+        self.assertEqual(stats[FAST]["mean_latency"], 1.5)
+        self.assertEqual(stats[STRONG]["tokens_per_attempt"], 300)
@@ -0,0 +1,389 @@
+import fnmatch
+import math
+import os
+import re
+import unittest
+from typing import Dict, List, Optional, Tuple, TypedDict
+
+from gpttrace.validate import _header_probes, program_blocks, static_check
+
+# Expected events per second of a probe on a busy host, first matching pattern wins.
+# kretprobe, kfunc and kretfunc are looked up as kprobe, and uretprobe as uprobe.
+PROBE_RATES: List[Tuple[str, float]] = [
+    ("tracepoint:raw_syscalls:*", 1e6),
+    # A wildcard over all system calls.
+    ("tracepoint:syscalls:sys_*[*]", 1e6),
+    ("tracepoint:syscalls:sys_*_futex*", 2e5),
+    ("tracepoint:syscalls:sys_*_*read*", 2e5),
+    ("tracepoint:syscalls:sys_*_*write*", 1e5),
+    ("tracepoint:syscalls:sys_*_*poll*", 1e5),
+    ("tracepoint:syscalls:sys_*_*recv*", 1e5),
+    ("tracepoint:syscalls:sys_*_*send*", 1e5),
+    ("tracepoint:syscalls:sys_*_*open*", 2e4),
+    ("tracepoint:syscalls:sys_*_close", 2e4),
+    ("tracepoint:syscalls:sys_*_exec*", 100),
+    ("tracepoint:syscalls:sys_*_clone*", 100),
+    ("tracepoint:syscalls:sys_*_*fork", 100),
+    ("tracepoint:syscalls:sys_*_kill", 10),
+    ("tracepoint:syscalls:*", 1e4),
+    ("tracepoint:sched:sched_switch", 1e5),
+    ("tracepoint:sched:sched_wakeup*", 5e4),
+    ("tracepoint:sched:sched_process_*", 100),
+    ("tracepoint:sched:*", 2e4),
+    ("tracepoint:irq:*", 5e4),
+    ("tracepoint:timer:*", 1e5),
+    ("tracepoint:kmem:*", 2e5),
+    ("tracepoint:exceptions:page_fault*", 1e5),
+    ("tracepoint:net:*", 1e5),
+    ("tracepoint:skb:*", 1e5),
+    ("tracepoint:block:*", 5e3),
+    ("tracepoint:tcp:tcp_probe", 1e4),
+    ("tracepoint:tcp:*", 100),
+    ("tracepoint:sock:*", 1e3),
+    ("tracepoint:signal:*", 100),
+    ("tracepoint:oom:*", 0.1),
+    ("tracepoint:*", 1e3),
+    ("kprobe:vfs_*", 1e5),
+    ("kprobe:*schedule*", 1e5),
+    ("kprobe:*alloc*", 2e5),
+    ("kprobe:*free*", 2e5),
+    ("kprobe:tcp_*", 1e4),
+    ("kprobe:*", 1e4),
+    ("uprobe:*malloc", 1e6),
+    ("uprobe:*free", 1e6),
+    ("uprobe:*", 1e3),
+    ("usdt:*", 1e3),
+    ("watchpoint:*", 1e3),
+    ("asyncwatchpoint:*", 1e3),
+]
+# Events per second of a software or hardware event before its count divides it, and the default counts.
+PERF_EVENT_RATES = {"software": (1e6, 1000), "hardware": (1e9, 1000000)}
+PROBE_ALIASES = {
+    "k": "kprobe", "kr": "kprobe", "kretprobe": "kprobe", "f": "kprobe", "fr": "kprobe", "kfunc": "kprobe",
+    "kretfunc": "kprobe", "fentry": "kprobe", "fexit": "kprobe", "u": "uprobe", "ur": "uprobe",
+    "uretprobe": "uprobe", "t": "tracepoint", "rt": "tracepoint", "rawtracepoint": "tracepoint",
+    "U": "usdt", "p": "profile", "i": "interval", "s": "software", "h": "hardware", "w": "watchpoint",
+    "aw": "asyncwatchpoint", "it": "iter",
+}
+PERIOD_UNITS = {"s": 1.0, "ms": 1e-3, "us": 1e-6, "ns": 1e-9}
+# Blocks that fire more often than this should not print on every event.
+HOT_EVENTS_PER_SEC = 1000
+# Output events per second a sampled block is cut down to.
+SAMPLED_EVENTS_PER_SEC = 100
+# The scratch variable that holds the random draw of a sampled block.
+SAMPLE_VARIABLE = "$__sample"
+# Statements that send data to user space on every event.
+OUTPUT_CALLS = ("printf", "print", "cat", "system", "time", "join")
+# printf arguments with few distinct values, which can key a map without it growing with every event.
+LOW_CARDINALITY_ARGUMENT = re.compile(r"^(comm|probe|func|cpu|uid|gid)$")
+# printf arguments that identify rather than measure, so they cannot be summarized with a histogram.
+ID_ARGUMENT = re.compile(r"^(pid|tid|cgroup|\w*stack.*|.*\b(fd|id|dev|port)\w*)$")
+STRING = re.compile(r'"(?:\\.|[^"\\])*"')
+FORMAT_SPEC = re.compile(r"%[-+ #0]*\d*(?:\.\d+)?(?:hh|h|ll|l|z|j|t)?([a-zA-Z%])")
+
+
+class BlockReport(TypedDict):
+    probes: List[str]
+    # expected events per second of all the probes of the block
+    events_per_sec: float
+    # whether the block sends data to user space on every event
+    per_event_output: bool
+    # "aggregate", "sample" or "" if the block was left as it is
+    action: str
+    # output events per second after the action
+    output_per_sec: float
+
+
+class OverheadReport(TypedDict):
+    blocks: List[BlockReport]
+    # output events per second sent to user space before and after the rewrite
+    output_before: float
+    output_after: float
+    # the program with the hot per-event blocks rewritten, the same program if none was
+    program: str
+
+
+def probe_rate(probe: str) -> float:
+    """
+    Estimates how often a probe fires on a busy host.
+
+    :param probe: An attach point as written in a program, e.g. `t:syscalls:sys_enter_read`.
+    :return: The expected events per second.
+    """
+    parts = probe.strip().split(":")
+    probe_type = PROBE_ALIASES.get(parts[0], parts[0])
+    if probe_type in ("BEGIN", "END", "iter", "self"):
+        return 0.0
+    if probe_type in ("profile", "interval"):
+        if len(parts) < 3 or parts[1] not in PERIOD_UNITS and parts[1] != "hz":
+            return 1.0
+        try:
+            value = float(parts[2])
+        except ValueError:
+            return 1.0
+        per_cpu = value if parts[1] == "hz" else 1 / max(value * PERIOD_UNITS[parts[1]], 1e-9)
+        # profile fires on every CPU, interval on one.
+        return per_cpu * (os.cpu_count() or 1) if probe_type == "profile" else per_cpu
+    if probe_type in PERF_EVENT_RATES:
+        rate, default_count = PERF_EVENT_RATES[probe_type]
+        try:
+            count = float(parts[2]) if len(parts) > 2 else default_count
+        except ValueError:
+            count = default_count
+        return rate / max(count, 1)
+    normalized = ":".join([probe_type] + parts[1:])
+    for pattern, rate in PROBE_RATES:
+        if fnmatch.fnmatchcase(normalized, pattern):
+            return rate
+    return float(HOT_EVENTS_PER_SEC)
+
+
+def _split_arguments(text: str) -> List[str]:
+    """
+    :param text: The text between the parentheses of a call.
+    :return: The arguments, split at top level commas.
+    """
+    arguments, depth, current, i = [], 0, "", 0
+    while i < len(text):
+        char = text[i]
+        if char == '"':
+            end = i + 1
+            while end < len(text) and text[end] != '"':
+                end += 2 if text[end] == "\\" else 1
+            current += text[i:end + 1]
+            i = end + 1
+            continue
+        if char in "([{":
+            depth += 1
+        elif char in ")]}":
+            depth -= 1
+        if char == "," and depth == 0:
+            arguments.append(current.strip())
+            current = ""
+        else:
+            current += char
+        i += 1
+    if current.strip():
+        arguments.append(current.strip())
+    return arguments
+
+
+def _find_calls(body: str, name: str) -> List[Tuple[int, int, str]]:
+    """
+    :param body: The code of a block.
+    :param name: A function name.
+    :return: The start and end of each call statement, trailing ";" included, and its arguments text.
+    """
+    # Blank string contents so that neither names nor parentheses in them count.
+    masked = STRING.sub(lambda match: '"' + " " * (len(match.group()) - 2) + '"', body)
+    calls = []
+    for match in re.finditer(rf"(?<![\w@$.>]){name}\s*\(", masked):
+        depth, i = 1, match.end()
+        while i < len(masked) and depth:
+            depth += {"(": 1, ")": -1}.get(masked[i], 0)
+            i += 1
+        end = re.match(r"\s*;?", masked[i:]).end() + i
+        calls.append((match.start(), end, body[match.end():i - 1]))
+    return calls
+
+
+def aggregation(arguments: List[str], map_name: str) -> Optional[str]:
+    """
+    Turns a printf into a map aggregation with the same information.
+
+    Low cardinality arguments (comm, probe, cpu...) become the map key; the
+    first number is summarized with `hist()`, and without one the events
+    are counted. Other strings and identifiers (pid, fd, file names,
+    stacks...) would make the map grow with every event, so such a printf
+    is not aggregated.
+
+    :param arguments: The arguments of the printf, the format first.
+    :param map_name: The name of the map, e.g. "@opens".
+    :return: The aggregation statement, or None if the format cannot be matched to the arguments
+        or has an unbounded key.
+    """
+    if not arguments or not arguments[0].startswith('"'):
+        return None
+    conversions = [spec for spec in FORMAT_SPEC.findall(arguments[0]) if spec != "%"]
+    values = arguments[1:]
+    if len(conversions) != len(values):
+        return None
+    keys, measure = [], None
+    for conversion, value in zip(conversions, values):
+        if LOW_CARDINALITY_ARGUMENT.match(value):
+            keys.append(value)
+        elif conversion in "scr" or ID_ARGUMENT.match(value):
+            return None
+        elif measure is None:
+            measure = value
+    function = f"hist({measure})" if measure is not None else "count()"
+    key = f"[{', '.join(keys)}]" if keys else ""
+    return f"{map_name}{key} = {function};"
+
+
+def _map_name(probes: List[str], used: Dict[str, int]) -> str:
+    name = re.sub(r"\W+", "_", probes[0].split(":")[-1]).strip("_") or "events"
+    used[name] = used.get(name, 0) + 1
+    return f"@{name}" if used[name] == 1 else f"@{name}_{used[name]}"
+
+
+def _sampled_body(body: str, calls: List[Tuple[int, int, str]], every: int) -> str:
+    """
+    Wraps the output statements of a block in a random sampling condition.
+
+    Only the output is sampled: the other statements, e.g. the `delete()`
+    of a map that pairs entry and return probes, still run on every event.
+
+    :param body: The code of a block.
+    :param calls: The output calls of the block, as found by `_find_calls`.
+    :param every: Keep one event in this many.
+    :return: The body, drawing one random number per event for all its output statements.
+    """
+    statements, end = [], 0
+    for call_start, call_end, _ in sorted(calls):
+        # A call in the arguments of another one is sampled with it.
+        if call_start >= end:
+            statements.append((call_start, call_end))
+            end = call_end
+    for call_start, call_end in reversed(statements):
+        statement = body[call_start:call_end].rstrip()
+        if not statement.endswith(";"):
+            statement += ";"
+        body = f"{body[:call_start]}if ({SAMPLE_VARIABLE} == 0) {{ {statement} }}{body[call_end:]}"
+    return f" {SAMPLE_VARIABLE} = rand % {every};{body}"
+
+
+def analyze_program(program: str) -> OverheadReport:
+    """
+    Estimates how much data a program sends to user space and rewrites the blocks that send too much.
+
+    A block on probes expected to fire more than `HOT_EVENTS_PER_SEC` times a
+    second that prints on every event is rewritten: if its only output is
+    `printf`, each printf becomes a map aggregation that bpftrace prints at
+    exit; otherwise the output statements only run for a random sample of about
+    `SAMPLED_EVENTS_PER_SEC` events. Blocks that call `exit()` are left alone.
+
+    :param program: The bpftrace program.
+    :return: The estimates per block, before and after, and the rewritten program.
+    """
+    report: OverheadReport = {"blocks": [], "output_before": 0.0, "output_after": 0.0, "program": program}
+    if static_check(program) != "":
+        return report
+    rewritten, offset, used = program, 0, {}
+    for header, start, open_brace, close_brace in program_blocks(program):
+        probes = _header_probes(header)
+        rate = sum(probe_rate(probe) for probe in probes)
+        body = program[open_brace + 1:close_brace]
+        calls = {name: _find_calls(body, name) for name in OUTPUT_CALLS}
+        per_event = any(calls.values())
+        block: BlockReport = {"probes": probes, "events_per_sec": rate, "per_event_output": per_event,
+                              "action": "", "output_per_sec": rate if per_event else 0.0}
+        report["blocks"].append(block)
+        if not per_event or rate <= HOT_EVENTS_PER_SEC or _find_calls(body, "exit"):
+            continue
+        new_header, new_body = program[start:open_brace], body
+        printfs = calls["printf"]
+        statements = []
+        if len(printfs) == sum(len(found) for found in calls.values()):
+            statements = [aggregation(_split_arguments(arguments), _map_name(probes, used))
+                          for _, _, arguments in printfs]
+        if statements and None not in statements:
+            for (call_start, call_end, _), statement in reversed(list(zip(printfs, statements))):
+                new_body = new_body[:call_start] + statement + new_body[call_end:]
+            block["action"], block["output_per_sec"] = "aggregate", 0.0
+        else:
+            every = 10 ** math.ceil(math.log10(rate / SAMPLED_EVENTS_PER_SEC))
+            new_body = _sampled_body(body, [call for found in calls.values() for call in found], every)
+            block["action"], block["output_per_sec"] = "sample", rate / every
+        replacement = new_header + "{" + new_body + "}"
+        rewritten = rewritten[:start + offset] + replacement + rewritten[close_brace + 1 + offset:]
+        offset += len(replacement) - (close_brace + 1 - start)
+    report["output_before"] = sum(block["events_per_sec"] for block in report["blocks"]
+                                  if block["per_event_output"])
+    report["output_after"] = sum(block["output_per_sec"] for block in report["blocks"])
+    report["program"] = rewritten
+    return report
+
+
+def format_rate(rate: float) -> str:
+    """
+    :param rate: Events per second.
+    :return: The rate in a short form, e.g. "200k/s".
+    """
+    for divisor, suffix in ((1e6, "M"), (1e3, "k")):
+        if rate >= divisor:
+            return f"{rate / divisor:.3g}{suffix}/s"
+    return f"{rate:.3g}/s"
+
+
+def format_report(report: OverheadReport) -> str:
+    """
+    :param report: The result of `analyze_program`.
+    :return: A short description of the hot blocks and what was done about them.
+    """
+    lines = []
+    for block in report["blocks"]:
+        if block["per_event_output"] and block["events_per_sec"] > HOT_EVENTS_PER_SEC:
+            action = {"aggregate": "aggregated in a map", "sample": "sampled", "": "left as it is"}[block["action"]]
+            lines.append(f"{', '.join(block['probes'])}: ~{format_rate(block['events_per_sec'])} events "
+                         f"printed one by one, {action}")
+    lines.append(f"Estimated output to user space: ~{format_rate(report['output_before'])} -> "
+                 f"~{format_rate(report['output_after'])}")
+    return "\n".join(lines)
+
+
+class TestOverhead(unittest.TestCase):
+    def test_probe_rates(self):
+        self.assertEqual(probe_rate("tracepoint:raw_syscalls:sys_enter"), 1e6)
+        self.assertEqual(probe_rate("t:syscalls:sys_enter_read"), 2e5)
+        self.assertEqual(probe_rate("tracepoint:syscalls:sys_enter_*"), 1e6)
+        self.assertEqual(probe_rate("kretprobe:vfs_read"), 1e5)
+        self.assertEqual(probe_rate("interval:ms:100"), 10)
+        self.assertEqual(probe_rate("software:page-faults:100"), 1e4)
+        self.assertEqual(probe_rate("BEGIN"), 0)
+
+    def test_printf_becomes_aggregation(self):
+        program = ('BEGIN { printf("Tracing...\\n"); }\n'
+                   'tracepoint:block:block_rq_issue { printf("%s %d\\n", comm, args->bytes); }\n'
+                   'tracepoint:syscalls:sys_enter_read /comm == "nginx"/ { printf("%s\\n", comm); }')
+        report = analyze_program(program)
+        self.assertEqual(report["program"],
+                         'BEGIN { printf("Tracing...\\n"); }\n'
+                         'tracepoint:block:block_rq_issue { @block_rq_issue[comm] = hist(args->bytes); }\n'
+                         'tracepoint:syscalls:sys_enter_read /comm == "nginx"/ { @sys_enter_read[comm] = count(); }')
+        self.assertEqual([block["action"] for block in report["blocks"]], ["", "aggregate", "aggregate"])
+        self.assertEqual(report["output_before"], 2.05e5)
+        self.assertEqual(report["output_after"], 0)
+        self.assertEqual(static_check(report["program"]), "")
+
+    def test_other_output_is_sampled(self):
+        program = 'kprobe:vfs_read /pid > 1/ { time("%H:%M:%S "); printf("%s\\n", comm); }'
+        report = analyze_program(program)
+        self.assertEqual(report["program"],
+                         'kprobe:vfs_read /pid > 1/ { $__sample = rand % 1000; if ($__sample == 0) { time("%H:%M:%S "); } '
+                         'if ($__sample == 0) { printf("%s\\n", comm); } }')
+        self.assertEqual(static_check(report["program"]), "")
+        self.assertEqual(report["output_after"], 100)
+        self.assertIn("~100k/s -> ~100/s", format_report(report))
+        # A printf whose arguments do not match its format cannot be turned into a map.
+        report = analyze_program('kprobe:vfs_read { printf("%s %d\\n", comm); }')
+        self.assertEqual(report["blocks"][0]["action"], "sample")
+        # Nor one that prints unbounded keys, which would grow the map with every event.
+        for arguments in ['"%d %s\\n", pid, comm', '"%d %d\\n", $fd, args->count',
+                          '"%s %d\\n", str(args->filename), retval', '"%s\\n", kstack']:
+            self.assertIsNone(aggregation(_split_arguments(arguments), "@vfs_read"))
+        # Map updates still run on every event.
+        program = ('kprobe:vfs_read { @start[tid] = nsecs; }\n'
+                   'kretprobe:vfs_read /@start[tid]/ { print(@start[tid]); delete(@start[tid]) }')
+        report = analyze_program(program)
+        self.assertEqual(report["program"].splitlines()[1],
+                         'kretprobe:vfs_read /@start[tid]/ { $__sample = rand % 1000; '
+                         'if ($__sample == 0) { print(@start[tid]); } delete(@start[tid]) }')
+        report = analyze_program('kprobe:vfs_read { printf("print(%s)\\n", comm); }')
+        self.assertEqual(report["program"], 'kprobe:vfs_read { @vfs_read[comm] = count(); }')
+
+    def test_cold_or_bounded_programs_untouched(self):
+        for program in ['tracepoint:syscalls:sys_enter_execve { printf("%s\\n", comm); }',
+                        'kprobe:vfs_read { printf("%s\\n", comm); exit(); }',
+                        'kprobe:vfs_read { @[comm] = count(); } interval:s:1 { print(@); clear(@); }']:
+            self.assertEqual(analyze_program(program)["program"], program)
@@ -0,0 +1,176 @@
+import hashlib
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+import unittest
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Optional
+
+
+def normalize_request(text: str) -> str:
+    """
+    Normalize a user request so trivially different phrasings share a cache entry.
+
+    :param text: User request.
+    :return: The request in lower case, without punctuation and repeated spaces.
+    """
+    text = re.sub(r"[^\w\s]", " ", text.lower())
+    return " ".join(text.split())
+
+
+class ProgramCache:
+    """
+    A persistent LRU cache of generated bpftrace function calls.
+
+    Entries are keyed by the normalized request, the model and the prompt
+    version, and expire after `ttl` seconds. One cache may be shared by the
+    requests of several threads.
+    """
+    def __init__(self, path: Path, max_entries: int = 256, ttl: float = 7 * 24 * 3600):
+        """
+        Initializes a ProgramCache object and loads the cache file if it exists.
+
+        :param path: The path of the cache file.
+        :param max_entries: The number of entries kept before the least recently used is evicted.
+        :param ttl: The number of seconds an entry stays valid.
+        """
+        self.path = Path(path)
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries: "OrderedDict[str, dict]" = OrderedDict()
+        self.counters = {"hits": 0, "misses": 0, "evictions": 0}
+        self.lock = threading.RLock()
+        if self.path.exists():
+            with open(self.path, "r", encoding="utf-8") as file:
+                data = json.load(file)
+            self.entries = OrderedDict(data.get("entries", {}))
+            self.counters.update(data.get("counters", {}))
+
+    @staticmethod
+    def key(request: str, model: str, prompt_version: str) -> str:
+        """
+        Compute the cache key of a request.
+
+        :param request: User request.
+        :param model: The model that generates the program.
+        :param prompt_version: The version of the prompts used to generate the program.
+        :return: The cache key.
+        """
+        material = "\0".join([prompt_version, model, normalize_request(request)])
+        return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[dict]:
+        """
+        Look up a function call, counting the hit or miss.
+
+        :param key: The cache key, see `key`.
+        :return: The cached function call, or None.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and time.time() - entry["stored"] > self.ttl:
+                del self.entries[key]
+                entry = None
+            if entry is None:
+                self.counters["misses"] += 1
+                self._save()
+                return None
+            self.counters["hits"] += 1
+            self.entries.move_to_end(key)
+            self._save()
+            return entry["function_call"]
+
+    def put(self, key: str, request: str, function_call: dict) -> None:
+        """
+        Store the function call that last ran successfully for a request.
+
+        :param key: The cache key, see `key`.
+        :param request: User request, kept for inspection.
+        :param function_call: The function call, with its name and JSON arguments.
+        """
+        with self.lock:
+            self.entries[key] = {
+                "request": request,
+                "function_call": {"name": function_call["name"], "arguments": function_call["arguments"]},
+                "stored": time.time(),
+            }
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.counters["evictions"] += 1
+            self._save()
+
+    def invalidate(self, key: str) -> None:
+        """
+        Drop an entry, e.g. because the cached program failed.
+
+        :param key: The cache key, see `key`.
+        """
+        with self.lock:
+            if self.entries.pop(key, None) is not None:
+                self._save()
+
+    def stats(self) -> Dict[str, int]:
+        """
+        :return: The hit, miss and eviction counters and the number of entries.
+        """
+        with self.lock:
+            return dict(self.counters, entries=len(self.entries))
+
+    def _save(self) -> None:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.path.parent, prefix=self.path.name + ".")
+        with os.fdopen(fd, "w", encoding="utf-8") as file:
+            json.dump({"entries": self.entries, "counters": self.counters}, file)
+        os.replace(tmp_path, self.path)
+
+
+class TestProgramCache(unittest.TestCase):
+    call = {"name": "bpftrace", "arguments": '{"program": "software:faults:1 { @[comm] = count(); }"}'}
+
+    def test_hit_miss_and_persistence(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            path = Path(cache_dir) / "cache.json"
+            cache = ProgramCache(path)
+            key = ProgramCache.key("Count page faults by process.", "gpt-3.5-turbo", "1")
+            self.assertIsNone(cache.get(key))
+            cache.put(key, "Count page faults by process.", self.call)
+            cache = ProgramCache(path)
+            same = ProgramCache.key("count page  faults by process", "gpt-3.5-turbo", "1")
+            self.assertEqual(cache.get(same), self.call)
+            self.assertEqual(cache.stats(), {"hits": 1, "misses": 1, "evictions": 0, "entries": 1})
+            self.assertNotEqual(key, ProgramCache.key("count page faults by process", "gpt-4", "1"))
+
+    def test_lru_and_ttl(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = ProgramCache(Path(cache_dir) / "cache.json", max_entries=2, ttl=60)
+            for key in ["a", "b"]:
+                cache.put(key, key, self.call)
+            cache.get("a")
+            cache.put("c", "c", self.call)
+            self.assertEqual(list(cache.entries), ["a", "c"])
+            cache.entries["a"]["stored"] -= 120
+            self.assertIsNone(cache.get("a"))
+
+    def test_shared_between_threads(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            path = Path(cache_dir) / "cache.json"
+            cache = ProgramCache(path, max_entries=50)
+
+            def requests(thread: int):
+                for i in range(50):
+                    key = f"{thread}-{i}"
+                    cache.put(key, key, self.call)
+                    cache.get(key)
+
+            threads = [threading.Thread(target=requests, args=(i,)) for i in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(cache.stats(), {"hits": 200, "misses": 0, "evictions": 150, "entries": 50})
+            self.assertEqual(len(ProgramCache(path).entries), 50)
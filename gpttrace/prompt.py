@@ -1,60 +1,155 @@
-import os
+from typing import List
+
+from gpttrace.config import cfg
 from gpttrace.examples import construct_bpftrace_examples
+from gpttrace.probe_catalog import get_probe_catalog
+from gpttrace.tokens import PromptAssembler
+
+# Bump when the prompts change in a way that changes the generated programs.
+PROMPT_VERSION = "4"
+# The order sections are trimmed in when a prompt is over its token budget: largest first.
+EXAMPLES_PRIORITY = 3
+PROBES_PRIORITY = 2
+HISTORY_PRIORITY = 1
+OUTPUT_PRIORITY = 1
+
+
+def format_attempt_history(attempts: List[dict]) -> str:
+    """
+    Format failed attempts compactly: each command tried once, each distinct error once.
+
+    :param attempts: The failed attempts, oldest first, as recorded by `execute`.
+    :return: The attempt history.
+    """
+    lines = ["The commands tried so far and their errors are:", ""]
+    errors = {}
+    for record in attempts:
+        lines.append(f"Attempt {record['attempt']}: {record['command']}")
+        lines.append(f"Error: {record['error_class']}")
+        count, _ = errors.get(record["error_class"], (0, ""))
+        errors[record["error_class"]] = (count + 1, record["stderr"])
+    lines += ["", "The full error output, once per distinct error:", ""]
+    for error_class, (count, stderr) in errors.items():
+        lines.append(f"{error_class} (seen {count} times):")
+        lines.append(stderr)
+    return "\n    ".join(lines)
+
+
+def prompt_on_error_sections(text: str, attempts: List[dict]) -> PromptAssembler:
+    """
+    Construct the sections of the prompt used when an error occurs.
+
+    :param text: User request.
+    :param attempts: The failed attempts, oldest first, as recorded by `execute`.
+    :return: The sections, trimmed to the budget of `GENERATION_MODEL` on `build`.
+    """
+    assembler = running_prompt_sections(text)
+    assembler.add("instructions", """
+    The previous commands failed to execute or not finished.
+    Maybe you can choose an attach point from the probes listed above or
+    suggested in the errors, or try list the attach points and choose one to attach,
+    if you have not done so before. Do not repeat a command that already failed.""")
+    assembler.add("history", "    " + format_attempt_history(attempts), HISTORY_PRIORITY)
+    return assembler
 
 
-def construct_prompt_on_error(previous_prompt: str, text: str, output: str) -> str:
+def construct_prompt_on_error(text: str, attempts: List[dict]) -> str:
     """
     Construct prompts when an error occurs.
 
     :param text: User request.
+    :param attempts: The failed attempts, oldest first, as recorded by `execute`.
     :return: Prompt.
     """
-    examples = construct_bpftrace_examples(text)
-    return f"""
-    {previous_prompt}
+    return prompt_on_error_sections(text, attempts).build()
 
-    The previous command failed to execute or not finished.
-    Maybe you can try list the attach points and choose one to attach, 
-    if you have not done so before.
-    The origin command and output is as follows:
-    
-    {output}
+
+def prompt_for_explain_sections(text: str, output: str) -> PromptAssembler:
     """
+    Construct the sections of a prompt that asks to explain the output of a bpftrace run.
 
-def construct_prompt_for_explain(text: str, output: str) -> str:
-    # fix the token limi
-    if len(output) > 2048:
-        output = output[:4096]
-    return f"""
+    :param text: User request.
+    :param output: The summary of the output, see `gpttrace.reducer.OutputReducer`.
+    :return: The sections, trimmed to the budget of `EXPLAIN_MODEL` on `build`.
+    """
+    assembler = PromptAssembler(cfg.get("EXPLAIN_MODEL"))
+    assembler.add("system", """
     please explain the output of the previous bpftrace result:
-    
-    {output}
-    
+    """)
+    assembler.add("output", output, OUTPUT_PRIORITY)
+    assembler.add("request", f"""
     The original user request is: 
     
     {text}
-    """
+    """)
+    return assembler
 
-def construct_running_prompt(text: str) -> str:
+
+def construct_prompt_for_explain(text: str, output: str) -> str:
     """
-    Construct prompts that translate user requests into bpf commands.
+    Construct a prompt that asks to explain the output of a bpftrace run.
 
     :param text: User request.
+    :param output: The summary of the output, see `gpttrace.reducer.OutputReducer`.
     :return: Prompt.
     """
-    examples = construct_bpftrace_examples(text)
+    return prompt_for_explain_sections(text, output).build()
+
+def construct_probe_list(text: str) -> str:
+    """
+    List kernel probes that match the request, so the model does not guess attach points.
+
+    :param text: User request.
+    :return: The prompt section, or "" if the probes of this machine are unknown.
+    """
+    catalog = get_probe_catalog()
+    if catalog is None:
+        return ""
+    probes = catalog.relevant(text, int(cfg.get("PROBE_PROMPT_LIMIT")))
+    if not probes:
+        return ""
+    listed = "\n    ".join(probes)
     return f"""
+    Some of the probes available on this kernel that may be related to the request:
+
+    {listed}
+    """
+
+def running_prompt_sections(text: str) -> PromptAssembler:
+    """
+    Construct the sections of the prompt that translates user requests into bpf commands.
+
+    The examples are trimmed first and the probe list next when the prompt
+    does not fit the budget of `GENERATION_MODEL`.
+
+    :param text: User request.
+    :return: The sections, trimmed on `build`.
+    """
+    assembler = PromptAssembler(cfg.get("GENERATION_MODEL"))
+    assembler.add("system", """
     As a supportive assistant to a Linux system administrator,
     your role involves leveraging bpftrace to generate eBPF code that aids
     in problem-solving, as well as responding to queries.
     Note that you may not always need to call the bpftrace tool function.
     Here are some pertinent examples that align with the user's requests:
-
-    {examples}
-
+    """)
+    assembler.add("examples", construct_bpftrace_examples(text), EXAMPLES_PRIORITY)
+    assembler.add("probes", construct_probe_list(text), PROBES_PRIORITY)
+    assembler.add("request", f"""
     Now, you have received the following request from a user: {text}
     Please utilize your capabilities to the fullest extent to accomplish this task.
+    """)
+    return assembler
+
+
+def construct_running_prompt(text: str) -> str:
+    """
+    Construct prompts that translate user requests into bpf commands.
+
+    :param text: User request.
+    :return: Prompt.
     """
+    return running_prompt_sections(text).build()
 
 
 def func_call_prompt(cmd: str, help_doc: str) -> str:
@@ -0,0 +1,374 @@
+import json
+import re
+import unittest
+from collections import deque
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from gpttrace.tokens import count_tokens, truncate_tokens
+
+# `@name[key]: value` or `@name: value`
+MAP_LINE = re.compile(r"^(@\w*)(?:\[(.*)\])?:\s+(-?\d+(?:\.\d+)?)\s*$")
+# `@name[key]:` or `@name:` on its own line, followed by histogram buckets
+HIST_HEADER = re.compile(r"^(@\w*)(?:\[(.*)\])?:\s*$")
+# `[4, 8)     100 |@@@@    |`, `[0]    1 |   |` or `(..., 0)   3 |@ |`
+HIST_BUCKET = re.compile(r"^([\[(][^\])]*[\])])\s+(\d+)\s*\|")
+# `@name[` opening a key that spans several lines, such as a stack
+MULTILINE_KEY_START = re.compile(r"^(@\w*)\[\s*$")
+MULTILINE_KEY_END = re.compile(r"^\]:\s+(-?\d+(?:\.\d+)?)\s*$")
+# the banner bpftrace prints before tracing starts
+ATTACHING_LINE = re.compile(r"^Attaching \d+ probes?\.\.\.$")
+# `clear(@name)` or `zero(@name)` in a program
+CLEAR_CALL = re.compile(r"\b(?:clear|zero)\(\s*(@\w*)\s*\)")
+
+
+def cleared_maps(program: str) -> Set[str]:
+    """
+    Finds the maps a bpftrace program clears, so that each of their prints
+    holds only the hits since the previous one.
+
+    :param program: The bpftrace program.
+    :return: The names of the cleared maps, e.g. `{"@usecs"}`.
+    """
+    return set(CLEAR_CALL.findall(program))
+
+
+class TopK:
+    """
+    Keeps the largest values of an unbounded key space in bounded memory.
+
+    When the table grows past `capacity`, the smaller half is evicted, so
+    keys that only ever receive small values are forgotten.
+    """
+    def __init__(self, capacity: int):
+        """
+        Initializes a TopK object.
+
+        :param capacity: The maximum number of keys to track.
+        """
+        self.capacity = capacity
+        self.values: Dict[str, float] = {}
+        self.evicted = 0
+
+    def set(self, key: str, value: float) -> None:
+        """
+        Sets the value of a key.
+        """
+        self.values[key] = value
+        self._shrink()
+
+    def add(self, key: str, delta: float = 1) -> None:
+        """
+        Adds to the value of a key.
+        """
+        self.values[key] = self.values.get(key, 0) + delta
+        self._shrink()
+
+    def _shrink(self) -> None:
+        if len(self.values) > self.capacity:
+            keep = sorted(self.values.items(), key=lambda item: item[1], reverse=True)
+            keep = keep[:self.capacity // 2]
+            self.evicted += len(self.values) - len(keep)
+            self.values = dict(keep)
+
+    def top(self, k: int) -> List[Tuple[str, float]]:
+        """
+        :return: The `k` keys with the largest values, largest first.
+        """
+        return sorted(self.values.items(), key=lambda item: item[1], reverse=True)[:k]
+
+
+class OutputReducer:
+    """
+    Summarizes bpftrace output incrementally in constant memory.
+
+    Recognizes map prints (`@name[key]: value`), histograms, `-f json`
+    records, and per-event printf lines. Map values keep their latest value,
+    histograms keep their last print, since each print of a map is cumulative,
+    except that the buckets of cleared histograms are summed across prints.
+    Events are counted per comm and pid when the output has a header with COMM
+    and PID columns.
+    """
+    def __init__(self, top_k: int = 10, samples: int = 5, max_maps: int = 32, cleared: Iterable[str] = ()):
+        """
+        Initializes an OutputReducer object.
+
+        :param top_k: The number of keys to report for each map.
+        :param samples: The number of event lines to keep from the start and from the end.
+        :param max_maps: The maximum number of distinct maps and histograms to track.
+        :param cleared: The maps the program clears between prints, see `cleared_maps`.
+        """
+        self.top_k = top_k
+        self.max_maps = max_maps
+        self.cleared = set(cleared)
+        self.maps: Dict[str, TopK] = {}
+        self.hists: Dict[str, Dict[str, int]] = {}
+        self.events = 0
+        self.events_by_comm = TopK(top_k * 8)
+        self.events_by_pid = TopK(top_k * 8)
+        self.head: List[str] = []
+        self.samples = samples
+        self.tail = deque(maxlen=samples)
+        self.lines = 0
+        self.chars = 0
+        self.lost_events = 0
+        self._hist: Optional[str] = None
+        self._key_map: Optional[str] = None
+        self._key_lines: List[str] = []
+        self._columns: Optional[Dict[str, int]] = None
+
+    def on_line(self, stream: str, line: str) -> None:
+        """
+        A `run_command_with_timeout` callback that feeds stdout lines to the reducer.
+
+        :param stream: The stream the line came from.
+        :param line: The line.
+        """
+        if stream == "stdout":
+            self.feed(line)
+
+    def feed_text(self, text: str) -> None:
+        """
+        Feeds a whole output at once.
+
+        :param text: The output.
+        """
+        for line in text.splitlines():
+            self.feed(line)
+
+    def feed(self, line: str) -> None:
+        """
+        Feeds one line of output.
+
+        :param line: The line, with or without its newline.
+        """
+        line = line.rstrip("\n")
+        self.lines += 1
+        self.chars += len(line) + 1
+        stripped = line.strip()
+        if self._key_map is not None:
+            match = MULTILINE_KEY_END.match(stripped)
+            if match:
+                key = ";".join(self._key_lines[-3:])
+                self._map(self._key_map).set(key, float(match.group(1)))
+                self._key_map = None
+            elif len(self._key_lines) < 64:
+                self._key_lines.append(stripped)
+            return
+        if stripped.startswith("{") and self._feed_json(stripped):
+            return
+        if self._hist is not None:
+            match = HIST_BUCKET.match(stripped)
+            if match:
+                buckets = self.hists[self._hist]
+                buckets[match.group(1)] = buckets.get(match.group(1), 0) + int(match.group(2))
+                return
+            self._hist = None
+        if stripped == "":
+            return
+        match = MAP_LINE.match(stripped)
+        if match:
+            name, key, value = match.groups()
+            self._map(name).set(key if key is not None else "", float(value))
+            return
+        match = MULTILINE_KEY_START.match(stripped)
+        if match:
+            self._key_map = match.group(1)
+            self._key_lines = []
+            return
+        match = HIST_HEADER.match(stripped)
+        if match:
+            name, key = match.groups()
+            hist = name if key is None else f"{name}[{key}]"
+            if hist in self.hists or len(self.hists) < self.max_maps:
+                self._start_hist(name, hist)
+                self._hist = hist
+            return
+        self._feed_event(stripped)
+
+    def _start_hist(self, name: str, hist: str) -> Dict[str, int]:
+        if name in self.cleared:
+            return self.hists.setdefault(hist, {})
+        # A new print of a map that is never cleared replaces the previous one.
+        self.hists[hist] = {}
+        return self.hists[hist]
+
+    def _map(self, name: str) -> TopK:
+        if name not in self.maps and len(self.maps) >= self.max_maps:
+            name = "@(other maps)"
+        return self.maps.setdefault(name, TopK(self.top_k * 8))
+
+    def _feed_json(self, line: str) -> bool:
+        try:
+            record = json.loads(line)
+        except ValueError:
+            return False
+        if not isinstance(record, dict) or "type" not in record:
+            return False
+        kind, data = record["type"], record.get("data")
+        if kind == "map" and isinstance(data, dict):
+            for name, values in data.items():
+                if isinstance(values, dict):
+                    for key, value in values.items():
+                        if isinstance(value, (int, float)):
+                            self._map(name).set(key, float(value))
+                elif isinstance(values, (int, float)):
+                    self._map(name).set("", float(values))
+        elif kind == "hist" and isinstance(data, dict):
+            for name, values in data.items():
+                keyed = values.items() if isinstance(values, dict) else [(None, values)]
+                for key, buckets in keyed:
+                    hist = name if key is None else f"{name}[{key}]"
+                    if hist not in self.hists and len(self.hists) >= self.max_maps:
+                        continue
+                    merged = self._start_hist(name, hist)
+                    for bucket in buckets:
+                        label = f"[{bucket.get('min', '...')}, {bucket.get('max', '...')}]"
+                        merged[label] = merged.get(label, 0) + int(bucket.get("count", 0))
+        elif kind == "printf":
+            self._feed_event(str(data).strip())
+        elif kind == "lost_events" and isinstance(data, dict):
+            self.lost_events += int(data.get("events", 0))
+        return True
+
+    def _feed_event(self, line: str) -> None:
+        if line == "" or ATTACHING_LINE.match(line):
+            return
+        fields = line.split()
+        if "PID" in fields and "COMM" in fields:
+            self._columns = {"pid": fields.index("PID"), "comm": fields.index("COMM")}
+            return
+        self.events += 1
+        if len(self.head) < self.samples:
+            self.head.append(line)
+        else:
+            self.tail.append(line)
+        if self._columns is not None:
+            pid, comm = self._columns["pid"], self._columns["comm"]
+            if len(fields) > max(pid, comm) and fields[pid].isdigit():
+                self.events_by_pid.add(fields[pid])
+                self.events_by_comm.add(fields[comm])
+
+    def _sections(self) -> List[str]:
+        sections = []
+        for name, buckets in self.hists.items():
+            if buckets:
+                lines = [f"{name} (histogram):"]
+                lines += [f"  {label} {count}" for label, count in buckets.items()]
+                sections.append("\n".join(lines))
+        for name, table in self.maps.items():
+            lines = [f"{name} (top {self.top_k} of {len(table.values) + table.evicted} keys):"]
+            for key, value in table.top(self.top_k):
+                value = int(value) if value == int(value) else value
+                lines.append(f"  {name}[{key}]: {value}" if key else f"  {name}: {value}")
+            sections.append("\n".join(lines))
+        if self.events:
+            lines = [f"{self.events} event lines"]
+            if self.events_by_comm.values:
+                lines.append("events by comm: " + ", ".join(
+                    f"{comm}={int(count)}" for comm, count in self.events_by_comm.top(self.top_k)))
+                lines.append("events by pid: " + ", ".join(
+                    f"{pid}={int(count)}" for pid, count in self.events_by_pid.top(self.top_k)))
+            sections.append("\n".join(lines))
+            sample = self.head + (["..."] if self.events > len(self.head) + len(self.tail) else []) + list(self.tail)
+            sections.append("sample events:\n" + "\n".join(sample))
+        if self.lost_events:
+            sections.append(f"{self.lost_events} events were lost")
+        return sections
+
+    def summary(self, token_budget: int = 1024, model: Optional[str] = None) -> str:
+        """
+        Renders the summary, most valuable sections first, within a token budget.
+
+        Histograms and maps come first, then event counts, then sample event lines.
+
+        :param token_budget: The maximum number of tokens of the summary.
+        :param model: The model whose tokenizer counts the tokens, defaults to `GENERATION_MODEL`.
+        :return: The summary.
+        """
+        footer = f"({self.lines} lines, {self.chars} characters of output in total)"
+        parts = []
+        used = count_tokens(footer, model)
+        for section in self._sections():
+            cost = count_tokens(section, model) + 1
+            if used + cost > token_budget:
+                remaining = token_budget - used - 1
+                if remaining > 20:
+                    parts.append(truncate_tokens(section, remaining, model))
+                break
+            parts.append(section)
+            used += cost
+        parts.append(footer)
+        return "\n".join(parts)
+
+
+class TestOutputReducer(unittest.TestCase):
+    def test_maps_and_histograms(self):
+        reducer = OutputReducer(top_k=2)
+        reducer.feed_text("""Attaching 1 probe...
+
+@usecs:
+[0]                    1 |                                                    |
+[4, 8)               100 |@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@|
+
+@usecs:
+[4, 8)                 5 |@@                                                  |
+
+@[bash]: 3
+@[sshd]: 10
+@[systemd]: 7
+@[
+    tcp_sendmsg+1
+    sock_sendmsg+62
+]: 42
+""")
+        summary = reducer.summary()
+        self.assertIn("[4, 8) 5", summary)
+        self.assertNotIn("[0] 1", summary)
+        self.assertIn("@[sshd]: 10", summary)
+        self.assertNotIn("@[systemd]", summary)
+        self.assertIn("@[tcp_sendmsg+1;sock_sendmsg+62]: 42", summary)
+        self.assertEqual(reducer.events, 0)
+
+    def test_cumulative_interval_prints(self):
+        output = """@usecs:
+[0]                    1 |@                                                   |
+[4, 8)               100 |@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@|
+
+@usecs:
+[0]                    1 |                                                    |
+[4, 8)               150 |@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@|
+"""
+        reducer = OutputReducer()
+        reducer.feed_text(output)
+        self.assertEqual(reducer.hists["@usecs"], {"[0]": 1, "[4, 8)": 150})
+        program = "kprobe:vfs_read { @start[tid] = nsecs; } interval:s:1 { print(@usecs); clear(@usecs); }"
+        reducer = OutputReducer(cleared=cleared_maps(program))
+        reducer.feed_text(output)
+        self.assertEqual(reducer.hists["@usecs"], {"[0]": 2, "[4, 8)": 250})
+        reducer = OutputReducer()
+        for count in (2, 3):
+            reducer.feed(f'{{"type": "hist", "data": {{"@lat": [{{"min": 4, "max": 7, "count": {count}}}]}}}}')
+        self.assertEqual(reducer.hists["@lat"], {"[4, 7]": 3})
+
+    def test_json_records(self):
+        reducer = OutputReducer()
+        reducer.feed('{"type": "map", "data": {"@": {"bash": 3, "sshd": 5}}}')
+        reducer.feed('{"type": "hist", "data": {"@lat": [{"min": 4, "max": 7, "count": 2}]}}')
+        reducer.feed('{"type": "printf", "data": "hello\\n"}')
+        summary = reducer.summary()
+        self.assertIn("@[sshd]: 5", summary)
+        self.assertIn("[4, 7] 2", summary)
+        self.assertEqual(reducer.events, 1)
+
+    def test_events_in_constant_memory(self):
+        reducer = OutputReducer(top_k=3)
+        reducer.feed("PID    COMM             FD ERR PATH")
+        for i in range(100000):
+            comm = "hot" if i % 2 else f"proc{i}"
+            reducer.feed(f"{1000 + i % 50:<6} {comm:<16} 3   0 /etc/passwd")
+        self.assertEqual(reducer.events, 100000)
+        self.assertLessEqual(len(reducer.events_by_comm.values), 24)
+        self.assertEqual(reducer.events_by_comm.top(1), [("hot", 50000)])
+        summary = reducer.summary(token_budget=200)
+        self.assertLessEqual(count_tokens(summary), 200)
+        self.assertIn("hot=50000", summary)
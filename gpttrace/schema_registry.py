@@ -0,0 +1,193 @@
+import hashlib
+import json
+import mmap
+import os
+import shutil
+import tempfile
+import unittest
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+
+def index_json_array(data: bytes) -> Dict[str, Tuple[int, int]]:
+    """
+    Finds where each object of a JSON array of function calls starts and ends.
+
+    :param data: The JSON text of the array.
+    :return: The byte range of each function call, keyed by its name.
+    """
+    text = data.decode("utf-8")
+    decoder = json.JSONDecoder()
+    offsets = {}
+    pos = text.index("[") + 1
+    # Character offsets equal byte offsets only for ASCII, so track both.
+    char_pos, byte_pos = 0, 0
+    while True:
+        while pos < len(text) and text[pos] in " \t\r\n,":
+            pos += 1
+        if pos >= len(text) or text[pos] == "]":
+            break
+        func, end = decoder.raw_decode(text, pos)
+        start_byte = byte_pos + len(text[char_pos:pos].encode("utf-8"))
+        end_byte = start_byte + len(text[pos:end].encode("utf-8"))
+        offsets[func["name"]] = (start_byte, end_byte)
+        char_pos, byte_pos = end, end_byte
+        pos = end
+    return offsets
+
+
+def help_hash(help_doc: str) -> str:
+    """
+    :param help_doc: The `--help` output of a command.
+    :return: The hex SHA-256 digest of the help output.
+    """
+    return hashlib.sha256(help_doc.encode("utf-8")).hexdigest()
+
+
+def _write_json_atomic(path: Path, data: Any) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=path.name + ".")
+    with os.fdopen(fd, "w", encoding="utf-8") as file:
+        json.dump(data, file)
+    os.replace(tmp_path, path)
+
+
+class SchemaRegistry:
+    """
+    Function call schemas of bcc tools, looked up by tool name.
+
+    Predefined schemas stay in `funcs.json`, which is memory-mapped; an index
+    of the byte range of each schema is cached next to it, so a lookup parses
+    only the schema it needs. Schemas generated by the model are stored in a
+    separate file, together with the mtime of the tool binary and the hash of
+    its `--help` output, and are dropped when the tool changes.
+    """
+    def __init__(self, funcs_path: Path, generated_path: Path,
+                 get_help: Callable[[str], str]):
+        """
+        Initializes a SchemaRegistry object.
+
+        :param funcs_path: The path of the predefined function calls.
+        :param generated_path: The path of the function calls generated by the model.
+        :param get_help: Returns the `--help` output of a command.
+        """
+        self.funcs_path = Path(funcs_path)
+        self.generated_path = Path(generated_path)
+        self.get_help = get_help
+        self._file = open(self.funcs_path, "rb")
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.offsets = self._load_index()
+        self._parsed: Dict[str, dict] = {}
+        self.generated: Dict[str, dict] = {}
+        if self.generated_path.exists():
+            with open(self.generated_path, "r", encoding="utf-8") as file:
+                self.generated = json.load(file)
+
+    def _load_index(self) -> Dict[str, Tuple[int, int]]:
+        """
+        Loads the byte range index of `funcs.json`, rebuilding it if `funcs.json` changed.
+
+        :return: The byte range of each predefined function call, keyed by name.
+        """
+        stat = os.stat(self.funcs_path)
+        index_path = self.funcs_path.with_name(self.funcs_path.stem + ".index.json")
+        if index_path.exists():
+            with open(index_path, "r", encoding="utf-8") as file:
+                index = json.load(file)
+            if index["mtime_ns"] == stat.st_mtime_ns and index["size"] == stat.st_size:
+                return {name: tuple(span) for name, span in index["offsets"].items()}
+        offsets = index_json_array(self._mmap[:])
+        try:
+            _write_json_atomic(index_path, {"mtime_ns": stat.st_mtime_ns, "size": stat.st_size,
+                                            "offsets": offsets})
+        except OSError:
+            # A read-only installation still works, it just indexes on every start.
+            pass
+        return offsets
+
+    def names(self) -> List[str]:
+        """
+        :return: The names of all known tools, predefined first.
+        """
+        return list(self.offsets) + [name for name in self.generated if name not in self.offsets]
+
+    def get(self, name: str) -> Optional[dict]:
+        """
+        Looks up the function call schema of a tool.
+
+        :param name: The name of the tool.
+        :return: The schema, or None if it is unknown or the generated one is stale.
+        """
+        if name in self._parsed:
+            return self._parsed[name]
+        if name in self.offsets:
+            start, end = self.offsets[name]
+            schema = json.loads(self._mmap[start:end])
+            self._parsed[name] = schema
+            return schema
+        entry = self.generated.get(name)
+        if entry is None or not self._is_fresh(name, entry):
+            return None
+        return entry["schema"]
+
+    def _is_fresh(self, name: str, entry: dict) -> bool:
+        """
+        Checks whether a generated schema still matches the installed tool.
+
+        The binary mtime is compared first; only when it changed is `--help`
+        run again and compared by hash.
+        """
+        mtime = self._binary_mtime(name)
+        if mtime == entry["binary_mtime"]:
+            return True
+        if help_hash(self.get_help(name)) != entry["help_hash"]:
+            del self.generated[name]
+            self._save_generated()
+            return False
+        entry["binary_mtime"] = mtime
+        self._save_generated()
+        return True
+
+    @staticmethod
+    def _binary_mtime(name: str) -> Optional[int]:
+        path = shutil.which(name)
+        return os.stat(path).st_mtime_ns if path is not None else None
+
+    def put_generated(self, name: str, schema: dict, help_doc: str) -> None:
+        """
+        Stores a schema generated by the model.
+
+        :param name: The name of the tool.
+        :param schema: The generated function call schema.
+        :param help_doc: The `--help` output the schema was generated from.
+        """
+        self.generated[name] = {"schema": schema, "binary_mtime": self._binary_mtime(name),
+                                "help_hash": help_hash(help_doc)}
+        self._save_generated()
+
+    def _save_generated(self) -> None:
+        _write_json_atomic(self.generated_path, self.generated)
+
+
+class TestSchemaRegistry(unittest.TestCase):
+    def test_lookup_and_generated_invalidation(self):
+        with tempfile.TemporaryDirectory() as data_dir:
+            funcs_path = Path(data_dir) / "funcs.json"
+            funcs = [{"name": "a-bpfcc", "description": "é"}, {"name": "b-bpfcc", "parameters": {}}]
+            funcs_path.write_text(json.dumps(funcs, indent=4, ensure_ascii=False), encoding="utf-8")
+            help_doc = {"sh": "usage: sh"}
+            registry = SchemaRegistry(funcs_path, Path(data_dir) / "generated.json", help_doc.get)
+            self.assertEqual(registry.get("b-bpfcc"), funcs[1])
+            self.assertEqual(registry.get("a-bpfcc"), funcs[0])
+            self.assertTrue((Path(data_dir) / "funcs.index.json").exists())
+
+            registry.put_generated("sh", {"name": "sh"}, "usage: sh")
+            registry = SchemaRegistry(funcs_path, Path(data_dir) / "generated.json", help_doc.get)
+            self.assertEqual(registry.get("sh"), {"name": "sh"})
+            # A changed binary with the same help output keeps the schema.
+            registry.generated["sh"]["binary_mtime"] = 0
+            self.assertEqual(registry.get("sh"), {"name": "sh"})
+            # A changed help output drops it.
+            registry.generated["sh"]["binary_mtime"] = 0
+            help_doc["sh"] = "usage: sh [-c]"
+            self.assertIsNone(registry.get("sh"))
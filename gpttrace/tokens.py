@@ -0,0 +1,208 @@
+import threading
+import unittest
+from typing import Dict, List, Optional, Tuple
+from unittest import mock
+
+from gpttrace.config import cfg
+
+# Context windows in tokens, matched by the longest model name prefix.
+CONTEXT_WINDOWS = {
+    "gpt-3.5-turbo": 4096,
+    "gpt-3.5-turbo-16k": 16384,
+    "gpt-3.5-turbo-1106": 16384,
+    "gpt-4": 8192,
+    "gpt-4-32k": 32768,
+    "gpt-4-1106": 128000,
+    "gpt-4-turbo": 128000,
+    "gpt-4o": 128000,
+    "claude": 100000,
+}
+DEFAULT_CONTEXT_WINDOW = 4096
+# Sections with this priority are never trimmed.
+REQUIRED = 0
+TRUNCATED = "..."
+
+_encodings = {}
+_encodings_lock = threading.Lock()
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Estimate the number of tokens of a text.
+
+    :param text: The text.
+    :return: The estimated number of tokens.
+    """
+    return (len(text) + 3) // 4
+
+
+def get_encoding(model: str):
+    """
+    Gets the tiktoken encoding of a model, loading it once per process.
+
+    :param model: The model name.
+    :return: The encoding, or None if `TOKENIZER` is not "tiktoken" or the encoding cannot be loaded.
+    """
+    if cfg.get("TOKENIZER") != "tiktoken":
+        return None
+    with _encodings_lock:
+        if model not in _encodings:
+            try:
+                import tiktoken
+
+                try:
+                    _encodings[model] = tiktoken.encoding_for_model(model)
+                except KeyError:
+                    _encodings[model] = tiktoken.get_encoding("cl100k_base")
+            except Exception:
+                # Not installed, or the encoding file cannot be downloaded:
+                # do not try again on every prompt.
+                _encodings[model] = None
+        return _encodings[model]
+
+
+def count_tokens(text: str, model: Optional[str] = None) -> int:
+    """
+    Counts the tokens of a text with the model's tokenizer, or estimates them without tiktoken.
+
+    :param text: The text.
+    :param model: The model name, defaults to `GENERATION_MODEL`.
+    :return: The number of tokens.
+    """
+    encoding = get_encoding(model or cfg.get("GENERATION_MODEL"))
+    if encoding is None:
+        return estimate_tokens(text)
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def truncate_tokens(text: str, budget: int, model: Optional[str] = None) -> str:
+    """
+    Keeps the leading whole lines of a text that fit in a token budget.
+
+    :param text: The text.
+    :param budget: The maximum number of tokens of the result.
+    :param model: The model name, defaults to `GENERATION_MODEL`.
+    :return: The text, or its head followed by a line with "...".
+    """
+    if count_tokens(text, model) <= budget:
+        return text
+    budget -= count_tokens("\n" + TRUNCATED, model)
+    kept = []
+    used = 0
+    for line in text.split("\n"):
+        cost = count_tokens(line + "\n", model)
+        if used + cost > budget:
+            if not kept and budget > 0:
+                # A single long line: cut it by characters.
+                kept.append(line[:budget * 4])
+            break
+        kept.append(line)
+        used += cost
+    return "\n".join(kept + [TRUNCATED]) if budget > 0 else ""
+
+
+def context_window(model: str) -> int:
+    """
+    :param model: The model name.
+    :return: The context window of the model in tokens.
+    """
+    matches = [prefix for prefix in CONTEXT_WINDOWS if model.startswith(prefix)]
+    return CONTEXT_WINDOWS[max(matches, key=len)] if matches else DEFAULT_CONTEXT_WINDOW
+
+
+def prompt_budget(model: str) -> int:
+    """
+    :param model: The model name.
+    :return: The tokens a prompt may use: the context window less the completion reserve,
+        capped by `PROMPT_TOKEN_CEILING`.
+    """
+    budget = context_window(model) - int(cfg.get("COMPLETION_TOKEN_RESERVE"))
+    return max(0, min(budget, int(cfg.get("PROMPT_TOKEN_CEILING"))))
+
+
+class PromptAssembler:
+    """
+    Builds a prompt from named sections within a token budget.
+
+    When the sections do not fit, the ones with the largest priority number
+    are trimmed first, down to their head; `REQUIRED` sections are never
+    trimmed. The tokens of each section are kept for instrumentation.
+    """
+    def __init__(self, model: Optional[str] = None, budget: Optional[int] = None):
+        """
+        Initializes a PromptAssembler object.
+
+        :param model: The model the prompt is for, defaults to `GENERATION_MODEL`.
+        :param budget: The maximum tokens of the prompt, defaults to `prompt_budget(model)`.
+        """
+        self.model = model or cfg.get("GENERATION_MODEL")
+        self.budget = budget if budget is not None else prompt_budget(self.model)
+        self.sections: List[Tuple[str, str, int]] = []
+        self.counts: Dict[str, int] = {}
+        self.trimmed: List[str] = []
+
+    def add(self, name: str, text: str, priority: int = REQUIRED) -> "PromptAssembler":
+        """
+        Appends a section.
+
+        :param name: The name of the section in `counts`.
+        :param text: The text of the section; empty sections are left out.
+        :param priority: `REQUIRED`, or larger numbers for sections that are trimmed sooner.
+        :return: The assembler, for chaining.
+        """
+        if text.strip():
+            self.sections.append((name, text, priority))
+        return self
+
+    def build(self) -> str:
+        """
+        Trims the sections to the budget and joins them.
+
+        :return: The prompt.
+        """
+        texts = {name: text for name, text, _ in self.sections}
+        self.counts = {name: count_tokens(text, self.model) for name, text in texts.items()}
+        self.trimmed = []
+        # Sections are separated by a newline, about a token each.
+        over = sum(self.counts.values()) + len(self.sections) - self.budget
+        optional = sorted((s for s in self.sections if s[2] != REQUIRED), key=lambda s: -s[2])
+        for name, text, _ in optional:
+            if over <= 0:
+                break
+            keep = max(0, self.counts[name] - over)
+            texts[name] = truncate_tokens(text, keep, self.model)
+            count = count_tokens(texts[name], self.model) if texts[name] else 0
+            over -= self.counts[name] - count
+            self.counts[name] = count
+            self.trimmed.append(name)
+        return "\n".join(texts[name] for name, _, _ in self.sections if texts[name])
+
+    def total(self) -> int:
+        """
+        :return: The tokens of the sections after the last `build`.
+        """
+        return sum(self.counts.values())
+
+
+class TestPromptAssembler(unittest.TestCase):
+    def test_trims_lowest_priority_first(self):
+        with mock.patch.dict("os.environ", {"TOKENIZER": "heuristic"}):
+            assembler = PromptAssembler("gpt-3.5-turbo", budget=120)
+            assembler.add("system", "s" * 80)
+            assembler.add("history", "\n".join(["h" * 39] * 10), priority=1)
+            assembler.add("examples", "\n".join(["e" * 39] * 20), priority=2)
+            assembler.add("request", "r" * 40)
+            prompt = assembler.build()
+        self.assertEqual(assembler.trimmed, ["examples", "history"])
+        self.assertEqual(assembler.counts["examples"], 0)
+        self.assertLessEqual(assembler.total() + 4, 120)
+        self.assertTrue(prompt.startswith("s" * 80 + "\nhhh"))
+        self.assertTrue(prompt.endswith("...\n" + "r" * 40))
+
+    def test_fits_untouched(self):
+        with mock.patch.dict("os.environ", {"TOKENIZER": "heuristic"}):
+            assembler = PromptAssembler("gpt-4", budget=1000).add("a", "hello").add("b", "", priority=1)
+            self.assertEqual(assembler.build(), "hello")
+            self.assertEqual(assembler.counts, {"a": 2})
+            self.assertEqual(context_window("gpt-3.5-turbo-16k-0613"), 16384)
+            self.assertEqual(context_window("unknown"), DEFAULT_CONTEXT_WINDOW)
@@ -0,0 +1,147 @@
+import json
+import re
+import shutil
+import tempfile
+import time
+import unittest
+from pathlib import Path
+from typing import Dict, List
+
+from gpttrace.bm25 import BM25Index, tokenize
+from gpttrace.schema_registry import SchemaRegistry
+
+# How many times the tool name and description count against the parameter text.
+NAME_WEIGHT = 3
+DESCRIPTION_WEIGHT = 3
+# Phrases and stems that users and tool descriptions spell differently.
+PHRASES = {"system call": "syscall", "system calls": "syscalls"}
+SYNONYMS = {"execut": "exec", "fork": "exec", "spawn": "exec"}
+
+
+def stem(term: str) -> str:
+    """
+    Strips common English suffixes so `opened`, `opens` and `open` match.
+
+    :param term: A lowercase term.
+    :return: The stem of the term.
+    """
+    if len(term) > 4 and term.endswith(("sses", "ches", "shes", "xes")):
+        term = term[:-2]
+    elif len(term) > 3 and term.endswith("s") and not term.endswith("ss"):
+        term = term[:-1]
+    for suffix in ("ing", "ed"):
+        if len(term) > len(suffix) + 2 and term.endswith(suffix):
+            term = term[:-len(suffix)]
+            break
+    if len(term) > 3 and term.endswith("e"):
+        term = term[:-1]
+    return SYNONYMS.get(term, term)
+
+
+def normalize_text(text: str) -> str:
+    """
+    Rewrites text as its stemmed terms, for both schemas and queries.
+
+    :param text: The text to normalize.
+    :return: The stemmed terms, separated by spaces.
+    """
+    text = text.lower()
+    for phrase, replacement in PHRASES.items():
+        text = text.replace(phrase, replacement)
+    return " ".join(stem(term) for term in tokenize(text))
+
+
+def schema_document(schema: dict) -> str:
+    """
+    Builds the text a bcc tool is matched on.
+
+    The name, split into words, and the description say what the tool does,
+    so they are repeated to outweigh the parameter text, which is mostly the
+    same filters (`pid`, `interval`, ...) across tools.
+
+    :param schema: The function call schema of the tool.
+    :return: The text to index for the tool.
+    """
+    name = re.sub(r"-bpfcc$", "", schema["name"])
+    words = " ".join(re.split(r"[^A-Za-z0-9]+", name))
+    description = schema.get("description", "")
+    params = []
+    for param, spec in schema.get("parameters", {}).get("properties", {}).items():
+        params.append(f"{param} {spec.get('description', '')}")
+    text = "\n".join([name] + [words] * NAME_WEIGHT + [description] * DESCRIPTION_WEIGHT + params)
+    return normalize_text(text)
+
+
+class ToolRouter:
+    """
+    Picks the bcc tools whose schemas best match a request.
+
+    The schemas are ranked locally with BM25, so only the few likely tools are
+    sent to the model instead of the whole registry.
+    """
+    def __init__(self, registry: SchemaRegistry, index_path: Path):
+        """
+        Initializes a ToolRouter object, loading or building its index.
+
+        :param registry: The registry of bcc tool function calls.
+        :param index_path: The path of the cached `.npz` index.
+        """
+        self.registry = registry
+        self.names = [name for name in registry.names() if registry.get(name) is not None]
+        documents = [schema_document(registry.get(name)) for name in self.names]
+        self.index = BM25Index.load(index_path, documents)
+
+    def route(self, query: str, k: int = 3) -> List[str]:
+        """
+        Ranks the tools for a request.
+
+        :param query: The task that the user wants to accomplish.
+        :param k: The number of tools to return.
+        :return: The names of the best matching tools, best first.
+        """
+        return [self.names[i] for i in self.index.rank(normalize_text(query), k)]
+
+
+def benchmark_router(router: ToolRouter, queries: List[dict], k: int = 3) -> Dict[str, float]:
+    """
+    Measures the ranking latency and top-k recall of a router.
+
+    :param router: The router to measure.
+    :param queries: Labeled queries, each with a `query` and the acceptable `tools`.
+    :param k: The number of tools the router returns.
+    :return: The mean and p99 latency in milliseconds and the recall@k.
+    """
+    latencies = []
+    hits = 0
+    for labeled in queries:
+        start = time.perf_counter()
+        routed = router.route(labeled["query"], k)
+        latencies.append((time.perf_counter() - start) * 1000)
+        if set(routed) & set(labeled["tools"]):
+            hits += 1
+    latencies.sort()
+    return {
+        "queries": len(queries),
+        "mean_ms": sum(latencies) / len(latencies),
+        "p99_ms": latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))],
+        f"recall@{k}": hits / len(queries),
+    }
+
+
+class TestToolRouter(unittest.TestCase):
+    def test_recall_on_labeled_queries(self):
+        root = Path(__file__).resolve().parent.parent
+        with open(root / "benchmarks" / "router_queries.json", "r", encoding="utf-8") as file:
+            queries = json.load(file)
+        with tempfile.TemporaryDirectory() as data_dir:
+            # The registry writes its index next to the schemas, so it works on a copy.
+            funcs_path = Path(data_dir) / "funcs.json"
+            shutil.copy(root / "data_save" / "funcs.json", funcs_path)
+            registry = SchemaRegistry(funcs_path, Path(data_dir) / "generated.json", lambda name: "")
+            router = ToolRouter(registry, Path(data_dir) / "tool_router.npz")
+            self.assertEqual(router.route("Trace open() syscalls", k=1), ["opensnoop-bpfcc"])
+            stats = benchmark_router(router, queries, k=3)
+        self.assertEqual(stats["queries"], len(queries))
+        self.assertLessEqual(stats["mean_ms"], stats["p99_ms"])
+        self.assertGreaterEqual(stats["recall@3"], 0.8)
+        self.assertLess(stats["p99_ms"], 5)
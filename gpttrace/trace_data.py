@@ -0,0 +1,256 @@
+import json
+import time
+import unittest
+from array import array
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+
+class MapTable:
+    """
+    The latest value of every key of a bpftrace map, stored column-wise.
+
+    Numbers are kept in `values`; other values, such as the strings of
+    `@[pid] = comm`, are kept in `texts` by row, with NaN in `values`.
+    """
+    def __init__(self, name: str):
+        """
+        Initializes an empty MapTable object.
+
+        :param name: The name of the map, e.g. `@bytes`.
+        """
+        self.name = name
+        self.keys: List[str] = []
+        self.values = array("d")
+        self.texts: Dict[int, str] = {}
+        self._rows: Dict[str, int] = {}
+
+    def set(self, key: str, value: Union[float, str]) -> None:
+        """
+        Sets the value of a key.
+        """
+        row = self._rows.get(key)
+        if row is None:
+            row = self._rows[key] = len(self.keys)
+            self.keys.append(key)
+            self.values.append(0.0)
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            self.values[row] = value
+            self.texts.pop(row, None)
+        else:
+            self.values[row] = float("nan")
+            self.texts[row] = value if isinstance(value, str) else json.dumps(value)
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def rows(self) -> Iterator[Tuple[str, Union[float, str]]]:
+        """
+        :return: The (key, value) rows of the table, with the text of non-numeric values.
+        """
+        for row, (key, value) in enumerate(zip(self.keys, self.values)):
+            yield key, self.texts.get(row, value)
+
+
+class HistTable:
+    """
+    The buckets of a bpftrace histogram, stored column-wise.
+
+    Row `i` is the bucket `[lower[i], upper[i]]` of map key `keys[i]` with `counts[i]` hits.
+    """
+    def __init__(self, name: str):
+        """
+        Initializes an empty HistTable object.
+
+        :param name: The name of the histogram map, e.g. `@usecs`.
+        """
+        self.name = name
+        self.keys: List[str] = []
+        self.lower = array("q")
+        self.upper = array("q")
+        self.counts = array("q")
+        self._rows: Dict[Tuple[str, int, int], int] = {}
+
+    def add(self, key: str, lower: int, upper: int, count: int) -> None:
+        """
+        Adds hits to a bucket.
+        """
+        row = self._rows.get((key, lower, upper))
+        if row is None:
+            self._rows[(key, lower, upper)] = len(self.keys)
+            self.keys.append(key)
+            self.lower.append(lower)
+            self.upper.append(upper)
+            self.counts.append(count)
+        else:
+            self.counts[row] += count
+
+    def set(self, key: str, lower: int, upper: int, count: int) -> None:
+        """
+        Sets the hits of a bucket.
+        """
+        row = self._rows.get((key, lower, upper))
+        if row is None:
+            self.add(key, lower, upper, count)
+        else:
+            self.counts[row] = count
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+
+class EventTable:
+    """
+    The printf events of a run. The text of all events is kept in one buffer
+    and sliced by offset, next to the arrival time of each event.
+    """
+    def __init__(self):
+        """
+        Initializes an empty EventTable object.
+        """
+        self.times = array("d")
+        self.offsets = array("Q", [0])
+        self.text = bytearray()
+
+    def append(self, timestamp: float, text: str) -> None:
+        """
+        Adds an event.
+
+        :param timestamp: Seconds since the start of the run.
+        :param text: The printed text.
+        """
+        self.text += text.encode("utf-8")
+        self.offsets.append(len(self.text))
+        self.times.append(timestamp)
+
+    def __len__(self) -> int:
+        return len(self.times)
+
+    def __getitem__(self, row: int) -> str:
+        return self.text[self.offsets[row]:self.offsets[row + 1]].decode("utf-8")
+
+
+class TraceTables:
+    """
+    Parses the `-f json` record stream of bpftrace into typed tables as it arrives.
+
+    Each print of a histogram is cumulative, so its buckets replace those of the
+    previous print, except for the histograms the program clears, whose buckets
+    are summed across prints.
+    """
+    def __init__(self, cleared: Iterable[str] = ()):
+        """
+        Initializes empty TraceTables.
+
+        :param cleared: The maps the program clears between prints, e.g. `{"@usecs"}`.
+        """
+        self.cleared = set(cleared)
+        self.maps: Dict[str, MapTable] = {}
+        self.hists: Dict[str, HistTable] = {}
+        self.events = EventTable()
+        self.attached_probes = 0
+        self.lost_events = 0
+        self.skipped_lines = 0
+        self._start: Optional[float] = None
+
+    def on_line(self, stream: str, line: str) -> None:
+        """
+        A `run_command_with_timeout` callback that feeds stdout lines to the parser.
+
+        :param stream: The stream the line came from.
+        :param line: The line.
+        """
+        if stream == "stdout":
+            self.feed(line)
+
+    def feed(self, line: str) -> None:
+        """
+        Parses one JSON record. Lines that are not records, or records of an
+        unexpected shape, are counted and skipped.
+
+        :param line: The line.
+        """
+        if self._start is None:
+            self._start = time.monotonic()
+        try:
+            record = json.loads(line)
+            self._add(record["type"], record.get("data"))
+        except (ValueError, TypeError, KeyError, AttributeError):
+            self.skipped_lines += 1
+
+    def _add(self, kind: str, data: object) -> None:
+        if kind == "printf":
+            self.events.append(time.monotonic() - self._start, data)
+        elif kind == "map":
+            for name, values in data.items():
+                table = self.maps.setdefault(name, MapTable(name))
+                if isinstance(values, dict):
+                    for key, value in values.items():
+                        table.set(key, value)
+                else:
+                    table.set("", values)
+        elif kind == "hist":
+            for name, values in data.items():
+                table = self.hists.setdefault(name, HistTable(name))
+                update = table.add if name in self.cleared else table.set
+                keyed = values.items() if isinstance(values, dict) else [("", values)]
+                for key, buckets in keyed:
+                    for bucket in buckets:
+                        update(key, bucket.get("min", -1), bucket.get("max", -1), bucket["count"])
+        elif kind == "attached_probes":
+            self.attached_probes = data.get("probes", 0)
+        elif kind == "lost_events":
+            self.lost_events += data.get("events", 0)
+
+
+def benchmark_parse(path: str, repeat: int = 5) -> Dict[str, float]:
+    """
+    Measures the parse throughput of a recorded `-f json` trace.
+
+    :param path: The path of the recorded trace, one record per line.
+    :param repeat: How many times to parse the trace.
+    :return: The best records per second and megabytes per second.
+    """
+    with open(path, "r", encoding="utf-8") as file:
+        lines = file.read().splitlines()
+    size = sum(len(line) + 1 for line in lines)
+    best = float("inf")
+    for _ in range(repeat):
+        tables = TraceTables()
+        start = time.perf_counter()
+        for line in lines:
+            tables.feed(line)
+        best = min(best, time.perf_counter() - start)
+    return {"records": len(lines), "records_per_second": len(lines) / best,
+            "mb_per_second": size / best / 1e6}
+
+
+class TestTraceTables(unittest.TestCase):
+    def test_records(self):
+        tables = TraceTables()
+        for line in [
+            '{"type": "attached_probes", "data": {"probes": 2}}',
+            '{"type": "printf", "data": "1234 bash /etc/passwd\\n"}',
+            '{"type": "map", "data": {"@": {"bash": 3, "sshd": 5}}}',
+            '{"type": "map", "data": {"@": {"bash": 4}}}',
+            '{"type": "hist", "data": {"@us": [{"min": 4, "max": 7, "count": 2}]}}',
+            '{"type": "hist", "data": {"@us": [{"min": 4, "max": 7, "count": 1}]}}',
+            '{"type": "lost_events", "data": {"events": 9}}',
+            '{"type": "map", "data": {"@c": {"123": "bash"}}}',
+            '{"type": "map", "data": ["not", "a", "dict"]}',
+            '{"type": "hist", "data": {"@us": [{"min": 4}]}}',
+            'not json',
+        ]:
+            tables.feed(line)
+        self.assertEqual(tables.attached_probes, 2)
+        self.assertEqual(dict(tables.maps["@"].rows()), {"bash": 4.0, "sshd": 5.0})
+        self.assertEqual(list(tables.hists["@us"].counts), [1])
+        self.assertEqual(tables.events[0], "1234 bash /etc/passwd\n")
+        self.assertEqual(tables.lost_events, 9)
+        self.assertEqual(dict(tables.maps["@c"].rows()), {"123": "bash"})
+        self.assertEqual(tables.skipped_lines, 3)
+
+    def test_cleared_histograms(self):
+        tables = TraceTables(cleared={"@us"})
+        for count in (2, 1):
+            tables.feed(f'{{"type": "hist", "data": {{"@us": [{{"min": 4, "max": 7, "count": {count}}}]}}}}')
+        self.assertEqual(list(tables.hists["@us"].counts), [3])
@@ -1,31 +1,35 @@
-import os
+import io
+import shutil
+import sys
+import unittest
+from pathlib import Path
 import pygments
 from prompt_toolkit import print_formatted_text
 from prompt_toolkit.formatted_text import PygmentsTokens
+from prompt_toolkit.output import create_output
 from pygments_markdown_lexer import MarkdownLexer
-from typing import Any
-from langchain import ConversationChain, OpenAI
-from langchain.chat_models import ChatOpenAI
-from langchain.chains.conversation.memory import ConversationBufferMemory
-from llama_index import LLMPredictor, ServiceContext, StorageContext, VectorStoreIndex, SimpleDirectoryReader, load_index_from_storage
+from typing import TYPE_CHECKING, Any, Optional, TextIO
 
 from gpttrace.config import cfg
 
-def get_doc_content_for_query(index: VectorStoreIndex, query: str) -> str:
+if TYPE_CHECKING:
+    from langchain import ConversationChain
+    from gpttrace.doc_index import DocIndex
+
+def get_doc_content_for_query(index: "DocIndex", query: str, k: Optional[int] = None) -> str:
     """
     Find the content from the document that is closest to the user's request
 
     :param index: Vector database
     :param query: User's request
+    :param k: The maximum number of chunks to return, defaults to `DOC_TOP_K`.
     :return: The content that is most relevant to the user's request.
     """
-    query_engine = index.as_query_engine()
-    response = query_engine.query(query)
-    related_contents = response.source_nodes
-    if related_contents is not None:
+    related_contents = index.search(query, int(cfg.get("DOC_TOP_K")) if k is None else k)
+    if related_contents:
         contents = "\nThere are some related information about this query:\n"
         for i, content in enumerate(related_contents):
-            info = f"Info {i}: {content.node.get_text()}\n"
+            info = f"Info {i}: {content}\n"
             contents += info
         return contents
     else:
@@ -44,44 +48,149 @@ def pretty_print(input_info: str, lexer: Any = MarkdownLexer, *args: Any, **kwar
     tokens = list(pygments.lex(input_info, lexer=lexer()))
     print_formatted_text(PygmentsTokens(tokens), *args, **kwargs)
 
-def init_conversation(need_train: bool, verbose: bool) -> list[ConversationChain, VectorStoreIndex]:
+class StreamingMarkdownPrinter:
+    """
+    Prints Markdown as it streams in, highlighted like `pretty_print`.
+
+    Text is written as soon as it arrives; when a line is complete it is
+    erased and printed again, highlighted. The lexer sees the current block
+    (paragraph or fenced code) up to that line, so code fences are colored
+    correctly. Output that is not a terminal gets the plain text only.
+    """
+    def __init__(self, lexer: Any = MarkdownLexer, file: Optional[TextIO] = None):
+        """
+        Initializes a StreamingMarkdownPrinter object.
+
+        :param lexer: The lexer to highlight with. Defaults to MarkdownLexer.
+        :param file: Where to print, defaults to stdout.
+        """
+        self.lexer = lexer()
+        self.file = file if file is not None else sys.stdout
+        self.highlight = self.file.isatty()
+        self.output = create_output(stdout=self.file) if self.highlight else None
+        self.text = ""
+        # Offsets into `text`: the current line, and the block it belongs to.
+        self.line_start = 0
+        self.block_start = 0
+        self.in_fence = False
+        # Characters of the current line already written unhighlighted.
+        self.shown = 0
+
+    def feed(self, delta: str) -> None:
+        """
+        Prints the next piece of the text.
+
+        :param delta: The text that just arrived.
+        """
+        self.text += delta
+        end = self.text.find("\n", self.line_start)
+        while end != -1:
+            self._finish_line(end + 1)
+            end = self.text.find("\n", self.line_start)
+        pending = self.text[self.line_start + self.shown:]
+        if pending:
+            self.file.write(pending)
+            self.file.flush()
+            self.shown += len(pending)
+
+    def close(self) -> None:
+        """
+        Prints the last line, if it did not end with a newline.
+        """
+        if self.line_start < len(self.text):
+            self.text += "\n"
+            self._finish_line(len(self.text))
+
+    def _finish_line(self, end: int) -> None:
+        line = self.text[self.line_start:end]
+        if not self.highlight:
+            self.file.write(line[self.shown:])
+        else:
+            self._erase_shown()
+            offset = self.line_start - self.block_start
+            tokens = []
+            for index, token_type, value in self.lexer.get_tokens_unprocessed(self.text[self.block_start:end]):
+                if index + len(value) > offset:
+                    tokens.append((token_type, value[max(0, offset - index):]))
+            print_formatted_text(PygmentsTokens(tokens), end="", output=self.output)
+        self.file.flush()
+        stripped = line.strip()
+        if stripped.startswith("```"):
+            self.in_fence = not self.in_fence
+            # A closing fence ends the block; an opening one starts it.
+            self.block_start = end if not self.in_fence else self.line_start
+        elif stripped == "" and not self.in_fence:
+            self.block_start = end
+        self.line_start = end
+        self.shown = 0
+
+    def _erase_shown(self) -> None:
+        if self.shown == 0:
+            return
+        width = shutil.get_terminal_size().columns
+        rows = (self.shown - 1) // max(width, 1)
+        # Back to the start of the line, up over wrapped rows, then clear to the end of the screen.
+        self.file.write("\r" + "\x1b[A" * rows + "\x1b[J")
+
+
+def init_conversation(need_train: bool, verbose: bool) -> "list[ConversationChain, DocIndex]":
     """
     Initialize the conversation and vector database.
 
+    The Markdown files under `DOC_PATH` are indexed file by file: only files
+    whose content changed since the last run are chunked and embedded.
+
     :param need_train: Whether you need to use a vector database.
     :verbose: Whether to print extra information.
-    :return: Containing two elements: The ConversationChain object is a conversation between a human and an AI. The VectorStoreIndex object is vector database.
+    :return: Containing two elements: The ConversationChain object is a conversation between a human and an AI. The DocIndex object is vector database.
     """
+    from langchain import ConversationChain
+    from langchain.chat_models import ChatOpenAI
+    from langchain.chains.conversation.memory import ConversationBufferMemory
+    from langchain.embeddings.openai import OpenAIEmbeddings
+    from gpttrace.doc_index import DocIndex
+
     model_name = cfg.get("DEFAULT_MODEL")
     llm = ChatOpenAI(model_name=model_name, temperature=0)
     agent_chain = ConversationChain(llm=llm, verbose=verbose,
                                     memory=ConversationBufferMemory())
     if need_train:
-        vector_path = cfg.get("VECTOR_DATABASE_PATH")
-        if not os.path.exists(vector_path):
-            print(f"{vector_path} not found. Training...")
-            md_files = []
-            # Get all markdown files in the tutorial
-            for root, _, files in os.walk(cfg.get("DOC_PATH")):
-                for file in files:
-                    if file.endswith('.md'):
-                        md_files.append(os.path.join(root, file))
-            print(f":: {cfg.get('DOC_PATH')}, {md_files}")
-            documents = SimpleDirectoryReader(input_files=md_files).load_data()
-            llm_predictor = LLMPredictor(llm=OpenAI(
-                temperature=0, model_name="text-davinci-003"))
-            service_context = ServiceContext.from_defaults(
-                llm_predictor=llm_predictor)
-            index = VectorStoreIndex.from_documents(
-                documents, service_context=service_context)
-            index.storage_context.persist(vector_path)
-            print(
-                f"Training completed, {vector_path} has been saved.")
-        else:
-            print(f"Loading the {vector_path}...")
-            storage_context = StorageContext.from_defaults(
-                persist_dir=vector_path)
-            index = load_index_from_storage(storage_context)
+        doc_path = Path(cfg.get("DOC_PATH"))
+        # Get all markdown files in the tutorial
+        md_files = sorted(doc_path.rglob("*.md"))
+        index = DocIndex(Path(cfg.get("DOC_INDEX_PATH")), OpenAIEmbeddings())
+        changed = index.sync(md_files, doc_path)
+        if verbose or changed:
+            print(f"Indexed {changed} new or changed of {len(md_files)} documents under {doc_path}.")
     else:
         index = None
     return agent_chain, index
+
+
+class _FakeTerminal(io.StringIO):
+    def isatty(self) -> bool:
+        return True
+
+
+class TestStreamingMarkdownPrinter(unittest.TestCase):
+    text = "# Result\n\nThe `vfs_read` calls:\n```\n@[comm] = count();\n```\nDone"
+
+    def test_plain_output(self):
+        file = io.StringIO()
+        printer = StreamingMarkdownPrinter(file=file)
+        for i in range(0, len(self.text), 3):
+            printer.feed(self.text[i:i + 3])
+        printer.close()
+        self.assertEqual(file.getvalue(), self.text + "\n")
+
+    def test_highlighted_output(self):
+        file = _FakeTerminal()
+        printer = StreamingMarkdownPrinter(file=file)
+        for i in range(0, len(self.text), 3):
+            printer.feed(self.text[i:i + 3])
+        printer.close()
+        output = file.getvalue()
+        self.assertIn("\x1b[J", output)
+        # Every line is printed again, highlighted, after its raw text was erased.
+        plain = output.split("\x1b[J")[-1]
+        self.assertIn("Done", plain)
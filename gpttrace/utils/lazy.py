@@ -0,0 +1,31 @@
+import importlib
+import time
+from typing import Dict, List, Tuple
+
+# Modules each subcommand imports, in the order they are first touched.
+SUBCOMMAND_BACKENDS: Dict[str, List[str]] = {
+    "cmd": ["gpttrace.config", "aiohttp", "gpttrace.cmd"],
+    "execute": ["gpttrace.config", "aiohttp", "langchain", "gpttrace.execute"],
+}
+
+
+def profile_imports(modules: List[str]) -> List[Tuple[str, float]]:
+    """
+    Imports the given modules in order and measures how long each one takes.
+
+    The cost of a module is incremental: dependencies already pulled in by an
+    earlier module in the list are not counted again.
+
+    :param modules: The fully qualified names of the modules to import.
+    :return: A list of (module name, seconds) pairs.
+    """
+    costs = []
+    for name in modules:
+        start = time.perf_counter()
+        try:
+            importlib.import_module(name)
+        except ImportError:
+            costs.append((name, float("nan")))
+            continue
+        costs.append((name, time.perf_counter() - start))
+    return costs
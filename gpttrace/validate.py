@@ -0,0 +1,312 @@
+import json
+import re
+import shutil
+import subprocess
+import unittest
+from pathlib import Path
+from unittest import mock
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple
+
+from gpttrace.bpftrace import bpftrace_command, construct_command
+from gpttrace.model_router import PARSE_ERROR
+from gpttrace.probe_catalog import FIXTURE, ProbeCatalog, get_probe_catalog
+
+# Probe types bpftrace accepts, with their short aliases.
+PROBE_TYPES = {
+    "BEGIN", "END", "kprobe", "k", "kretprobe", "kr", "uprobe", "u", "uretprobe", "ur",
+    "tracepoint", "t", "usdt", "U", "profile", "p", "interval", "i", "software", "s",
+    "hardware", "h", "watchpoint", "w", "asyncwatchpoint", "aw", "kfunc", "f", "kretfunc",
+    "fr", "fentry", "fexit", "rawtracepoint", "rt", "iter", "it", "self",
+}
+# Seconds a dry run may take before the candidate is rejected.
+DRY_RUN_TIMEOUT = 30
+# Exit statuses of a shell or sudo that could not run the command at all: not executable, not found.
+COMMAND_NOT_RUN = (126, 127)
+# Errors that come from where the dry run ran, not from the program.
+ENVIRONMENT_ERRORS = re.compile(r"^sudo:|only supports running as the root user", re.M)
+BRACKETS = {"(": ")", "[": "]", "{": "}"}
+# Top level blocks that declare types rather than attach to probes, e.g. `struct cfs_rq { ... };`.
+DEFINITION = re.compile(r"^\s*(struct|union|enum|typedef)\b")
+
+
+def static_check(program: str) -> str:
+    """
+    Checks a bpftrace program for mistakes that need no kernel to find.
+
+    Brackets and strings must be balanced, every top level block must follow
+    a probe, and every probe must have a known type.
+
+    :param program: The bpftrace program.
+    :return: The error in bpftrace's `ERROR: ...` style, or "" if none was found.
+    """
+    error, headers, _ = _scan(program)
+    if error:
+        return error
+    for header in headers:
+        probes = _header_probes(header)
+        if not probes:
+            return "ERROR: block without a probe"
+        for probe in probes:
+            if probe.split(":")[0] not in PROBE_TYPES:
+                return f"ERROR: invalid probe type: {probe}"
+    return ""
+
+
+def attach_points(program: str) -> List[str]:
+    """
+    :param program: A bpftrace program that passes `static_check`.
+    :return: The probes the program attaches to, as written in it.
+    """
+    _, headers, _ = _scan(program)
+    return [probe for header in headers for probe in _header_probes(header)]
+
+
+def check_attach_points(program: str) -> str:
+    """
+    Checks that the kernel has the tracepoints and kprobes a program attaches to.
+
+    :param program: The bpftrace program.
+    :return: The error, or "" if all were found or the probes cannot be listed on this machine.
+    """
+    catalog = get_probe_catalog()
+    if catalog is None:
+        return ""
+    missing = catalog.missing(attach_points(program))
+    lines = []
+    for attach_point in missing:
+        neighbors = catalog.neighbors(attach_point)
+        hint = f" (similar: {', '.join(neighbors)})" if neighbors else ""
+        lines.append(f"ERROR: attach point not found: {attach_point}{hint}")
+    return "\n".join(lines)
+
+
+def program_blocks(program: str) -> List[Tuple[str, int, int, int]]:
+    """
+    :param program: A bpftrace program that passes `static_check`.
+    :return: For each top level block, the probes and predicate before it without comments, where
+        that text starts, and the positions of the block's opening and closing braces.
+    """
+    _, headers, spans = _scan(program)
+    return [(header, *span) for header, span in zip(headers, spans)]
+
+
+def _scan(program: str) -> Tuple[str, List[str], List[Tuple[int, int, int]]]:
+    """
+    :param program: The bpftrace program.
+    :return: The first syntax error, or "", the text before each top level probe block, and where
+        that text starts and the block opens and closes. Preprocessor lines and type definitions
+        are skipped.
+    """
+    if program.strip() == "":
+        return "ERROR: empty program", [], []
+    stack = []
+    headers = []
+    spans = []
+    header = ""
+    start = 0
+    definition = False
+    i = 0
+    while i < len(program):
+        char = program[i]
+        if char == "#" and not stack and program[program.rfind("\n", 0, i) + 1:i].strip() == "":
+            # A preprocessor line, continued by a trailing backslash.
+            end = program.find("\n", i)
+            while end != -1 and program[:end].rstrip().endswith("\\"):
+                end = program.find("\n", end + 1)
+            i = len(program) if end == -1 else end
+            continue
+        if program.startswith("//", i):
+            end = program.find("\n", i)
+            i = len(program) if end == -1 else end
+            continue
+        if program.startswith("/*", i):
+            end = program.find("*/", i + 2)
+            if end == -1:
+                return "ERROR: unterminated comment", headers, spans
+            i = end + 2
+            continue
+        if char == '"':
+            i += 1
+            while i < len(program) and program[i] != '"':
+                i += 2 if program[i] == "\\" else 1
+            if i >= len(program):
+                return "ERROR: unterminated string", headers, spans
+        elif char in BRACKETS:
+            if char == "{" and not stack:
+                definition = DEFINITION.match(header) is not None
+                if not definition:
+                    headers.append(header)
+                    spans.append((start, i, -1))
+                header = ""
+            stack.append(BRACKETS[char])
+        elif char in BRACKETS.values():
+            if not stack or stack.pop() != char:
+                return f"ERROR: unexpected '{char}'", headers, spans
+            if char == "}" and not stack:
+                if definition:
+                    # The definition ends at the ";" after its fields, e.g. `} name_t;`.
+                    end = program.find(";", i)
+                    if end == -1:
+                        return "ERROR: missing ';' after a type definition", headers, spans
+                    i = end
+                    definition = False
+                else:
+                    spans[-1] = (spans[-1][0], spans[-1][1], i)
+                start = i + 1
+        elif not stack:
+            header += char
+        i += 1
+    if stack:
+        return f"ERROR: missing '{stack[-1]}'", headers, spans
+    if header.strip() != "":
+        return f"ERROR: probe without a block: {header.strip()}", headers, spans
+    return "", headers, spans
+
+
+def _header_probes(header: str) -> List[str]:
+    """
+    :param header: The text before a top level block: probes and an optional `/predicate/`.
+    :return: The probes of the block.
+    """
+    # A predicate starts with a "/" after whitespace; uprobe paths have "/" after ":".
+    probes = re.split(r"(?:^|\s)/", header.strip())[0].strip()
+    return [probe.strip() for probe in probes.split(",") if probe.strip()]
+
+
+def dry_run(args: dict, timeout: int = DRY_RUN_TIMEOUT) -> str:
+    """
+    Parses and checks a bpftrace program with `bpftrace -d` without attaching any probe.
+
+    :param args: The arguments of the bpftrace function call.
+    :param timeout: Seconds after which the dry run is abandoned.
+    :return: The stderr of a failed dry run, or "" if it passed or could not run here, e.g.
+        because sudo needs a password.
+    """
+    args = dict(args, debugInfo=True)
+    # -n: fail instead of asking for a password from a background thread.
+    command = bpftrace_command(non_interactive=True) + construct_command(args)
+    try:
+        res = subprocess.run(command, capture_output=True, text=True, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        return "ERROR: dry run timed out"
+    except OSError:
+        return ""
+    if res.returncode in COMMAND_NOT_RUN or ENVIRONMENT_ERRORS.search(res.stderr):
+        return ""
+    if res.returncode != 0:
+        return res.stderr or f"ERROR: dry run exited with {res.returncode}"
+    return ""
+
+
+def validate_function_call(response_message: dict) -> str:
+    """
+    Checks a bpftrace function call before it is offered to the user.
+
+    The static check always runs, the attach points are checked against the
+    probe catalog if there is one, and the dry run only runs if bpftrace is installed.
+
+    :param response_message: The response message of the model.
+    :return: The error, or "" if the function call looks runnable.
+    """
+    function_call = response_message.get("function_call")
+    if not function_call or function_call["name"] != "bpftrace":
+        return ""
+    try:
+        args = json.loads(function_call["arguments"])
+    except json.JSONDecodeError as err:
+        return f"{PARSE_ERROR}: {err}"
+    error = static_check(args.get("program", ""))
+    if error == "":
+        error = check_attach_points(args["program"])
+    if error == "" and shutil.which(bpftrace_command()[-1]) is not None:
+        error = dry_run(args)
+    return error
+
+
+def candidate_command(response_message: dict) -> str:
+    """
+    :param response_message: A candidate response message of the model.
+    :return: The command the candidate would run, for the attempt history.
+    """
+    function_call = response_message.get("function_call")
+    if not function_call:
+        return "response_message"
+    if function_call["name"] != "bpftrace":
+        return function_call["name"]
+    try:
+        args = json.loads(function_call["arguments"])
+    except json.JSONDecodeError:
+        return " ".join(bpftrace_command() + [function_call["arguments"]])
+    return " ".join(bpftrace_command() + construct_command(args))
+
+
+def validate_candidates(messages: List[dict]) -> List[str]:
+    """
+    Validates several candidate function calls in parallel.
+
+    :param messages: The candidate response messages of the model.
+    :return: The error of each candidate, "" for the ones that passed.
+    """
+    if len(messages) <= 1:
+        return [validate_function_call(message) for message in messages]
+    with ThreadPoolExecutor(max_workers=len(messages)) as pool:
+        return list(pool.map(validate_function_call, messages))
+
+
+def _message(program: str) -> dict:
+    return {"role": "assistant", "content": None,
+            "function_call": {"name": "bpftrace", "arguments": json.dumps({"program": program})}}
+
+
+class TestValidate(unittest.TestCase):
+    def test_static_check(self):
+        self.assertEqual(static_check("tracepoint:syscalls:sys_enter_openat { printf(\"%s }\\n\", comm); }"), "")
+        self.assertEqual(static_check("BEGIN { @start = nsecs; }\n// done }\nEND { clear(@start); }"), "")
+        self.assertEqual(static_check("kprobe:vfs_read /pid == 1/ { @[comm] = count(); }"), "")
+        self.assertEqual(static_check("uprobe:/bin/bash:readline, uretprobe:/bin/bash:readline { }"), "")
+        self.assertEqual(static_check("kprobe:vfs_read { @[comm] = count();"), "ERROR: missing '}'")
+        self.assertEqual(static_check("kprobe:vfs_read { @[comm] = count()); }"), "ERROR: unexpected ')'")
+        self.assertEqual(static_check("kprobe:vfs_read { printf(\"x); }"), "ERROR: unterminated string")
+        self.assertEqual(static_check("syscall:open { }"), "ERROR: invalid probe type: syscall:open")
+        self.assertEqual(attach_points("#include <linux/fs.h>\nBEGIN { }\nt:a:b, k:c /pid/ { }"),
+                         ["BEGIN", "t:a:b", "k:c"])
+        self.assertEqual(attach_points("#define LOG(x) { printf(\"%d\\n\", x); \\\n}\n"
+                                       "typedef struct { int a; } pair_t;\nBEGIN { LOG(1) }"), ["BEGIN"])
+        tools = Path(__file__).parent.parent / "tools"
+        for name, probes in [("runqlen.bt", ["BEGIN", "profile:hz:99"]),
+                             ("dcsnoop.bt", ["BEGIN", "kprobe:lookup_fast", "kprobe:lookup_fast.constprop.*",
+                                             "kprobe:d_lookup", "kretprobe:d_lookup"])]:
+            program = (tools / name).read_text()
+            self.assertEqual(static_check(program), "")
+            self.assertEqual(attach_points(program), probes)
+
+    def test_check_attach_points(self):
+        catalog = ProbeCatalog(sorted(FIXTURE.split()))
+        with mock.patch("gpttrace.validate.get_probe_catalog", return_value=catalog):
+            self.assertEqual(check_attach_points("t:syscalls:sys_enter_openat { }"), "")
+            error = check_attach_points("tracepoint:syscalls:sys_enter_opennat { }")
+        self.assertTrue(error.startswith("ERROR: attach point not found: tracepoint:syscalls:sys_enter_opennat"))
+        self.assertIn("tracepoint:syscalls:sys_enter_open,", error)
+
+    def test_validate_candidates(self):
+        with mock.patch("gpttrace.validate.get_probe_catalog", return_value=None):
+            errors = validate_candidates([_message("kprobe:vfs_read {"), _message("BEGIN { exit(); }"),
+                                          {"role": "assistant", "content": "no tool"}])
+        self.assertEqual(errors[0], "ERROR: missing '}'")
+        if shutil.which("bpftrace") is None:
+            self.assertEqual(errors[1], "")
+        self.assertEqual(errors[2], "")
+
+    def test_dry_run_environment_errors(self):
+        args = {"program": "BEGIN { exit(); }"}
+        for returncode, stderr in [(1, "sudo: a password is required\n"), (127, ""),
+                                   (1, "ERROR: bpftrace currently only supports running as the root user.\n")]:
+            res = subprocess.CompletedProcess([], returncode, "", stderr)
+            with mock.patch("subprocess.run", return_value=res):
+                self.assertEqual(dry_run(args), "")
+        with mock.patch("subprocess.run", side_effect=FileNotFoundError("bpftrace")):
+            self.assertEqual(dry_run(args), "")
+        res = subprocess.CompletedProcess([], 1, "", "stdin:1:1-6: ERROR: Invalid probe type: BEGN\n")
+        with mock.patch("subprocess.run", return_value=res):
+            self.assertIn("Invalid probe type", dry_run(args))
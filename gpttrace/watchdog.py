@@ -0,0 +1,345 @@
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+from pathlib import Path
+from unittest import mock
+from typing import Dict, List, Optional, Tuple, TypedDict
+
+from gpttrace.config import cfg
+
+PROC = Path("/proc")
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+class ResourceUsage(TypedDict):
+    # CPU seconds of the command and its children, and the highest CPU % over one sample interval
+    cpu_seconds: float
+    peak_cpu_percent: float
+    peak_rss_mb: float
+    output_mb: float
+    peak_output_mb_per_s: float
+    # the budget that was exceeded, e.g. "rss 812 MB > 512 MB", or None
+    exceeded: Optional[str]
+    # the last signal the watchdog sent: "SIGINT", "SIGKILL" or None
+    signal: Optional[str]
+
+
+class ResourceBudget:
+    """
+    Limits on the resources a traced command may use, 0 for no limit.
+
+    Budgets are not enforced for the first `grace` seconds, while bpftrace
+    compiles and loads the program, and a budget only counts as exceeded
+    once it was over for `sustain` consecutive samples, so short spikes do
+    not stop a trace.
+    """
+    def __init__(self, cpu_percent: float = 0, rss_mb: float = 0, output_mb_per_s: float = 0,
+                 interval: float = 0.5, sustain: int = 3, kill_after: float = 5.0, grace: float = 0.0):
+        """
+        Initializes a ResourceBudget object.
+
+        :param cpu_percent: The CPU use of the command and its children, in % of one CPU.
+        :param rss_mb: The resident memory of the command and its children, in MB.
+        :param output_mb_per_s: The rate at which the command writes stdout and stderr, in MB/s.
+        :param interval: Seconds between samples.
+        :param sustain: The number of consecutive samples a budget must be exceeded for.
+        :param kill_after: Seconds between SIGINT and SIGKILL if the command does not exit.
+        :param grace: Seconds after the start during which the budgets are not enforced.
+        """
+        self.cpu_percent = cpu_percent
+        self.rss_mb = rss_mb
+        self.output_mb_per_s = output_mb_per_s
+        self.interval = interval
+        self.sustain = sustain
+        self.kill_after = kill_after
+        self.grace = grace
+
+    @classmethod
+    def from_config(cls) -> "ResourceBudget":
+        """
+        :return: The budget configured in `cfg`.
+        """
+        return cls(float(cfg.get("WATCHDOG_MAX_CPU_PERCENT")), float(cfg.get("WATCHDOG_MAX_RSS_MB")),
+                   float(cfg.get("WATCHDOG_MAX_OUTPUT_MBPS")), float(cfg.get("WATCHDOG_INTERVAL")),
+                   int(cfg.get("WATCHDOG_SUSTAIN")), float(cfg.get("WATCHDOG_KILL_AFTER")),
+                   float(cfg.get("WATCHDOG_GRACE")))
+
+
+def _read_stat(pid: int) -> Optional[Tuple[int, float, int]]:
+    """
+    :return: The parent pid, CPU seconds and RSS in bytes of a process, or None if it is gone.
+    """
+    try:
+        with open(PROC / str(pid) / "stat", "r") as file:
+            stat = file.read()
+    except OSError:
+        return None
+    # The command name may contain spaces and parentheses; the fields after it do not.
+    fields = stat[stat.rindex(")") + 2:].split()
+    ppid, utime, stime, rss = int(fields[1]), int(fields[11]), int(fields[12]), int(fields[21])
+    return ppid, (utime + stime) / CLOCK_TICKS, rss * PAGE_SIZE
+
+
+def _children(pid: int) -> Optional[List[int]]:
+    """
+    :return: The children of a process from `/proc/<pid>/task/*/children`, or None if the kernel
+        does not have these files.
+    """
+    children = []
+    try:
+        tasks = list((PROC / str(pid) / "task").iterdir())
+    except OSError:
+        return []
+    for task in tasks:
+        try:
+            children += [int(child) for child in (task / "children").read_text().split()]
+        except FileNotFoundError:
+            if not task.exists():
+                # The thread exited.
+                continue
+            return None
+        except OSError:
+            continue
+    return children
+
+
+def _scan_tree(pid: int) -> Dict[int, Tuple[float, int]]:
+    """
+    Finds the descendants of a process by reading the parent of every process in `/proc`.
+    """
+    stats = {}
+    children: Dict[int, List[int]] = {}
+    for entry in PROC.iterdir():
+        if entry.name.isdigit():
+            stat = _read_stat(int(entry.name))
+            if stat is not None:
+                stats[int(entry.name)] = stat
+                children.setdefault(stat[0], []).append(int(entry.name))
+    tree = {}
+    pending = [pid]
+    while pending:
+        current = pending.pop()
+        if current in stats:
+            tree[current] = stats[current][1:]
+            pending.extend(children.get(current, []))
+    return tree
+
+
+def process_tree(pid: int) -> Dict[int, Tuple[float, int]]:
+    """
+    Reads the CPU time and RSS of a process and all its descendants, e.g. bpftrace under sudo.
+
+    The tree is walked from the root through `/proc/<pid>/task/*/children`;
+    kernels without these files fall back to scanning all of `/proc`.
+
+    :param pid: The root process.
+    :return: The CPU seconds and RSS in bytes of each process of the tree.
+    """
+    tree = {}
+    pending = [pid]
+    while pending:
+        current = pending.pop()
+        stat = _read_stat(current)
+        if stat is None:
+            continue
+        children = _children(current)
+        if children is None:
+            return _scan_tree(pid)
+        tree[current] = stat[1:]
+        pending.extend(children)
+    return tree
+
+
+class Watchdog:
+    """
+    Samples a running command's CPU, memory and output rate and stops it when it goes over budget.
+
+    The command first gets SIGINT, so bpftrace detaches its probes and
+    prints its maps as if the user had pressed Ctrl-C; if it has not exited
+    `kill_after` seconds later, it gets SIGKILL. CPU and memory are read
+    from `/proc` for the whole process tree, so they are only watched on
+    Linux; the output rate is counted by the reader of the pipes.
+    """
+    def __init__(self, process: subprocess.Popen, budget: ResourceBudget):
+        """
+        Initializes a Watchdog object.
+
+        :param process: The command, just started.
+        :param budget: The limits it runs under.
+        """
+        self.process = process
+        self.budget = budget
+        self.watch_proc = PROC.is_dir()
+        self.started = self.last_sample = time.monotonic()
+        self.next_check = self.started + budget.interval
+        self.output_bytes = 0
+        self.last_output_bytes = 0
+        # CPU seconds of the processes seen so far, kept after they exit.
+        self.cpu: Dict[int, float] = {}
+        self.last_cpu = 0.0
+        self.over = 0
+        self.kill_at: Optional[float] = None
+        self.usage: ResourceUsage = {"cpu_seconds": 0.0, "peak_cpu_percent": 0.0, "peak_rss_mb": 0.0,
+                                     "output_mb": 0.0, "peak_output_mb_per_s": 0.0, "exceeded": None,
+                                     "signal": None}
+
+    def add_output(self, size: int) -> None:
+        """
+        Counts bytes read from the command's pipes.
+
+        :param size: The number of bytes.
+        """
+        self.output_bytes += size
+
+    def sample(self, now: float) -> Tuple[float, float, float]:
+        """
+        Measures the command since the previous sample and updates `usage`.
+
+        :param now: The current `time.monotonic()`.
+        :return: The CPU %, RSS in MB and output MB/s of the interval.
+        """
+        elapsed = max(now - self.last_sample, 1e-6)
+        self.last_sample = now
+        usage = self.usage
+        # A short last interval would make the rates jump.
+        full_interval = elapsed >= self.budget.interval / 2
+        output_rate = (self.output_bytes - self.last_output_bytes) / elapsed / 1e6
+        self.last_output_bytes = self.output_bytes
+        usage["output_mb"] = self.output_bytes / 1e6
+        if full_interval:
+            usage["peak_output_mb_per_s"] = max(usage["peak_output_mb_per_s"], output_rate)
+        cpu_percent, rss_mb = 0.0, 0.0
+        if self.watch_proc:
+            tree = process_tree(self.process.pid)
+            for pid, (cpu_seconds, _) in tree.items():
+                self.cpu[pid] = cpu_seconds
+            total_cpu = sum(self.cpu.values())
+            cpu_percent = (total_cpu - self.last_cpu) / elapsed * 100
+            self.last_cpu = total_cpu
+            rss_mb = sum(rss for _, rss in tree.values()) / 1e6
+            usage["cpu_seconds"] = total_cpu
+            if full_interval:
+                usage["peak_cpu_percent"] = max(usage["peak_cpu_percent"], cpu_percent)
+            usage["peak_rss_mb"] = max(usage["peak_rss_mb"], rss_mb)
+        return cpu_percent, rss_mb, output_rate
+
+    def check(self, now: float) -> None:
+        """
+        Takes a sample if one is due and signals the command if it is over budget.
+
+        :param now: The current `time.monotonic()`.
+        """
+        if now < self.next_check:
+            return
+        self.next_check = now + self.budget.interval
+        cpu_percent, rss_mb, output_rate = self.sample(now)
+        if self.kill_at is not None:
+            if now >= self.kill_at and self.process.poll() is None:
+                self._signal(signal.SIGKILL)
+                self.kill_at = float("inf")
+            return
+        budget = self.budget
+        if now - self.started < budget.grace:
+            return
+        exceeded = None
+        if budget.cpu_percent and cpu_percent > budget.cpu_percent:
+            exceeded = f"cpu {cpu_percent:.0f}% > {budget.cpu_percent:g}%"
+        elif budget.rss_mb and rss_mb > budget.rss_mb:
+            exceeded = f"rss {rss_mb:.0f} MB > {budget.rss_mb:g} MB"
+        elif budget.output_mb_per_s and output_rate > budget.output_mb_per_s:
+            exceeded = f"output {output_rate:.1f} MB/s > {budget.output_mb_per_s:g} MB/s"
+        self.over = self.over + 1 if exceeded is not None else 0
+        if self.over >= budget.sustain:
+            self.usage["exceeded"] = exceeded
+            self._signal(signal.SIGINT)
+            self.kill_at = now + budget.kill_after
+
+    def _signal(self, signum: signal.Signals) -> None:
+        if self.process.poll() is not None:
+            return
+        try:
+            # sudo relays SIGINT to bpftrace.
+            self.process.send_signal(signum)
+        except ProcessLookupError:
+            return
+        self.usage["signal"] = signum.name
+
+    def timeout(self, now: float) -> float:
+        """
+        :param now: The current `time.monotonic()`.
+        :return: Seconds until the next sample is due.
+        """
+        return max(0.0, self.next_check - now)
+
+
+def _run(code: str, budget: ResourceBudget, timeout: float = 30) -> Tuple[str, ResourceUsage]:
+    from gpttrace.capture import capture_output
+
+    with subprocess.Popen([sys.executable, "-c", code], stdout=subprocess.PIPE,
+                          stderr=subprocess.PIPE) as process:
+        watchdog = Watchdog(process, budget)
+        stdout, _, _ = capture_output(process, timeout, echo=False, watchdog=watchdog)
+        process.wait()
+    return stdout, watchdog.usage
+
+
+class TestWatchdog(unittest.TestCase):
+    def test_process_tree_walks_children(self):
+        with tempfile.TemporaryDirectory() as proc:
+            # sudo (10) runs bpftrace (11) with a thread (12) that started a helper (13); 20 is unrelated.
+            for pid, ppid, threads in [(10, 1, {10: "11"}), (11, 10, {11: "", 12: "13"}), (13, 11, {13: ""}),
+                                       (20, 1, {20: ""})]:
+                for tid, children in threads.items():
+                    task = Path(proc, str(pid), "task", str(tid))
+                    task.mkdir(parents=True)
+                    (task / "children").write_text(children)
+                stat = f"{pid} (a (b)) S {ppid}" + " 0" * 9 + f" {pid} 1" + " 0" * 8 + " 2" + " 0" * 30
+                Path(proc, str(pid), "stat").write_text(stat)
+            with mock.patch(f"{__name__}.PROC", Path(proc)):
+                tree = process_tree(10)
+                self.assertEqual(sorted(tree), [10, 11, 13])
+                self.assertEqual(tree[11], ((11 + 1) / CLOCK_TICKS, 2 * PAGE_SIZE))
+                # Without the children files, all of /proc is scanned.
+                for children in Path(proc).glob("*/task/*/children"):
+                    children.unlink()
+                self.assertEqual(sorted(process_tree(10)), [10, 11, 13])
+
+    def test_output_rate_stops_with_sigint(self):
+        code = ("import sys\n"
+                "try:\n"
+                "    while True: sys.stdout.write('x' * 1023 + '\\n')\n"
+                "except KeyboardInterrupt:\n"
+                "    print('@maps: 1')\n")
+        start = time.monotonic()
+        stdout, usage = _run(code, ResourceBudget(output_mb_per_s=1, interval=0.1, sustain=2))
+        self.assertLess(time.monotonic() - start, 10)
+        self.assertTrue(stdout.endswith("@maps: 1\n"))
+        self.assertEqual(usage["signal"], "SIGINT")
+        self.assertTrue(usage["exceeded"].startswith("output"))
+        self.assertGreater(usage["output_mb"], 0.1)
+
+    @unittest.skipUnless(PROC.is_dir(), "needs /proc")
+    def test_rss_escalates_to_sigkill(self):
+        code = ("import signal, time\n"
+                "signal.signal(signal.SIGINT, signal.SIG_IGN)\n"
+                "data = bytearray(200 << 20)\n"
+                "for i in range(0, len(data), 4096): data[i] = 1\n"
+                "time.sleep(30)\n")
+        start = time.monotonic()
+        _, usage = _run(code, ResourceBudget(rss_mb=100, interval=0.1, sustain=2, kill_after=0.5))
+        self.assertLess(time.monotonic() - start, 10)
+        self.assertEqual(usage["signal"], "SIGKILL")
+        self.assertTrue(usage["exceeded"].startswith("rss"))
+        self.assertGreater(usage["peak_rss_mb"], 100)
+
+    def test_within_budget(self):
+        stdout, usage = _run("print('ok')", ResourceBudget(cpu_percent=100, rss_mb=1000, output_mb_per_s=10,
+                                                           interval=0.05))
+        self.assertEqual(stdout, "ok\n")
+        self.assertIsNone(usage["exceeded"])
+        self.assertIsNone(usage["signal"])
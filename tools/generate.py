@@ -1,15 +1,27 @@
-import re
-import openai
-import os
+import argparse
+import hashlib
 import json
-import glob
+import os
+import re
+import tempfile
+import threading
 import time
-openai.api_key = os.getenv("OPENAI_API_KEY")
+import unittest
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+from typing import Callable
+from unittest import mock
+
+from gpttrace import llm
+from gpttrace.config import cfg
+
+# Summaries added before `output.json` and `examples.json` are rewritten; they are also written at the end.
+SAVE_EVERY = 16
 
 
 def get_bpf_summary(bpf_code):
-    response = openai.ChatCompletion.create(
-        model="gpt-3.5-turbo",
+    response = llm.chat(
+        model=cfg.get("DEFAULT_MODEL"),
         messages=[
             {"role": "system", "content": "You are a helpful assistant."},
             {"role": "user", "content": 
@@ -30,35 +42,168 @@ start with action-oriented phrases such as 'Write a BPF code that...'
         max_tokens=1500
     )
 
-    output = response.choices[0].message['content']
+    output = response["choices"][0]["message"]["content"]
     return output
 
 
-def get_all_bpf_in_dir(directory):
-    all_files = glob.glob(directory + '/*.bt')
-    all_bpf = []
-    for file in all_files:
-        print("opening file: " + file)
-        # sleep for a short time to avoid hitting the rate limit
-        # Sleep for 5 seconds
-        time.sleep(3)
-        with open(file, 'r') as f:
-            bpf_code = f.read()
-            summary = get_bpf_summary(bpf_code)
-            all_bpf.append({
-                "request": summary,
-                "bpf": bpf_code
-            })
-            print(bpf_code)
-            print(summary)
-            
-    return all_bpf
+class TokenBucket:
+    """
+    Limits the rate of calls across threads.
+
+    The bucket holds up to `capacity` tokens and refills at `rate` tokens per
+    second; a call waits until it can take its tokens. Unlike a fixed sleep,
+    bursts go through at once and the average stays under the limit.
+    """
+    def __init__(self, rate: float, capacity: float):
+        """
+        Initializes a full TokenBucket object.
+
+        :param rate: Tokens added per second.
+        :param capacity: The maximum number of tokens.
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens: float = 1) -> None:
+        """
+        Takes tokens, waiting until there are enough.
+
+        :param tokens: The number of tokens to take, at most `capacity`.
+        """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                wait = (tokens - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def source_hash(bpf_code: str) -> str:
+    """
+    :param bpf_code: The source of a bpftrace program.
+    :return: The hex SHA-256 digest of the source.
+    """
+    return hashlib.sha256(bpf_code.encode("utf-8")).hexdigest()
+
+
+def format_example(entry: dict) -> dict:
+    """
+    :param entry: A summarized program of `output.json`, with its `request` and `bpf`.
+    :return: The entry of `examples.json` for the program.
+    """
+    cleaned_content = remove_multiline_comments(re.split(r'(\n)', entry['bpf']))
+    return {"content": f"example: {entry['request']}\n\n```\n{cleaned_content}\n```\n"}
+
+
+def write_json(path: Path, data) -> None:
+    """
+    Replaces a JSON file atomically, so an interrupted build leaves it intact.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=path.name + ".")
+    with os.fdopen(fd, "w", encoding="utf-8") as file:
+        json.dump(data, file)
+    os.replace(tmp_path, path)
+
+
+def build_corpus(directory: Path, tools_path: Path, workers: int = 8, requests_per_minute: float = 60,
+                 summarize: Callable[[str], str] = get_bpf_summary) -> int:
+    """
+    Summarizes the new `.bt` programs of a directory into the example corpus.
+
+    Programs whose source hash is already in `output.json` are skipped.
+    The others are summarized concurrently under a rate limit. The
+    summaries are written to `output.json` and `examples.json` every
+    `SAVE_EVERY` summaries and at the end, so an interrupted build resumes
+    with at most that many programs to summarize again.
+
+    :param directory: The directory of the `.bt` programs.
+    :param tools_path: The directory of `output.json` and `examples.json`.
+    :param workers: The number of summaries requested at once.
+    :param requests_per_minute: The rate limit of the summary requests.
+    :param summarize: Turns a program into the request it answers.
+    :return: The number of programs summarized.
+    """
+    output_path = Path(tools_path) / "output.json"
+    examples_path = Path(tools_path) / "examples.json"
+    entries = []
+    if output_path.exists():
+        with open(output_path, "r", encoding="utf-8") as file:
+            entries = json.load(file)
+    examples = {"data": []}
+    if examples_path.exists():
+        with open(examples_path, "r", encoding="utf-8") as file:
+            examples = json.load(file)
+    if len(examples["data"]) < len(entries):
+        examples = {"data": [format_example(entry) for entry in entries]}
+    known = {entry.get("hash") or source_hash(entry["bpf"]) for entry in entries}
+
+    pending = {}
+    for bt_path in sorted(Path(directory).glob("*.bt")):
+        bpf_code = bt_path.read_text(encoding="utf-8")
+        digest = source_hash(bpf_code)
+        if digest not in known and digest not in pending:
+            pending[digest] = (bt_path, bpf_code)
+    print(f"{len(pending)} new programs, {len(known)} already summarized")
+    if not pending:
+        return 0
+
+    bucket = TokenBucket(requests_per_minute / 60, max(1, workers))
+
+    def summarize_one(bpf_code: str) -> str:
+        bucket.acquire()
+        return summarize(bpf_code)
+
+    done = saved = 0
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = {pool.submit(summarize_one, bpf_code): (digest, bt_path, bpf_code)
+                       for digest, (bt_path, bpf_code) in pending.items()}
+            # Results are handled in this thread only, so the corpus needs no lock.
+            for future in as_completed(futures):
+                digest, bt_path, bpf_code = futures[future]
+                try:
+                    summary = future.result()
+                except Exception as err:
+                    print(f"failed to summarize {bt_path.name}: {err}")
+                    continue
+                entry = {"request": summary, "bpf": bpf_code, "file": bt_path.name, "hash": digest}
+                entries.append(entry)
+                examples["data"].append(format_example(entry))
+                done += 1
+                print(f"[{done}/{len(pending)}] {bt_path.name}: {summary}")
+                if done - saved >= SAVE_EVERY:
+                    write_json(output_path, entries)
+                    write_json(examples_path, examples)
+                    saved = done
+    finally:
+        if done > saved:
+            write_json(output_path, entries)
+            write_json(examples_path, examples)
+    return done
+
+
+def update_indexes(embed: bool = False) -> None:
+    """
+    Brings the retrieval indexes of the examples up to date with the corpus.
+
+    :param embed: Whether to also embed new examples into the vector index, which calls the embedding API.
+    """
+    from gpttrace.examples import get_bm25_index, get_example_index
+
+    get_bm25_index()
+    if embed:
+        get_example_index()
+
 
 def write_example_to_json():
-    directory = './'
-    all_bpf = get_all_bpf_in_dir(directory)
-    with open('output.json', 'w') as outfile:
-        json.dump(all_bpf, outfile)
+    build_corpus(Path('./'), Path(cfg.get("TOOLS_PATH")))
 
 def remove_multiline_comments(lines):
     """
@@ -98,17 +243,77 @@ def remove_multiline_comments(lines):
     return cleaned_content
 
 def reformat():
-    rearranged_data = {"data": []}
-    with open("./tools/output.json", mode='r', encoding='utf-8') as file:
+    """
+    Rewrites `examples.json` from scratch from `output.json`.
+    """
+    tools_path = Path(cfg.get("TOOLS_PATH"))
+    with open(tools_path / "output.json", mode='r', encoding='utf-8') as file:
         contents = json.load(file)
-        for content in contents:
-            cleaned_content = remove_multiline_comments(re.split(r'(\n)', content['bpf']))
-            example = f"example: {content['request']}\n\n```\n{cleaned_content}\n```\n"
-            info = {"content": example}
-            rearranged_data["data"].append(info)
-
-    with open("./tools/examples.json", 'w', encoding='utf-8') as file:
-        json.dump(rearranged_data, file)
-    
+    write_json(tools_path / "examples.json", {"data": [format_example(content) for content in contents]})
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Summarize bpftrace programs into the example corpus.")
+    parser.add_argument("directory", nargs="?", default=cfg.get("TOOLS_PATH"),
+                        help="The directory of the .bt programs")
+    parser.add_argument("--workers", type=int, default=8, help="Summaries requested at once")
+    parser.add_argument("--rpm", type=float, default=60, help="Summary requests per minute")
+    parser.add_argument("--embed", action="store_true", help="Also embed new examples into the vector index")
+    parser.add_argument("--reformat", action="store_true", help="Only rewrite examples.json from output.json")
+    args = parser.parse_args()
+    if args.reformat:
+        reformat()
+    else:
+        build_corpus(Path(args.directory), Path(cfg.get("TOOLS_PATH")), args.workers, args.rpm)
+    update_indexes(args.embed)
+
+
+class TestBuildCorpus(unittest.TestCase):
+    def test_incremental_and_concurrent(self):
+        calls = []
+
+        def summarize(bpf_code):
+            calls.append(bpf_code)
+            time.sleep(0.05)
+            return "Write a BPF code that " + bpf_code.split()[0]
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = Path(directory)
+            for i in range(8):
+                (path / f"tool{i}.bt").write_text(f"kprobe:f{i} {{ }}\n")
+            (path / "copy.bt").write_text("kprobe:f0 { }\n")
+            start = time.perf_counter()
+            self.assertEqual(build_corpus(path, path, workers=8, requests_per_minute=6000, summarize=summarize), 8)
+            self.assertLess(time.perf_counter() - start, 0.3)
+            (path / "tool8.bt").write_text("kprobe:f8 { }\n")
+            self.assertEqual(build_corpus(path, path, summarize=summarize), 1)
+            with open(path / "examples.json", "r", encoding="utf-8") as file:
+                examples = json.load(file)["data"]
+        self.assertEqual(len(calls), 9)
+        self.assertEqual(len(examples), 9)
+        self.assertTrue(examples[-1]["content"].startswith("example: Write a BPF code that kprobe:f8"))
+
+    def test_batched_writes(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = Path(directory)
+            for i in range(8):
+                (path / f"tool{i}.bt").write_text(f"kprobe:f{i} {{ }}\n")
+            with mock.patch(f"{__name__}.SAVE_EVERY", 3), \
+                    mock.patch(f"{__name__}.write_json", wraps=write_json) as write:
+                self.assertEqual(build_corpus(path, path, summarize=lambda bpf_code: "Write a BPF code"), 8)
+            # After 3 and 6 summaries and at the end, two files each time.
+            self.assertEqual(write.call_count, 6)
+            with open(path / "output.json", "r", encoding="utf-8") as file:
+                self.assertEqual(len(json.load(file)), 8)
+
+    def test_token_bucket(self):
+        bucket = TokenBucket(rate=100, capacity=2)
+        start = time.perf_counter()
+        for _ in range(6):
+            bucket.acquire()
+        # Two tokens at once, then four at 100 per second.
+        self.assertGreaterEqual(time.perf_counter() - start, 0.035)
+
+
 if __name__ == "__main__":
-    reformat()
+    main()